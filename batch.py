@@ -0,0 +1,340 @@
+#!/usr/bin/env python -O
+
+import argparse
+import json
+import os
+import random
+import re
+import socket
+import sys
+import threading
+import time
+from collections import deque
+import client
+import server
+from folders import quote
+from pool import ConnectionPool, PoolTimeoutError
+from search import Query
+
+# This module runs operations on many accounts without interaction. A job file
+# lists accounts and operations, and each operation of each account is one
+# job. The jobs are shared by a pool of worker threads, at most a limited
+# number of them on one host at once, and the result of each job is written as
+# one JSON line as soon as it ends.
+#
+# A job file is a JSON object such as:
+#
+#     {"accounts":   [{"host": "imap.example.com", "username": "alice",
+#                      "password": "secret"}],
+#      "operations": [{"op": "count", "mailbox": "INBOX"},
+#                     {"op": "export", "dest": "backup", "format": "mbox"},
+#                     {"op": "flag", "mailbox": "INBOX", "search": "SEEN",
+#                      "flags": ["\\Deleted"], "mode": "+"}],
+#      "hosts":      {"imap.example.com": 8}}
+#
+# "hosts" optionally overrides the limit of running jobs of some hosts.
+
+# The default number of worker threads.
+WORKERS = 8
+# The default maximum number of jobs running at once on one host. Servers
+# limit the connections from one address as well as those of one user.
+HOST_CONNECTIONS = 4
+# The default number of retries of a job failing for a transient reason.
+RETRIES = 3
+# The seconds before the first retry, doubled by each next one.
+BACKOFF = 1.0
+# The most seconds before a retry.
+BACKOFF_MAX = 60.0
+
+# Regular expression to match the errors worth retrying: the server closed the
+# connection, or is temporarily unable to serve. [7.1.5, RFC 5530]
+Transient = re.compile(r'\bBYE\b|\[(UNAVAILABLE|INUSE|LIMIT|SERVERBUG)\]', re.I)
+
+class Error(Exception): pass
+
+def opCount(imap, operation):
+    """ Return the number of emails of a mailbox, or of those matching the
+    raw search keys of 'search'.
+    """
+    query = Query(operation['search']) if operation.get('search') else None
+    return imap.count(operation.get('mailbox', 'INBOX'), query)
+
+def opExport(imap, operation):
+    """ Export the mailboxes, by default all of them, into the directory
+    'dest'/host/username, and return the number of emails exported of each.
+
+    The export resumes from its checkpoints when the job is retried.
+    """
+    mailboxes = operation.get('mailboxes')
+    if mailboxes is None:
+        mailboxes = [quote(folder.name) for folder in imap.getFolders().walk() if folder.selectable()]
+    dest = os.path.join(operation['dest'], imap.host, imap.username)
+    # One connection per job, so the host limit holds.
+    return imap.export(mailboxes, dest, operation.get('format', 'maildir'), 1)
+
+def opFlag(imap, operation):
+    """ Add, remove or replace the flags of the emails of a mailbox matching
+    the raw search keys of 'search', and return the numbers matched and
+    flagged.
+    """
+    mailbox = operation.get('mailbox', 'INBOX')
+    query = Query(operation['search']) if operation.get('search') else None
+    uids = imap.search(mailbox, query)
+    flagged = imap.store(mailbox, uids, operation['flags'], operation.get('mode', '+')) if uids else 0
+    return {'matched': len(uids), 'flagged': flagged}
+
+# The operations of jobs by name.
+OPERATIONS = {'count': opCount, 'export': opExport, 'flag': opFlag}
+
+def transient(error):
+    """ Return true if a job failing with the given exception may succeed when
+    retried.
+    """
+    if isinstance(error, (server.AbortError, PoolTimeoutError, socket.error)):
+        return True
+    return isinstance(error, server.Error) and Transient.search(str(error)) is not None
+
+class Job(object):
+    """ One operation on one account.
+
+    Arguments:
+        account:   The account, a dictionary of host, username and password.
+        operation: The operation, a dictionary of op and its arguments.
+        tries:     The number of times the job was started.
+        ready:     The time before which the job is not retried.
+    """
+
+    def __init__(self, account, operation):
+        self.account = account
+        self.operation = operation
+        self.tries = 0
+        self.ready = 0
+
+    def key(self):
+        """ Return the (host, username) of the account.
+        """
+        return self.account['host'], self.account['username']
+
+def load(path):
+    """ Read a job file.
+
+    Raise:
+        Error: If the job file is malformed.
+
+    Returns:
+        A tuple of the list of Jobs, account by account, and the dictionary
+        of host limits.
+    """
+    try:
+        with open(path) as f:
+            spec = json.load(f)
+    except ValueError, e:
+        raise Error(path + ': ' + str(e))
+    accounts = spec.get('accounts') or []
+    operations = spec.get('operations') or []
+    for account in accounts:
+        if not all(isinstance(account.get(name), basestring) for name in ('host', 'username', 'password')):
+            raise Error(path + ': An account needs a host, a username and a password')
+    for operation in operations:
+        if operation.get('op') not in OPERATIONS:
+            raise Error(path + ': Unknown operation ' + str(operation.get('op')))
+    limits = dict((str(host), int(limit)) for host, limit in (spec.get('hosts') or {}).items())
+    return [Job(account, operation) for account in accounts for operation in operations], limits
+
+class Scheduler(object):
+    """ The runner of jobs on a pool of worker threads.
+
+    Jobs wait in one queue per host, served in turn. A job starts once its host
+    runs fewer jobs than its limit, and a job failing for a transient reason
+    goes back to its queue until its backoff elapses, so it never holds a
+    worker or a host slot while waiting. The idle connections of an account
+    are logged out once its last job ends.
+
+    Arguments:
+        output:    The file the JSON lines are written to.
+        workers:   The number of worker threads.
+        limit:     The maximum number of running jobs of a host.
+        limits:    A dictionary maps hosts to their own limits.
+        retries:   The number of retries of a job failing for a transient
+                   reason.
+        backoff:   The seconds before the first retry, doubled by each next
+                   one up to BACKOFF_MAX.
+        pool:      The ConnectionPool shared by the jobs.
+        queues:    A dictionary maps hosts to the deques of their waiting
+                   jobs.
+        hosts:     The deque of hosts with waiting jobs, in turn.
+        running:   A dictionary maps hosts to their numbers of running jobs.
+        remaining: A dictionary maps accounts to their numbers of jobs not
+                   ended.
+        succeeded: The number of jobs succeeded.
+        failed:    The number of jobs failed.
+        lock:      The condition guarding the queues and the output.
+    """
+
+    def __init__(self, output, workers=WORKERS, limit=HOST_CONNECTIONS, limits=None,
+                 retries=RETRIES, backoff=BACKOFF, engine=server.IMAPServer):
+        """ Construct the scheduler.
+
+        Args:
+            output:  The file the JSON lines are written to.
+            workers: The number of worker threads.
+            limit:   The maximum number of running jobs of a host.
+            limits:  A dictionary maps hosts to their own limits.
+            retries: The number of retries of a job failing for a transient
+                     reason.
+            backoff: The seconds before the first retry.
+            engine:  The IMAP server class used to connect.
+        """
+        self.output = output
+        self.workers = workers
+        self.limit = limit
+        self.limits = limits or {}
+        self.retries = retries
+        self.backoff = backoff
+        # An account never runs more jobs than its host.
+        self.pool = ConnectionPool(engine, max([limit] + self.limits.values()))
+        self.queues = {}
+        self.hosts = deque()
+        self.running = {}
+        self.remaining = {}
+        self.succeeded = 0
+        self.failed = 0
+        self.lock = threading.Condition()
+
+    def run(self, jobs):
+        """ Run the jobs and wait for all of them to end.
+
+        Args:
+            jobs: The list of Jobs.
+
+        Returns:
+            A tuple of the numbers of jobs succeeded and failed.
+        """
+        with self.lock:
+            for job in jobs:
+                self._put(job)
+                self.remaining[job.key()] = self.remaining.get(job.key(), 0) + 1
+        threads = [threading.Thread(target=self._work) for i in range(min(self.workers, len(jobs)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            # Join with a timeout, so the main thread still gets interrupts.
+            while thread.is_alive():
+                thread.join(1)
+        self.pool.close()
+        return self.succeeded, self.failed
+
+    def _put(self, job):
+        """ Queue a job. The caller must hold the lock.
+        """
+        host = job.account['host']
+        if host not in self.queues:
+            self.queues[host] = deque()
+            self.hosts.append(host)
+        self.queues[host].append(job)
+
+    def _take(self):
+        """ Remove the next job which can start, waiting if necessary.
+
+        Returns:
+            The Job, None once all jobs ended.
+        """
+        with self.lock:
+            while 1:
+                now = time.time()
+                wakeup = None
+                for i in range(len(self.hosts)):
+                    host = self.hosts[0]
+                    self.hosts.rotate(-1)
+                    if self.running.get(host, 0) >= self.limits.get(host, self.limit):
+                        continue
+                    queue = self.queues[host]
+                    for job in queue:
+                        if job.ready <= now:
+                            queue.remove(job)
+                            if not queue:
+                                del self.queues[host]
+                                self.hosts.remove(host)
+                            self.running[host] = self.running.get(host, 0) + 1
+                            return job
+                        wakeup = min(wakeup or job.ready, job.ready)
+                if not self.hosts and not any(self.running.values()):
+                    return None
+                self.lock.wait(None if wakeup is None else wakeup - now)
+
+    def _work(self):
+        """ Run jobs until all of them ended.
+        """
+        while 1:
+            job = self._take()
+            if job is None:
+                return
+            record = self._run(job)
+            with self.lock:
+                self.running[job.account['host']] -= 1
+                if record['status'] == 'retry':
+                    self._put(job)
+                else:
+                    if record['status'] == 'ok':
+                        self.succeeded += 1
+                    else:
+                        self.failed += 1
+                    self.remaining[job.key()] -= 1
+                self.output.write(json.dumps(record, sort_keys=True) + '\n')
+                self.output.flush()
+                self.lock.notify_all()
+                done = self.remaining[job.key()] == 0
+            if done:
+                self.pool.close(*job.key())
+
+    def _run(self, job):
+        """ Run a job once and return its result record.
+        """
+        job.tries += 1
+        account, operation = job.account, job.operation
+        record = {'host': account['host'], 'username': account['username'],
+                  'operation': operation, 'try': job.tries}
+        start = time.time()
+        try:
+            imap = client.IMAPClient(account['host'], account['username'], account['password'], pool=self.pool)
+            record['result'] = OPERATIONS[operation['op']](imap, operation)
+            record['status'] = 'ok'
+        except Exception, e:
+            record['error'] = '%s: %s' % (e.__class__.__name__, e)
+            record['status'] = 'error'
+            if transient(e) and job.tries <= self.retries:
+                # The jitter spreads the retries of the jobs of a host which
+                # failed together.
+                delay = min(self.backoff * 2 ** (job.tries - 1), BACKOFF_MAX) * random.uniform(0.5, 1)
+                job.ready = time.time() + delay
+                record['status'] = 'retry'
+                record['retry_in'] = round(delay, 3)
+        record['seconds'] = round(time.time() - start, 4)
+        return record
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run IMAP jobs of many accounts.')
+    parser.add_argument('jobs', help='the job file')
+    parser.add_argument('-w', '--workers', type=int, default=WORKERS,
+                        help='worker threads (default: %d)' % WORKERS)
+    parser.add_argument('-l', '--limit', type=int, default=HOST_CONNECTIONS,
+                        help='running jobs per host (default: %d)' % HOST_CONNECTIONS)
+    parser.add_argument('-r', '--retries', type=int, default=RETRIES,
+                        help='retries of transient failures (default: %d)' % RETRIES)
+    parser.add_argument('-p', '--port', type=int, default=server.IMAP_SSL_PORT,
+                        help='imap port (default: %d)' % server.IMAP_SSL_PORT)
+    parser.add_argument('-o', '--output', help='write the results to the file')
+    args = parser.parse_args()
+
+    server.IMAP_SSL_PORT = args.port
+    try:
+        jobs, limits = load(args.jobs)
+    except (Error, IOError), e:
+        sys.stderr.write('batch: ' + str(e) + '\n')
+        sys.exit(2)
+    output = open(args.output, 'a') if args.output else sys.stdout
+    scheduler = Scheduler(output, args.workers, args.limit, limits, args.retries)
+    succeeded, failed = scheduler.run(jobs)
+    sys.stderr.write('%d jobs succeeded, %d failed\n' % (succeeded, failed))
+    sys.exit(1 if failed else 0)
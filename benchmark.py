@@ -0,0 +1,198 @@
+#!/usr/bin/env python -O
+
+import argparse
+import json
+import os
+import platform
+import resource
+import time
+import client
+import server
+from fakeserver import FakeIMAPServer, makeMailboxes
+
+# This script measures the client against an IMAP server, by default the
+# bundled FakeIMAPServer with synthetic mailboxes: login latency, LIST of the
+# folder tree, FETCH throughput and the peak memory of getEmails() and
+# getEmail(), with and without COMPRESS=DEFLATE. The results are printed as
+# JSON, so they can be compared between versions. Run it with -O, so no
+# debugging information is printed.
+
+# The version of the result format.
+REPORT_VERSION = 1
+# The maximum number of emails read one by one by getEmail().
+GET_EMAIL_COUNT = 100
+
+def measure(function, *args):
+    """ Call a function in a child process and return its results with the
+    peak memory it used.
+
+    Memory is freed only to the process, so each measure starts afresh in its
+    own process. The function returns a dictionary of results.
+
+    Returns:
+        The results, with 'peak_kb', the growth of the peak resident memory
+        in KB.
+    """
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        try:
+            base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            result = function(*args)
+            result['peak_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base
+        except Exception, e:
+            result = {'error': str(e)}
+        os.write(write, json.dumps(result))
+        os._exit(0)
+    os.close(write)
+    data = ''
+    while 1:
+        chunk = os.read(read, 65536)
+        if not chunk:
+            break
+        data += chunk
+    os.close(read)
+    os.waitpid(pid, 0)
+    return json.loads(data)
+
+def _throughput(seconds, num, size):
+    """ Return the results of reading emails.
+    """
+    seconds = max(seconds, 1e-9)
+    return {'seconds': round(seconds, 4), 'messages': num, 'bytes': size,
+            'messages_per_s': round(num / seconds, 1),
+            'mb_per_s': round(size / seconds / 1024 / 1024, 3)}
+
+def benchLogin(host, username, password, rounds):
+    """ Return the mean seconds to connect and log in.
+    """
+    seconds = []
+    for i in range(rounds):
+        start = time.time()
+        imap = client.IMAPClient(host, username, password)
+        seconds.append(time.time() - start)
+        compressed = imap.server.deflater is not None
+        imap.logout()
+    return {'seconds': round(sum(seconds) / len(seconds), 4), 'best': round(min(seconds), 4),
+            'compressed': compressed}
+
+def benchList(host, username, password):
+    """ Return the seconds to list the folder tree, without and with status.
+    """
+    imap = client.IMAPClient(host, username, password)
+    start = time.time()
+    folders = len(imap.getFolders(refresh=True).names)
+    middle = time.time()
+    imap.getFolders(status=True, refresh=True)
+    end = time.time()
+    imap.logout()
+    return {'folders': folders, 'seconds': round(middle - start, 4),
+            'status_seconds': round(end - middle, 4)}
+
+def benchHeaders(host, username, password, mailbox):
+    """ Return the throughput of fetching the headers of all emails.
+    """
+    imap = client.IMAPClient(host, username, password)
+    start = time.time()
+    records = imap.getHeaders(mailbox)
+    seconds = time.time() - start
+    imap.logout()
+    size = sum(len(record.section('BODY[HEADER]') or '') for record in records)
+    return _throughput(seconds, len(records), size)
+
+def benchGetEmails(host, username, password, mailbox):
+    """ Return the throughput of getEmails() fetching whole emails.
+    """
+    imap = client.IMAPClient(host, username, password)
+    start = time.time()
+    emails = imap.getEmails(mailbox, 'BODY.PEEK[]')
+    seconds = time.time() - start
+    imap.logout()
+    return _throughput(seconds, len(emails), sum(len(email) for email in emails))
+
+def benchGetEmail(host, username, password, mailbox):
+    """ Return the throughput of getEmail() reading emails one by one.
+    """
+    imap = client.IMAPClient(host, username, password)
+    num = min(imap.count(mailbox), GET_EMAIL_COUNT)
+    size = 0
+    start = time.time()
+    for i in range(1, num + 1):
+        email = imap.getEmail(mailbox, i)
+        size += sum(len(part) for part in email)
+    seconds = time.time() - start
+    imap.logout()
+    return _throughput(seconds, num, size)
+
+def run(host, username, password, mailbox, rounds, modes):
+    """ Return the results of all benchmarks for each compression mode.
+
+    Args:
+        host:     The address of the IMAP server.
+        username: The username.
+        password: The password.
+        mailbox:  The mailbox read.
+        rounds:   The number of logins measured.
+        modes:    The compression modes, 'plain' and 'compressed'.
+    """
+    results = {}
+    for mode in modes:
+        server.COMPRESS_DEFLATE = mode == 'compressed'
+        results[mode] = {
+                'login':     benchLogin(host, username, password, rounds),
+                'list':      benchList(host, username, password),
+                'headers':   measure(benchHeaders, host, username, password, mailbox),
+                'getEmails': measure(benchGetEmails, host, username, password, mailbox),
+                'getEmail':  measure(benchGetEmail, host, username, password, mailbox)
+                }
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the IMAP client.')
+    parser.add_argument('host', nargs='?',
+                        help='imap host (default: a bundled local server)')
+    parser.add_argument('username', nargs='?', default='user', help='username')
+    parser.add_argument('password', nargs='?', default='password', help='password')
+    parser.add_argument('-m', '--mailbox', default='INBOX',
+                        help='the mailbox read (default: INBOX)')
+    parser.add_argument('-p', '--port', type=int, default=server.IMAP_SSL_PORT,
+                        help='imap port (default: %d)' % server.IMAP_SSL_PORT)
+    parser.add_argument('-r', '--rounds', type=int, default=5,
+                        help='the number of logins measured (default: 5)')
+    parser.add_argument('-c', '--compress', choices=('off', 'on', 'both'), default='both',
+                        help='use COMPRESS=DEFLATE (default: both)')
+    parser.add_argument('-n', '--messages', type=int, default=1000,
+                        help='emails in the local server (default: 1000)')
+    parser.add_argument('-s', '--size', type=int, default=4096,
+                        help='bytes per email in the local server (default: 4096)')
+    parser.add_argument('-f', '--folders', type=int, default=1000,
+                        help='folders in the local server (default: 1000)')
+    parser.add_argument('-l', '--latency', type=float, default=0,
+                        help='seconds of latency of the local server (default: 0)')
+    parser.add_argument('-o', '--output', help='write the results to the file')
+    args = parser.parse_args()
+
+    report = {'version': REPORT_VERSION, 'python': platform.python_version(),
+              'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())}
+    host = args.host
+    fake = None
+    if host is None:
+        fake = FakeIMAPServer(makeMailboxes(args.messages, args.size, args.folders), args.latency)
+        server.IMAP_SSL_PORT = fake.start()
+        host = fake.host
+        report['server'] = {'messages': args.messages, 'size': args.size,
+                            'folders': args.folders, 'latency': args.latency}
+    else:
+        server.IMAP_SSL_PORT = args.port
+        report['server'] = {'host': host}
+    modes = {'off': ['plain'], 'on': ['compressed'], 'both': ['plain', 'compressed']}[args.compress]
+    report['results'] = run(host, args.username, args.password, args.mailbox, args.rounds, modes)
+    if fake is not None:
+        fake.stop()
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
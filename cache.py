@@ -0,0 +1,164 @@
+import os
+import sqlite3
+import threading
+import time
+from response import EmailRecord
+
+# The default directory of the cache database.
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.imapCMD')
+# The default maximum size of the cached data in bytes.
+CACHE_BUDGET = 256 * 1024 * 1024
+# The maximum number of parameters in one SQL statement.
+SQL_BATCH = 500
+
+class HeaderCache(object):
+    """ The persistent cache of email headers, flags and sizes.
+
+    Emails are keyed by (account, mailbox, UIDVALIDITY, UID). A UID is never
+    reused in a mailbox with the same UIDVALIDITY, so a cached email stays
+    valid until the UIDVALIDITY changes. [2.3.1.1] When the cached data
+    exceeds the budget, the least recently used emails are evicted.
+
+    Arguments:
+        db:     The SQLite connection.
+        budget: The maximum size of the cached data in bytes.
+        size:   The current size of the cached data in bytes.
+        lock:   The lock guarding the database, shared by pooled clients.
+    """
+
+    def __init__(self, directory=CACHE_DIR, budget=CACHE_BUDGET):
+        """ Open the cache database in the given directory.
+
+        Args:
+            directory: The directory of the cache database.
+            budget:    The maximum size of the cached data in bytes.
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.db = sqlite3.connect(os.path.join(directory, 'cache.db'), check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS emails ('
+                        'account TEXT, mailbox TEXT, uidvalidity INTEGER, uid INTEGER, '
+                        'flags TEXT, size INTEGER, internaldate TEXT, header BLOB, '
+                        'bytes INTEGER, used REAL, '
+                        'PRIMARY KEY (account, mailbox, uidvalidity, uid))')
+        self.db.execute('CREATE INDEX IF NOT EXISTS emails_used ON emails (used)')
+        self.db.commit()
+        self.budget = budget
+        self.size = self.db.execute('SELECT COALESCE(SUM(bytes), 0) FROM emails').fetchone()[0]
+        self.lock = threading.Lock()
+
+    def invalidate(self, account, mailbox, uidvalidity):
+        """ Remove the emails of a mailbox cached with another UIDVALIDITY.
+
+        Args:
+            account:     The account, such as 'user@host'.
+            mailbox:     The mailbox name.
+            uidvalidity: The current UIDVALIDITY of the mailbox.
+        """
+        with self.lock:
+            where = ' FROM emails WHERE account = ? AND mailbox = ? AND uidvalidity != ?'
+            params = (account, mailbox, uidvalidity)
+            self.size -= self.db.execute('SELECT COALESCE(SUM(bytes), 0)' + where, params).fetchone()[0]
+            self.db.execute('DELETE' + where, params)
+            self.db.commit()
+
+    def get(self, account, mailbox, uidvalidity, uids):
+        """ Return the cached emails with the given UIDs.
+
+        Args:
+            account:     The account, such as 'user@host'.
+            mailbox:     The mailbox name.
+            uidvalidity: The UIDVALIDITY of the mailbox.
+            uids:        A list of UIDs.
+
+        Returns:
+            A dictionary maps UID to EmailRecord, for the cached UIDs only.
+            The sequence numbers of the records are 0.
+        """
+        records = {}
+        now = time.time()
+        with self.lock:
+            for i in range(0, len(uids), SQL_BATCH):
+                batch = list(uids[i:i + SQL_BATCH])
+                where = (' WHERE account = ? AND mailbox = ? AND uidvalidity = ? AND uid IN (' +
+                         ','.join('?' * len(batch)) + ')')
+                params = [account, mailbox, uidvalidity] + batch
+                rows = self.db.execute('SELECT uid, flags, size, internaldate, header FROM emails' + where, params)
+                for uid, flags, size, internaldate, header in rows:
+                    record = EmailRecord(0)
+                    record.uid = uid
+                    record.flags = flags.split(' ') if flags else []
+                    record.size = size
+                    record.internaldate = internaldate
+                    record.sections['BODY[HEADER]'] = str(header)
+                    records[uid] = record
+                self.db.execute('UPDATE emails SET used = ?' + where, [now] + params)
+            self.db.commit()
+        return records
+
+    def put(self, account, mailbox, uidvalidity, records):
+        """ Store emails fetched with UID, FLAGS, RFC822.SIZE, INTERNALDATE and
+        BODY[HEADER] in the cache.
+
+        Args:
+            account:     The account, such as 'user@host'.
+            mailbox:     The mailbox name.
+            uidvalidity: The UIDVALIDITY of the mailbox.
+            records:     A list of EmailRecords.
+        """
+        now = time.time()
+        with self.lock:
+            for record in records:
+                header = record.section('BODY[HEADER]') or ''
+                size = len(header) + 64
+                self.size -= self._bytes(account, mailbox, uidvalidity, record.uid)
+                self.db.execute('INSERT OR REPLACE INTO emails VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                (account, mailbox, uidvalidity, record.uid,
+                                 ' '.join(record.flags or []), record.size,
+                                 record.internaldate, buffer(header), size, now))
+                self.size += size
+            self._evict()
+            self.db.commit()
+
+    def updateFlags(self, account, mailbox, uidvalidity, flags):
+        """ Update the flags of cached emails.
+
+        Args:
+            account:     The account, such as 'user@host'.
+            mailbox:     The mailbox name.
+            uidvalidity: The UIDVALIDITY of the mailbox.
+            flags:       A dictionary maps UID to its list of flags.
+        """
+        with self.lock:
+            self.db.executemany('UPDATE emails SET flags = ? WHERE account = ? AND mailbox = ? '
+                                'AND uidvalidity = ? AND uid = ?',
+                                [(' '.join(f), account, mailbox, uidvalidity, uid)
+                                 for uid, f in flags.items()])
+            self.db.commit()
+
+    def _bytes(self, account, mailbox, uidvalidity, uid):
+        """ Return the size of one cached email, 0 if not cached.
+        """
+        row = self.db.execute('SELECT bytes FROM emails WHERE account = ? AND mailbox = ? '
+                              'AND uidvalidity = ? AND uid = ?',
+                              (account, mailbox, uidvalidity, uid)).fetchone()
+        return row[0] if row else 0
+
+    def _evict(self):
+        """ Remove the least recently used emails until the budget is met.
+
+        The caller must hold the lock.
+        """
+        while self.size > self.budget:
+            rows = self.db.execute('SELECT rowid, bytes FROM emails ORDER BY used LIMIT ?',
+                                   (SQL_BATCH,)).fetchall()
+            if not rows:
+                self.size = 0
+                break
+            evicted = []
+            for rowid, size in rows:
+                evicted.append((rowid,))
+                self.size -= size
+                if self.size <= self.budget:
+                    break
+            self.db.executemany('DELETE FROM emails WHERE rowid = ?', evicted)
@@ -1,24 +1,254 @@
 import server
+import seqset
+import itertools
 import re
+import socket
+import threading
+import time
+import Queue
+from contextlib import contextmanager
+from export import open_export, readMaildir, EXPORT_BATCH
+from folders import parseList, quote, FOLDER_TTL, STATUS_ITEMS
+from index import INDEX_TEXT_SIZE
+from message import LazyEmail, CHUNK_SIZE
+from pool import ConnectionPool, MAX_CONNECTIONS
+from response import parseFetch, tokenize
+from search import Query, parseSearch, parseESearch, parseSort, parseThread
+from seqset import UIDSet
+from sync import Synchronizer
 from util import printd
 
+# The default number of emails fetched by one FETCH command when streaming.
+BATCH_SIZE = 500
+# The data items kept in the header cache.
+HEADER_ITEMS = '(UID FLAGS RFC822.SIZE INTERNALDATE BODY.PEEK[HEADER])'
+# The data items of the preview of an email in a listing.
+PREVIEW_ITEMS = '(UID FLAGS RFC822.SIZE BODY.PEEK[HEADER.FIELDS (DATE FROM SUBJECT)])'
+# The default number of emails of a page of previews.
+PAGE_SIZE = 20
+# The seconds before IDLE is issued again. Servers may log out a client idle
+# for 30 minutes. [3, RFC 2177]
+IDLE_TIMEOUT = 29 * 60
+# The minimum and maximum seconds between two NOOP if IDLE is not supported.
+POLL_MIN = 5
+POLL_MAX = 300
+# The data items of an exported email.
+EXPORT_ITEMS = '(UID FLAGS INTERNALDATE BODY.PEEK[])'
+# The maximum number of emails appended by one MULTIAPPEND command.
+APPEND_BATCH = 100
+# The maximum number of APPEND commands in flight.
+APPEND_WINDOW = 16
+# The maximum length of the sequence set of one command, so that the command
+# line stays under the 8192 octets servers should accept. [4, RFC 7162]
+SEQUENCE_MAX = 8000
+# The maximum number of UID STORE, COPY, MOVE or EXPUNGE commands in flight.
+UID_WINDOW = 16
+# The maximum number of UID SEARCH commands grep sends for the emails not
+# indexed. Beyond it, one SEARCH of the whole mailbox costs less.
+GREP_SEARCHES = 8
+# The number of times a lost connection is opened again before giving up.
+RECONNECT_TRIES = 3
+# The seconds before opening a connection again after a failure, doubled by
+# each next failure.
+RECONNECT_DELAY = 1
+# The largest UID. [9]
+MAX_UID = 4294967295
+# The data items of an indexed email.
+INDEX_ITEMS = '(UID BODY.PEEK[HEADER] BODY.PEEK[TEXT]<0.%d>)' % INDEX_TEXT_SIZE
+
+def _splitRange(range, count, batch_size):
+    """ Split a message set into message sets of at most batch_size messages.
+
+    Args:
+        range:      The message set, such as '1:*' or '2,4:6'. [9]
+        count:      The number of messages, which '*' stands for.
+        batch_size: The maximum number of messages in one message set.
+
+    Returns:
+        A list of message sets.
+    """
+    batches = []
+    parts = []
+    size = 0
+    for item in range.split(','):
+        bounds = [count if bound == '*' else int(bound) for bound in item.split(':')]
+        start, end = max(min(bounds), 1), max(bounds)
+        if count is not None:
+            end = min(end, count)
+        while start <= end:
+            stop = min(end, start + batch_size - size - 1)
+            parts.append(str(start) if start == stop else '%d:%d' % (start, stop))
+            size += stop - start + 1
+            start = stop + 1
+            if size == batch_size:
+                batches.append(','.join(parts))
+                parts = []
+                size = 0
+    if parts:
+        batches.append(','.join(parts))
+    return batches
+
+def _uidSet(uids):
+    """ Return UIDs given as a UIDSet, a sequence set or an iterable as a
+    UIDSet.
+    """
+    if isinstance(uids, UIDSet):
+        return uids
+    if isinstance(uids, basestring):
+        return UIDSet.parse(uids)
+    return UIDSet(uids)
+
 class IMAPClient(object):
     """ IMAP client.
 
     Arguments:
-        server: IMAP server.
+        server:  IMAP server, None if connections are taken from a pool.
+        engine:  The IMAP server class.
+        pool:    The ConnectionPool shared with other clients, if any.
+        cache:   The HeaderCache consulted before fetching headers, if any.
+        index:   The TextIndex of fetched emails, if any.
+        account: The account name in the cache.
+        folders: The root Folder of the last listed mailbox tree, None if not
+                 listed yet.
+        listed:  The time the mailbox tree was listed.
     """
 
-    def __init__(self, host, username, password):
+    def __init__(self, host, username, password, engine=server.IMAPServer, pool=None, cache=None, index=None):
         """ Initialize the client with connect established.
 
         Args:
             host:     The address of the IMAP SSL host.
             username: The username.
             password: The password.
+            engine:   The IMAP server class, server.IMAPServer or the
+                      event-loop driven engine.IMAPServer.
+            pool:     A ConnectionPool to take connections from. Each
+                      operation then checks out its own connection, so the
+                      client can be used by several threads.
+            cache:    A HeaderCache to keep headers, flags and sizes in.
+            index:    A TextIndex to index fetched emails in, and to search.
+        """
+        self.host = host
+        self.username = username
+        self.password = password
+        self.engine = engine
+        self.pool = pool
+        self.cache = cache
+        self.index = index
+        self.account = username + '@' + host
+        self.folders = None
+        self.listed = 0
+        self.server = None
+        if pool is None:
+            self.server = self._login()
+
+    def _login(self):
+        """ Return a new connection, logged in, and compressed if possible.
+
+        Raise:
+            server.InvalidCommandError: If the login is rejected.
+        """
+        conn = self.engine(self.host)
+        data = conn.LOGIN(self.username, self.password)[1]
+        if conn.state != 'AUTH':
+            raise server.InvalidCommandError('Login failed for ' + self.username + '@' + self.host + ': ' + data)
+        if server.COMPRESS_DEFLATE:
+            conn.compress()
+        return conn
+
+    def _reconnect(self):
+        """ Replace the lost connection of this client by a new one.
+
+        Opening the connection is tried RECONNECT_TRIES times, waiting longer
+        after each failure.
+
+        Raise:
+            server.AbortError: If the connection cannot be opened again.
         """
-        self.server = server.IMAPServer(host)
-        self.server.LOGIN(username, password)
+        if __debug__:
+            printd('\n[reconnecting: ' + str(self.server.lost or self.server.bye) + ']\n')
+        try:
+            self.server.sock.close()
+        except socket.error:
+            pass
+        delay = RECONNECT_DELAY
+        for i in range(RECONNECT_TRIES):
+            if i > 0:
+                time.sleep(delay)
+                delay *= 2
+            try:
+                self.server = self._login()
+                return
+            except (server.AbortError, socket.error), e:
+                error = e
+        raise server.AbortError('Cannot reconnect to ' + self.host + ': ' + str(error))
+
+    def _lost(self, conn):
+        """ Return true if the connection is lost.
+
+        What the server sent while the connection was idle, such as BYE or the
+        end of the connection, is read first.
+        """
+        if conn.lost is None and not conn.pending:
+            try:
+                conn.poll(0)
+            except server.AbortError:
+                pass
+        # The server closes the connection after BYE. [7.1.5]
+        return conn.lost is not None or conn.bye is not None
+
+    @contextmanager
+    def _connection(self, directory=None, prefer=None):
+        """ Provide a connection for one operation.
+
+        If a directory is given, it is selected on the connection, and None
+        is provided if it cannot be selected. Connections keep the directory
+        selected afterwards, so the next operation on the same directory
+        skips SELECT, and the state of the mailbox kept by the connection
+        answers about its emails without a round-trip.
+
+        A connection lost since the last operation is replaced by a new one,
+        logged in again, before the directory is selected. A connection lost
+        during the operation raises server.AbortError to the operation.
+
+        Args:
+            directory: The mailbox to be selected.
+            prefer:    The mailbox the connection should have selected if
+                       possible, without selecting it.
+        """
+        if self.pool is None:
+            for i in range(RECONNECT_TRIES + 1):
+                if self._lost(self.server):
+                    self._reconnect()
+                try:
+                    type = 'OK'
+                    if directory is not None and self.server.mailbox != directory:
+                        type = self.server.SELECT(directory)[0]
+                    break
+                except server.AbortError:
+                    if i == RECONNECT_TRIES:
+                        raise
+            yield None if type == 'NO' else self.server
+            return
+        for i in range(RECONNECT_TRIES + 1):
+            conn = self.pool.checkout(self.host, self.username, self.password, directory or prefer)
+            try:
+                # A lost connection is discarded when checked in.
+                if self._lost(conn):
+                    continue
+                type = 'OK'
+                if directory is not None and conn.mailbox != directory:
+                    try:
+                        type = conn.SELECT(directory)[0]
+                    except server.AbortError:
+                        if i == RECONNECT_TRIES:
+                            raise
+                        continue
+                yield None if type == 'NO' else conn
+                return
+            finally:
+                self.pool.checkin(conn)
+        raise server.AbortError('Cannot reconnect to ' + self.host)
 
     def getMailBoxs(self, directory='""'):
         """ Return a list of mailboxs.
@@ -26,15 +256,55 @@ class IMAPClient(object):
         Args:
             directory: The parent diretory of the retrieving mailbox list.
         """
-        mailboxs = []
-        for line in self.server.LIST(directory)[2]:
-            mailboxs.append(line.split(' ')[-1][1:-1])
-        return mailboxs
+        with self._connection() as conn:
+            root = parseList(conn.LIST(directory)[2])
+        return [folder.name for folder in root.walk() if folder.selectable()]
+
+    def getFolders(self, status=False, refresh=False):
+        """ Return the root Folder of the mailbox tree.
+
+        The tree is listed again only once it is older than FOLDER_TTL, or if
+        the status of the folders is asked but was not listed. With
+        LIST-STATUS, the status of every folder comes with the same LIST.
+        [RFC 5819] Otherwise STATUS commands of all folders are pipelined, so
+        the status still costs one round-trip.
+
+        Args:
+            status:  Get the MESSAGES, UNSEEN and UIDNEXT of the folders.
+            refresh: List the tree even if the cached one is fresh.
+        """
+        folders = self.folders
+        if not refresh and folders is not None and time.time() - self.listed < FOLDER_TTL and \
+           (not status or folders.status is not None):
+            return folders
+        with self._connection() as conn:
+            if status and conn.capable('LIST-STATUS'):
+                untagged = conn.LIST('""', '*', 'STATUS ' + STATUS_ITEMS)[2]
+            else:
+                untagged = conn.LIST()[2]
+                if status:
+                    handles = [conn.send('STATUS', quote(folder.name), STATUS_ITEMS)
+                               for folder in parseList(untagged).walk() if folder.selectable()]
+                    for handle in handles:
+                        untagged = untagged + handle.result()[2]
+        folders = parseList(untagged)
+        # The status of the root tells whether the status was listed.
+        folders.status = {} if status else None
+        self.folders, self.listed = folders, time.time()
+        return folders
 
     # Other mail box operations.
-    def makeMailBox(self, path):                 self.server.CREATE(path)
-    def removeMailBox(self, path):               self.server.DELETE(path)
-    def renameMailBox(self, old_name, new_name): self.server.RENAME(path, old_name, new_name)
+    def makeMailBox(self, path):                 self._mailBoxCommand('CREATE', path)
+    def removeMailBox(self, path):               self._mailBoxCommand('DELETE', path)
+    def renameMailBox(self, old_name, new_name): self._mailBoxCommand('RENAME', old_name, new_name)
+
+    def _mailBoxCommand(self, command, *params):
+        """ Send a mail box command on any connection.
+        """
+        # The mailbox tree is changed.
+        self.folders = None
+        with self._connection() as conn:
+            return conn._interact(command, *params)
 
     def getEmails(self, directory, part='UID', range='1:*', raw=False):
         """ Get information of a list of emails.
@@ -45,23 +315,31 @@ class IMAPClient(object):
             range:     The range of email list in the mailbox.
             raw:       Returns unprocessed information if true.
         """
-        # If the directory cannot be SELECT, return an empty list.
-        if self.server.SELECT(directory)[0] == 'NO':
-            return []
-        info = self._getInfo(directory, part, range, raw)
-        self.server.CLOSE()
-        return info
+        with self._connection(directory) as conn:
+            # If the directory cannot be SELECT, return an empty list.
+            if conn is None:
+                return []
+            return self._getInfo(conn, part, range, raw)
 
-    def _getInfo(self, directory, part='UID', range='1:*', raw=False):
+    def _getInfo(self, conn, part='UID', range='1:*', raw=False):
         """ Get information of a list of emails from a seleted mailbox.
 
         Args:
-            directory: The mailbox where the retrieving email stays.
-            part:      The part of the email to be retrieve.
-            range:     The range of email list in the mailbox.
-            raw:       Returns unprocessed information if true.
+            conn:  The connection with the mailbox selected.
+            part:  The part of the email to be retrieve.
+            range: The range of email list in the mailbox.
+            raw:   Returns unprocessed information if true.
+        """
+        lines = conn.FETCH(range, part)[2]
+        return self._parseInfo(lines, raw)
+
+    def _parseInfo(self, lines, raw=False):
+        """ Parse the untagged FETCH responses into email information.
+
+        Args:
+            lines: The untagged responses of a FETCH command.
+            raw:   Returns unprocessed information if true.
         """
-        lines = self.server.FETCH(range, part)[2]
         if raw: return lines
         result = []
         for line in lines:
@@ -78,6 +356,920 @@ class IMAPClient(object):
                 result.append({data[0]:data[1]})
         return result
 
+    def getRecords(self, directory, items='(UID FLAGS RFC822.SIZE)', range='1:*'):
+        """ Get the data items of a list of emails as EmailRecords.
+
+        Any combination of data items can be fetched in one command.
+
+        Args:
+            directory: The mailbox where the retrieving email stays.
+            items:     The data items to be retrieve.
+            range:     The range of email list in the mailbox.
+        """
+        return list(self.iterRecords(directory, items, range))
+
+    def iterRecords(self, directory, items='(UID FLAGS RFC822.SIZE)', range='1:*', batch_size=BATCH_SIZE):
+        """ Iterate over the data items of a list of emails as EmailRecords.
+
+        It streams the emails as iterEmails() does.
+
+        Args:
+            directory:  The mailbox where the retrieving email stays.
+            items:      The data items to be retrieve.
+            range:      The range of email list in the mailbox.
+            batch_size: The maximum number of emails fetched by one command.
+        """
+        return self._iter(directory, items, range, batch_size, parseFetch)
+
+    def iterEmails(self, directory, part='UID', range='1:*', batch_size=BATCH_SIZE, raw=False):
+        """ Iterate over the information of a list of emails.
+
+        Unlike getEmails(), each email is yielded as soon as it is read, and
+        the range is split into FETCH commands of at most batch_size emails.
+        The next command is sent ahead while the current one is read, so the
+        memory used does not grow with the size of the mailbox.
+
+        Args:
+            directory:  The mailbox where the retrieving email stays.
+            part:       The part of the email to be retrieve.
+            range:      The range of email list in the mailbox.
+            batch_size: The maximum number of emails fetched by one command.
+            raw:        Yields unprocessed information if true.
+        """
+        return self._iter(directory, part, range, batch_size,
+                          lambda line: self._parseInfo([line], raw)[0])
+
+    def _iter(self, directory, part, range, batch_size, parse):
+        """ Iterate over the parsed FETCH responses of a list of emails.
+
+        If the connection is lost, the emails not yielded yet are fetched on
+        a new connection. The emails yielded are told by the UID of the last
+        one, so the parsed responses must be EmailRecords with their UID, and
+        the UIDVALIDITY must not change. [2.3.1.1] Otherwise the range is
+        fetched again only if nothing was yielded.
+
+        Args:
+            directory:  The mailbox where the retrieving email stays.
+            part:       The part of the email to be retrieve.
+            range:      The range of email list in the mailbox.
+            batch_size: The maximum number of emails fetched by one command.
+            parse:      The function parsing one untagged FETCH response.
+        """
+        batches = None
+        last = None
+        for i in itertools.count():
+            try:
+                with self._connection(directory) as conn:
+                    # If the directory cannot be SELECT, yield nothing.
+                    if conn is None:
+                        return
+                    if batches is None:
+                        uidvalidity = conn.uidvalidity
+                        batches = self._batches(conn, range, batch_size)
+                    elif last is not None:
+                        batches = self._resume(conn, uidvalidity, batches, last, batch_size)
+                    handle = None
+                    for batch in batches + [None]:
+                        ahead = None if batch is None else conn.send('FETCH', batch, part)
+                        if handle is not None:
+                            for info in self._iterInfo(conn, handle, parse):
+                                last = info
+                                yield info
+                            batches = batches[1:]
+                        handle = ahead
+                return
+            except server.AbortError:
+                if i == RECONNECT_TRIES or \
+                   (last is not None and (getattr(last, 'uid', None) is None or uidvalidity is None)):
+                    raise
+
+    def _resume(self, conn, uidvalidity, batches, last, batch_size):
+        """ Return the message sets of the emails of the batches following the
+        last EmailRecord yielded, on a new connection.
+
+        Emails expunged in between shift the message numbers, so the next email
+        is found by its UID. The message sets may then end with a few emails
+        more than the batches, but never skip one.
+
+        Raise:
+            server.AbortError: If the UIDVALIDITY changed, so UIDs tell nothing
+                               about the emails yielded.
+        """
+        if conn.uidvalidity != uidvalidity:
+            raise server.AbortError('UIDVALIDITY of ' + conn.mailbox + ' changed, cannot resume')
+        query = Query().uid('%d:%d' % (last.uid + 1, MAX_UID))
+        first = self._esearch(conn, query, ('MIN',), uid=False).get('MIN')
+        if first is None or not batches:
+            return []
+        rest = UIDSet.parse(','.join(batches)) - UIDSet.parse('1:%d' % last.seq)
+        return _splitRange(str(rest.shift(first - last.seq - 1)), None, batch_size)
+
+    def _batches(self, conn, range, batch_size):
+        """ Split the range into message sets of at most batch_size emails.
+        """
+        if '*' in range:
+            return _splitRange(range, self._count(conn), batch_size)
+        return _splitRange(range, None, batch_size)
+
+    def getHeaders(self, directory, range='1:*'):
+        """ Get the headers, flags and sizes of a list of emails.
+
+        Args:
+            directory: The mailbox where the retrieving email stays.
+            range:     The range of email list in the mailbox.
+
+        Returns:
+            A list of EmailRecords, with the header in section BODY[HEADER].
+        """
+        return list(self.iterHeaders(directory, range))
+
+    def iterHeaders(self, directory, range='1:*', batch_size=BATCH_SIZE):
+        """ Iterate over the headers, flags and sizes of a list of emails.
+
+        With a cache, only the flags are fetched for the cached emails, and
+        the headers are fetched for the others only.
+
+        Args:
+            directory:  The mailbox where the retrieving email stays.
+            range:      The range of email list in the mailbox.
+            batch_size: The maximum number of emails fetched by one command.
+        """
+        if self.cache is None:
+            return self.iterRecords(directory, HEADER_ITEMS, range, batch_size)
+        return self._iterCached(directory, range, batch_size)
+
+    def _iterCached(self, directory, range, batch_size):
+        """ Iterate over the headers, flags and sizes of a list of emails
+        through the cache.
+        """
+        with self._connection(directory) as conn:
+            if conn is None:
+                return
+            uidvalidity = conn.uidvalidity
+            if uidvalidity is not None:
+                self.cache.invalidate(self.account, directory, uidvalidity)
+            for batch in self._batches(conn, range, batch_size):
+                if uidvalidity is None:
+                    # UIDs cannot be trusted across sessions. [2.3.1.1]
+                    handle = conn.send('FETCH', batch, HEADER_ITEMS)
+                    for record in self._iterInfo(conn, handle, parseFetch):
+                        yield record
+                    continue
+                handle = conn.send('FETCH', batch, '(UID FLAGS)')
+                records = list(self._iterInfo(conn, handle, parseFetch))
+                cached = self.cache.get(self.account, directory, uidvalidity,
+                                        [record.uid for record in records])
+                missing = [record.uid for record in records if record.uid not in cached]
+                if missing:
+                    handle = conn.send('UID', 'FETCH', seqset.compress(missing), HEADER_ITEMS)
+                    fetched = list(self._iterInfo(conn, handle, parseFetch))
+                    self.cache.put(self.account, directory, uidvalidity, fetched)
+                    cached.update((record.uid, record) for record in fetched)
+                self.cache.updateFlags(self.account, directory, uidvalidity,
+                                       dict((record.uid, record.flags) for record in records))
+                for record in records:
+                    # The email may be expunged in between.
+                    if record.uid in cached:
+                        full = cached[record.uid]
+                        full.seq = record.seq
+                        full.flags = record.flags
+                        yield full
+
+    def iterPages(self, directory, page_size=PAGE_SIZE, first=1):
+        """ Iterate over the pages of the previews of the emails of a mailbox,
+        newest first.
+
+        Each page is fetched by one FETCH of PREVIEW_ITEMS. The FETCH of the
+        next page is sent before the current page is yielded, so the next page
+        arrives while the current one is shown. The pages are numbered by the
+        number of emails when the iteration starts.
+
+        Args:
+            directory: The mailbox where the emails stay.
+            page_size: The number of emails of a page.
+            first:     The number of the first page, 1 for the newest emails.
+
+        Returns:
+            An iterator of tuples of the page number, the number of pages, the
+            number of emails and the list of EmailRecords of the page, newest
+            first. Nothing is yielded if the directory cannot be selected or
+            the page does not exist.
+        """
+        with self._connection(directory) as conn:
+            if conn is None:
+                return
+            exists = conn.selected.exists
+            pages = (exists + page_size - 1) // page_size
+            def fetch(page):
+                last = exists - (page - 1) * page_size
+                return conn.send('FETCH', '%d:%d' % (max(last - page_size + 1, 1), last), PREVIEW_ITEMS)
+            ahead = fetch(first) if 0 < first <= pages else None
+            try:
+                for page in range(first, pages + 1):
+                    handle, ahead = ahead, fetch(page + 1) if page < pages else None
+                    records = list(self._iterInfo(conn, handle, parseFetch))
+                    yield page, pages, exists, sorted(records, key=lambda record: -record.seq)
+            finally:
+                # A listing stopped early leaves no response behind.
+                if ahead is not None:
+                    try:
+                        conn.wait(ahead)
+                    except server.AbortError:
+                        pass
+
+    def sync(self, directory, state, items='(UID FLAGS)'):
+        """ Get the changes of a mailbox since its last synchronization.
+
+        Only new emails, flag changes and expunged UIDs are fetched, with
+        CONDSTORE/QRESYNC if the server supports them.
+
+        Args:
+            directory: The mailbox to be synchronized.
+            state:     The SyncState keeping the last synchronization.
+            items:     The data items fetched for new emails.
+
+        Returns:
+            The SyncResult, or None if the mailbox cannot be selected.
+        """
+        # The state is saved only once a synchronization completes, so one
+        # interrupted by a lost connection starts again from it.
+        for i in range(RECONNECT_TRIES + 1):
+            try:
+                with self._connection() as conn:
+                    # QRESYNC is enabled before a mailbox is selected, and
+                    # UNSELECT leaves one without expunging. [3.2.3, RFC 7162]
+                    if conn.state == 'SELECTED' and 'QRESYNC' not in conn.enabled and conn.capable('QRESYNC'):
+                        if conn.capable('UNSELECT'):
+                            conn.UNSELECT()
+                        else:
+                            conn.CLOSE()
+                    return Synchronizer(conn, self.account, state).sync(directory, items)
+            except server.AbortError:
+                if i == RECONNECT_TRIES:
+                    raise
+
+    def watch(self, directory, callback, duration=None):
+        """ Deliver the changes of a mailbox as the server reports them.
+
+        IDLE is used if the server supports it, and issued again before the
+        server times it out. Otherwise NOOP is sent, less often while nothing
+        changes.
+
+        Args:
+            directory: The mailbox to be watched.
+            callback:  A function called as callback(type, num, record) for
+                       each EXISTS, RECENT, EXPUNGE and FETCH response, where
+                       record is the EmailRecord of FETCH, None otherwise.
+                       Watching stops if it returns False.
+            duration:  The seconds to watch, or None to watch until stopped.
+
+        Returns:
+            False if the directory cannot be SELECT, True otherwise.
+        """
+        deadline = None if duration is None else time.time() + duration
+        with self._connection(directory) as conn:
+            if conn is None:
+                return False
+            if conn.capable('IDLE') and self._idle(conn, callback, deadline):
+                return True
+            delay = POLL_MIN
+            while deadline is None or time.time() < deadline:
+                changed, stop = self._notify(callback, conn.NOOP()[2])
+                if stop:
+                    break
+                # Back off while nothing changes.
+                delay = POLL_MIN if changed else min(delay * 2, POLL_MAX)
+                if deadline is not None:
+                    delay = max(min(delay, deadline - time.time()), 0)
+                time.sleep(delay)
+        return True
+
+    def _idle(self, conn, callback, deadline):
+        """ Watch a selected mailbox with IDLE.
+
+        Returns:
+            False if the server rejects IDLE, True once watching stops.
+        """
+        while 1:
+            idle = conn.IDLE()
+            while idle.continuation is None and not idle.done():
+                conn.poll()
+            if idle.done():
+                return False
+            renew = time.time() + IDLE_TIMEOUT
+            stop = False
+            while not stop:
+                end = renew if deadline is None else min(renew, deadline)
+                if time.time() >= end:
+                    break
+                conn.poll(end - time.time())
+                lines, idle.untagged = idle.untagged, []
+                stop = self._notify(callback, lines)[1]
+            conn.DONE(idle)
+            stop = self._notify(callback, idle.untagged)[1] or stop
+            if stop or (deadline is not None and time.time() >= deadline):
+                return True
+
+    def _notify(self, callback, lines):
+        """ Call the watch callback with the mailbox changes in the untagged
+        responses.
+
+        Returns:
+            A tuple of two booleans: whether there are changes, and whether the
+            callback asks to stop.
+        """
+        changed = False
+        for line in lines:
+            words = line.split(' ', 2)
+            if words[1:2] == ['FETCH']:
+                record = parseFetch(line)
+            elif words[1:2] in (['EXISTS'], ['RECENT'], ['EXPUNGE']):
+                record = None
+            else:
+                continue
+            changed = True
+            if callback(words[1], int(words[0]), record) is False:
+                return changed, True
+        return changed, False
+
+    def _iterInfo(self, conn, handle, parse):
+        """ Iterate over the parsed responses of a FETCH command as they are
+        received.
+
+        Args:
+            conn:   The connection the command was sent through.
+            handle: The FETCH Command.
+            parse:  The function parsing one untagged FETCH response.
+        """
+        while 1:
+            lines, handle.untagged = handle.untagged, []
+            for line in lines:
+                # Skip other untagged responses, such as EXISTS.
+                if line.split(' ', 2)[1:2] == ['FETCH']:
+                    yield parse(line)
+            if handle.done():
+                break
+            conn.poll()
+        handle.result()
+
+    def _count(self, conn):
+        """ Return the number of emails in the selected mailbox.
+        """
+        # The last EXISTS response tells the number. [7.3.1]
+        return conn.selected.exists
+
+    def getEmailsFrom(self, directories, part='UID', range='1:*', raw=False):
+        """ Get information of a list of emails from several mailboxes.
+
+        All the commands are pipelined, so walking many mailboxes costs about
+        one round-trip instead of three per mailbox.
+
+        Args:
+            directories: The mailboxes where the retrieving emails stay.
+            part:        The part of the email to be retrieve.
+            range:       The range of email list in the mailbox.
+            raw:         Returns unprocessed information if true.
+
+        Returns:
+            A dictionary maps each mailbox to its list of email information.
+        """
+        fetches = []
+        with self._connection() as conn:
+            for directory in directories:
+                select = conn.send('SELECT', directory)
+                fetch = conn.send('FETCH', range, part)
+                conn.send('CLOSE')
+                fetches.append((directory, select, fetch))
+            conn.wait()
+        result = {}
+        for directory, select, fetch in fetches:
+            # If the directory cannot be SELECT, the following FETCH fails.
+            if select.type != 'OK':
+                result[directory] = []
+            else:
+                result[directory] = self._parseInfo(fetch.result()[2], raw)
+        return result
+
+    def export(self, mailboxes, dest, format='maildir', workers=MAX_CONNECTIONS, batch_size=EXPORT_BATCH):
+        """ Export mailboxes into a directory, as Maildirs or mbox files.
+
+        The mailboxes are shared by a bounded number of workers, each with its
+        own connection. Emails are fetched by large UID batches and streamed
+        to disk as they are received. Each mailbox keeps a checkpoint of the
+        last exported UID, so an interrupted export resumes.
+
+        Args:
+            mailboxes:  The list of mailboxes to be exported.
+            dest:       The destination directory.
+            format:     'maildir' or 'mbox'.
+            workers:    The maximum number of connections used at once.
+            batch_size: The maximum number of emails fetched by one command.
+
+        Returns:
+            A dictionary maps each mailbox to the number of emails exported,
+            None if it cannot be selected.
+        """
+        client = self
+        if self.pool is None:
+            # The connection of this client serves one thread only.
+            client = IMAPClient(self.host, self.username, self.password,
+                                pool=ConnectionPool(self.engine, workers))
+        queue = Queue.Queue()
+        for mailbox in mailboxes:
+            queue.put(mailbox)
+        # The local directories follow the hierarchy delimiters of the listed
+        # mailboxes.
+        folders = self.getFolders()
+        result = {}
+        errors = []
+        def run():
+            while not errors:
+                try:
+                    mailbox = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                # A mailbox whose connection is lost is exported again from its
+                # checkpoint.
+                for i in range(RECONNECT_TRIES + 1):
+                    try:
+                        result[mailbox] = client._export(mailbox, dest, format, batch_size, folders)
+                        break
+                    except server.AbortError, e:
+                        if i == RECONNECT_TRIES:
+                            errors.append(e)
+                    except Exception, e:
+                        errors.append(e)
+                        break
+        threads = [threading.Thread(target=run) for i in range(min(workers, len(mailboxes)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if client is not self:
+            client.pool.close()
+        if errors:
+            raise errors[0]
+        return result
+
+    def _export(self, mailbox, dest, format, batch_size, folders):
+        """ Export one mailbox, resuming from its checkpoint.
+
+        Args:
+            folders: The root Folder of the mailbox tree, giving the
+                     hierarchy delimiter of the mailbox.
+
+        Returns:
+            The number of emails exported, None if the mailbox cannot be
+            selected.
+        """
+        name = tokenize(mailbox)[0] if mailbox.startswith('"') else mailbox
+        folder = folders.names.get(name)
+        output = open_export(dest, name, format, folder.delimiter if folder is not None else None)
+        try:
+            with self._connection(mailbox) as conn:
+                if conn is None:
+                    return None
+                last = output.start(conn.uidvalidity or 0)
+                try:
+                    lines = conn.send('UID', 'FETCH', '%d:*' % (last + 1), '(UID)').result()[2]
+                except server.InvalidCommandError:
+                    # Some servers reject n:* in an empty mailbox.
+                    lines = []
+                # n:* always includes the last email, even below n. [6.4.8]
+                uids = sorted(uid for uid in (parseFetch(line).uid for line in lines
+                                              if line.split(' ', 2)[1:2] == ['FETCH']) if uid > last)
+                handle = None
+                for i in range(0, len(uids) + batch_size, batch_size):
+                    # Keep the next batch in flight while writing this one.
+                    ahead = None
+                    if i < len(uids):
+                        ahead = conn.send('UID', 'FETCH', seqset.compress(uids[i:i + batch_size]),
+                                          EXPORT_ITEMS, sink=output.sink)
+                    if handle is not None:
+                        for record in self._iterInfo(conn, handle, parseFetch):
+                            output.done(record)
+                        output.commit(uids[min(i, len(uids)) - 1])
+                    handle = ahead
+            return len(uids)
+        finally:
+            output.close()
+
+    def append(self, directory, messages, batch_size=APPEND_BATCH):
+        """ Append emails to a mailbox.
+
+        The APPEND commands are pipelined. With LITERAL+, emails are streamed
+        without waiting for continuation requests, and with MULTIAPPEND, up
+        to batch_size emails are appended by one command. File objects are
+        closed once sent.
+
+        Args:
+            directory:  The mailbox where the emails are appended.
+            messages:   An iterable of tuples of flags, date and data, see
+                        server.appendParams.
+            batch_size: The maximum number of emails appended by one command.
+
+        Returns:
+            The number of emails appended.
+        """
+        count = 0
+        with self._connection() as conn:
+            # Capabilities decide how the literals are sent.
+            if not conn.capable('MULTIAPPEND'):
+                batch_size = 1
+            handles = []
+            batch = []
+            for message in itertools.chain(messages, [None]):
+                if message is not None:
+                    batch.append(message)
+                    if len(batch) < batch_size:
+                        continue
+                if batch:
+                    handles.append((conn.send('APPEND', *server.appendParams(directory, batch)), len(batch)))
+                    for flags, date, data in batch:
+                        if hasattr(data, 'close'):
+                            data.close()
+                    batch = []
+                # Read the completions, so they never fill the socket.
+                while handles and (message is None or len(handles) > APPEND_WINDOW):
+                    handle, size = handles.pop(0)
+                    if handle.result()[0] == 'OK':
+                        count += size
+        return count
+
+    def restore(self, path, directory, batch_size=APPEND_BATCH):
+        """ Append the emails of a Maildir to a mailbox, with their flags.
+
+        The mailbox is created if it does not exist.
+
+        Args:
+            path:       The Maildir, such as one written by export.
+            directory:  The mailbox where the emails are appended.
+            batch_size: The maximum number of emails appended by one command.
+
+        Returns:
+            The number of emails appended.
+        """
+        self.makeMailBox(directory)
+        return self.append(directory, readMaildir(path), batch_size)
+
+    def store(self, directory, uids, flags, mode='+'):
+        """ Add, remove or replace the flags of emails. [6.4.6]
+
+        The UIDs are sent as the fewest sequence sets fitting in command
+        lines, and the UID STORE commands are pipelined. With .SILENT, the
+        server does not send the new flags back.
+
+        Args:
+            directory: The mailbox where the emails stay.
+            uids:      A UIDSet, a sequence set or an iterable of UIDs.
+            flags:     The list of flags, such as ['\\Seen'].
+            mode:      '+' adds the flags, '-' removes them and '' replaces
+                       the flags by them.
+
+        Returns:
+            The number of UIDs in the commands completed by OK.
+        """
+        with self._connection(directory) as conn:
+            if conn is None:
+                return 0
+            parts = self._uidPipeline(conn, 'STORE', _uidSet(uids).split(SEQUENCE_MAX),
+                                      mode + 'FLAGS.SILENT', '(' + ' '.join(flags) + ')')
+        return sum(len(part) for part in parts)
+
+    def move(self, directory, uids, dest):
+        """ Move emails to another mailbox.
+
+        With MOVE, each chunk of UIDs is moved by one UID MOVE. [RFC 6851]
+        Otherwise the emails are copied, and only the chunks copied are
+        marked \\Deleted and expunged, see delete().
+
+        Args:
+            directory: The mailbox where the emails stay.
+            uids:      A UIDSet, a sequence set or an iterable of UIDs.
+            dest:      The mailbox where the emails are moved.
+
+        Returns:
+            The number of UIDs in the chunks moved.
+        """
+        # The status of the folders is changed.
+        self.folders = None
+        with self._connection(directory) as conn:
+            if conn is None:
+                return 0
+            parts = _uidSet(uids).split(SEQUENCE_MAX)
+            if conn.capable('MOVE'):
+                parts = self._uidPipeline(conn, 'MOVE', parts, dest)
+            else:
+                parts = self._expunge(conn, self._uidPipeline(conn, 'COPY', parts, dest))
+        return sum(len(part) for part in parts)
+
+    def delete(self, directory, uids):
+        """ Delete emails, by marking them \\Deleted and expunging them.
+
+        With UIDPLUS, UID EXPUNGE removes only the given emails. Otherwise
+        EXPUNGE also removes the other emails already marked \\Deleted.
+        [RFC 4315]
+
+        Args:
+            directory: The mailbox where the emails stay.
+            uids:      A UIDSet, a sequence set or an iterable of UIDs.
+
+        Returns:
+            The number of UIDs in the chunks deleted.
+        """
+        self.folders = None
+        with self._connection(directory) as conn:
+            if conn is None:
+                return 0
+            parts = self._expunge(conn, _uidSet(uids).split(SEQUENCE_MAX))
+        return sum(len(part) for part in parts)
+
+    def _expunge(self, conn, parts):
+        """ Mark the chunks of UIDs \\Deleted and expunge them. Return the
+        chunks expunged.
+        """
+        parts = self._uidPipeline(conn, 'STORE', parts, '+FLAGS.SILENT', '(\\Deleted)')
+        if conn.capable('UIDPLUS'):
+            return self._uidPipeline(conn, 'EXPUNGE', parts)
+        if parts and conn.EXPUNGE()[0] != 'OK':
+            return []
+        return parts
+
+    def _uidPipeline(self, conn, command, parts, *params):
+        """ Send a UID command for each chunk of UIDs, pipelined, and return
+        the chunks whose commands completed by OK.
+
+        At most UID_WINDOW commands are in flight, so the responses, such as
+        the EXPUNGE of each moved email, never fill the socket while sending.
+        """
+        done = []
+        handles = []
+        for part in parts + [None]:
+            if part is not None:
+                handles.append((part, conn.send('UID', command, str(part), *params)))
+            while handles and (part is None or len(handles) > UID_WINDOW):
+                sent, handle = handles.pop(0)
+                if handle.result()[0] == 'OK':
+                    done.append(sent)
+        return done
+
+    def getUIDs(self, directory, messages):
+        """ Return the UIDs of the emails with the given message numbers.
+
+        The UIDs seen since the mailbox was selected are known, so they cost
+        no round-trip. Otherwise one FETCH asks for them.
+
+        Args:
+            directory: The mailbox where the emails stay.
+            messages:  The message numbers, as a sequence set such as '1:3,7'.
+
+        Returns:
+            The UIDSet of the emails, empty if the directory cannot be
+            selected.
+        """
+        with self._connection(directory) as conn:
+            if conn is None or conn.selected.exists == 0:
+                return UIDSet()
+            state = conn.selected
+            nums = UIDSet.parse(messages, state.exists) & UIDSet.parse('1:%d' % state.exists)
+            uids = [state.uidOf(num) for num in nums]
+            if None not in uids:
+                return UIDSet(uids)
+            lines = conn.FETCH(str(nums), '(UID)')[2]
+        return UIDSet(record.uid for record in (parseFetch(line) for line in lines)
+                      if record is not None and record.uid is not None)
+
+    def search(self, directory, query=None, uid=True):
+        """ Return the emails matching the query.
+
+        Args:
+            directory: The mailbox to be searched.
+            query:     The search Query, None for all emails.
+            uid:       Returns UIDs if true, otherwise message numbers.
+
+        Returns:
+            The UIDSet of the matching emails.
+        """
+        return self.esearch(directory, query, ('ALL',), uid).get('ALL', UIDSet())
+
+    def esearch(self, directory, query=None, returns=('MIN', 'MAX', 'COUNT', 'ALL'), uid=True):
+        """ Search emails and return only the asked results.
+
+        With ESEARCH, the server computes the results, so a huge result comes
+        back as a short sequence set, and COUNT alone costs a few bytes.
+        Otherwise the results are computed from SEARCH. [RFC 4731]
+
+        Args:
+            directory: The mailbox to be searched.
+            query:     The search Query, None for all emails.
+            returns:   The results among MIN, MAX, COUNT and ALL.
+            uid:       Returns UIDs if true, otherwise message numbers.
+
+        Returns:
+            A dictionary maps MIN, MAX and COUNT to numbers and ALL to a
+            UIDSet. MIN and MAX are absent if no email matches. It is empty if
+            the directory cannot be selected.
+        """
+        with self._connection(directory) as conn:
+            if conn is None:
+                return {}
+            return self._esearch(conn, query, returns, uid)
+
+    def _esearch(self, conn, query=None, returns=('ALL',), uid=True):
+        """ Search emails in the selected mailbox, see esearch().
+        """
+        query = query or Query()
+        params = query.params()
+        if query.charset:
+            params = ['CHARSET', query.charset] + params
+        if conn.capable('ESEARCH'):
+            untagged = self._uidCommand(conn, uid, 'SEARCH', 'RETURN', '(' + ' '.join(returns) + ')', *params)
+            result = parseESearch(untagged)
+            # COUNT is left out if nothing matches. [3.1, RFC 4731]
+            if 'COUNT' in returns:
+                result.setdefault('COUNT', 0)
+            if 'ALL' in returns:
+                result.setdefault('ALL', UIDSet())
+            return result
+        numbers = parseSearch(self._uidCommand(conn, uid, 'SEARCH', *params))
+        result = {'COUNT': len(numbers), 'ALL': numbers}
+        if numbers:
+            result['MIN'] = numbers.min()
+            result['MAX'] = numbers.max()
+        return dict((name, value) for name, value in result.items() if name in returns)
+
+    def count(self, directory, query=None):
+        """ Return the number of emails in a mailbox, or of those matching the
+        query.
+
+        Without a query, the number is known if the mailbox is selected.
+        Otherwise STATUS gives it at once, without selecting the mailbox.
+        [6.3.10]
+
+        Args:
+            directory: The mailbox to be counted.
+            query:     The search Query, None for all emails.
+        """
+        if query is not None:
+            return self.esearch(directory, query, ('COUNT',)).get('COUNT', 0)
+        with self._connection(prefer=directory) as conn:
+            # The state of the selected mailbox tells the number at once.
+            if conn.mailbox == directory and conn.selected is not None:
+                return conn.selected.exists
+            type, data, untagged = conn.STATUS(directory, '(MESSAGES)')
+        if type != 'OK':
+            return 0
+        for info in untagged:
+            tokens = tokenize(info)
+            if tokens[:1] == ['STATUS'] and isinstance(tokens[-1], list):
+                items = tokens[-1]
+                for i in range(0, len(items) - 1, 2):
+                    if items[i].upper() == 'MESSAGES':
+                        return int(items[i + 1])
+        return 0
+
+    def grep(self, directory, text):
+        """ Return the UIDs of the emails containing the text.
+
+        With an index, the indexed emails are searched locally, and the
+        server only searches the emails not indexed yet.
+
+        Args:
+            directory: The mailbox to be searched.
+            text:      The text searched in headers and bodies.
+
+        Returns:
+            The UIDSet of the matching emails.
+        """
+        with self._connection(directory) as conn:
+            if conn is None:
+                return UIDSet()
+            if self.index is None or conn.uidvalidity is None:
+                return self._esearch(conn, Query().text(text))['ALL']
+            self.index.invalidate(self.account, directory, conn.uidvalidity)
+            uids = self._esearch(conn)['ALL']
+            found = self.index.search(self.account, directory, conn.uidvalidity, text) & uids
+            missing = uids - self.index.covered(self.account, directory, conn.uidvalidity)
+            # The UIDs are split as by store(), so the command lines stay
+            # short however sparse the index is.
+            parts = missing.split(SEQUENCE_MAX)
+            if len(parts) > GREP_SEARCHES:
+                return self._esearch(conn, Query().text(text))['ALL']
+            for part in parts:
+                found = found | self._esearch(conn, Query().uid(part).text(text))['ALL']
+        return found
+
+    def indexEmails(self, directory, range='1:*', batch_size=BATCH_SIZE):
+        """ Add the emails not indexed yet to the index.
+
+        The emails are streamed and indexed in the background while the next
+        batch is fetched. Only the first INDEX_TEXT_SIZE bytes of each body
+        are fetched.
+
+        Args:
+            directory:  The mailbox where the emails stay.
+            range:      The range of email list in the mailbox.
+            batch_size: The maximum number of emails fetched by one command.
+
+        Returns:
+            The number of emails indexed.
+        """
+        count = 0
+        with self._connection(directory) as conn:
+            if conn is None or conn.uidvalidity is None:
+                return 0
+            uidvalidity = conn.uidvalidity
+            self.index.invalidate(self.account, directory, uidvalidity)
+            uids = self._esearch(conn, Query().atoms(range), uid=True)['ALL']
+            missing = list(uids - self.index.covered(self.account, directory, uidvalidity))
+            handle = None
+            for i in xrange(0, len(missing) + batch_size, batch_size):
+                ahead = None
+                if i < len(missing):
+                    ahead = conn.send('UID', 'FETCH', seqset.compress(missing[i:i + batch_size]),
+                                      INDEX_ITEMS)
+                if handle is not None:
+                    for record in self._iterInfo(conn, handle, parseFetch):
+                        self._indexRecord(directory, uidvalidity, record)
+                        count += 1
+                handle = ahead
+        return count
+
+    def _indexRecord(self, directory, uidvalidity, record):
+        """ Queue a fetched email with its header and body to the index.
+        """
+        header = record.section('BODY[HEADER]')
+        body = record.section('BODY[TEXT]<0>')
+        if body is None:
+            body = record.section('BODY[TEXT]')
+        if self.index is not None and record.uid is not None and header is not None and body is not None:
+            self.index.add(self.account, directory, uidvalidity, record.uid, header, body)
+
+    def getRecordsByUID(self, directory, uids, items='(UID FLAGS RFC822.SIZE)'):
+        """ Get the data items of the emails with the given UIDs.
+
+        Args:
+            directory: The mailbox where the retrieving email stays.
+            uids:      A UIDSet or a sequence set of UIDs.
+            items:     The data items to be retrieve.
+
+        Returns:
+            The list of EmailRecords, with their message numbers.
+        """
+        with self._connection(directory) as conn:
+            if conn is None or not str(uids):
+                return []
+            lines = conn.send('UID', 'FETCH', str(uids), items).result()[2]
+        return [parseFetch(line) for line in lines if line.split(' ', 2)[1:2] == ['FETCH']]
+
+    def sort(self, directory, keys, query=None, uid=True):
+        """ Return the emails matching the query, sorted by the server.
+        [RFC 5256]
+
+        Args:
+            directory: The mailbox to be searched.
+            keys:      The sort criteria, such as '(REVERSE DATE)'.
+            query:     The search Query, None for all emails.
+            uid:       Returns UIDs if true, otherwise message numbers.
+
+        Returns:
+            The list of sorted numbers.
+        """
+        query = query or Query()
+        with self._connection(directory) as conn:
+            if conn is None:
+                return []
+            return parseSort(self._uidCommand(conn, uid, 'SORT', keys, query.charset or 'UTF-8',
+                                              *query.params()))
+
+    def thread(self, directory, query=None, algorithm='REFERENCES', uid=True):
+        """ Return the emails matching the query, grouped in threads by the
+        server. [RFC 5256]
+
+        Args:
+            directory: The mailbox to be searched.
+            query:     The search Query, None for all emails.
+            algorithm: The threading algorithm, REFERENCES or ORDEREDSUBJECT.
+            uid:       Returns UIDs if true, otherwise message numbers.
+
+        Returns:
+            The list of threads, see search.parseThread.
+        """
+        query = query or Query()
+        with self._connection(directory) as conn:
+            if conn is None:
+                return []
+            return parseThread(self._uidCommand(conn, uid, 'THREAD', algorithm, query.charset or 'UTF-8',
+                                                *query.params()))
+
+    def _uidCommand(self, conn, uid, command, *params):
+        """ Send a command, by UID if uid is true, and return its untagged
+        responses.
+        """
+        if uid:
+            return conn.send('UID', command, *params).result()[2]
+        return conn.send(command, *params).result()[2]
+
     def getEmail(self, directory, num):
         """ get a complete readable email from directory.
 
@@ -85,17 +1277,98 @@ class IMAPClient(object):
             directory: The mailbox where the retrieving email stays.
             num:       The email number in the mailbox.
         """
-        if self.server.SELECT(directory)[0] == 'NO':
-            return ""
-        head = self._getInfo(directory, '(RFC822.HEADER.LINES (Subject From To Date))', str(num))
-        text = self._getInfo(directory, 'RFC822.TEXT', str(num))
-        self.server.CLOSE()
-        return head[0], text[0]
+        with self._connection(directory) as conn:
+            if conn is None:
+                return ""
+            # Both parts are fetched by one command.
+            lines = conn.FETCH(str(num), '(BODY[HEADER.FIELDS (SUBJECT FROM TO DATE)] BODY[TEXT])')[2]
+        for line in lines:
+            record = parseFetch(line)
+            if record is not None:
+                head = record.section('BODY[HEADER.FIELDS (SUBJECT FROM TO DATE)]') or ''
+                text = record.section('BODY[TEXT]') or ''
+                return head.rstrip(server.CRLF).replace(server.CRLF, '\n'), text.replace(server.CRLF, '\n')
+        return ""
+
+    def getMessage(self, directory, num):
+        """ get an email whose body parts are downloaded on demand.
+
+        Only the structure and the main header fields are fetched here, so an
+        email with big attachments costs nothing until its parts are read.
+
+        Args:
+            directory: The mailbox where the retrieving email stays.
+            num:       The email number in the mailbox.
+
+        Returns:
+            The LazyEmail, or None if the email does not exist.
+        """
+        with self._connection(directory) as conn:
+            if conn is None:
+                return None
+            # No email is above the number of emails.
+            if str(num).isdigit() and int(num) > conn.selected.exists:
+                return None
+            lines = conn.FETCH(str(num), '(UID BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (SUBJECT FROM TO DATE)])')[2]
+        for line in lines:
+            record = parseFetch(line)
+            if record is not None and 'BODYSTRUCTURE' in record.items:
+                head = record.section('BODY[HEADER.FIELDS (SUBJECT FROM TO DATE)]') or ''
+                return LazyEmail(self, directory, record.uid, head.rstrip(server.CRLF).replace(server.CRLF, '\n'),
+                                 record.items['BODYSTRUCTURE'])
+        return None
+
+    def _iterSection(self, directory, uid, section, size, chunk_size=CHUNK_SIZE):
+        """ Iterate over the content of a body section in partial fetches of
+        at most chunk_size bytes, keeping one fetch in flight ahead. [6.4.5]
+
+        Args:
+            directory:  The mailbox where the email stays.
+            uid:        The UID of the email.
+            section:    The section number, such as '2.1'.
+            size:       The size of the section from BODYSTRUCTURE.
+            chunk_size: The maximum number of bytes fetched by one command.
+        """
+        with self._connection(directory) as conn:
+            if conn is None:
+                return
+            # The size from BODYSTRUCTURE can be inexact, so fetch at least one
+            # chunk and stop at the first short one.
+            offsets = range(0, max(size, 1), chunk_size)
+            handles = [conn.send('UID', 'FETCH', str(uid),
+                                 '(BODY.PEEK[%s]<%d.%d>)' % (section, offsets[0], chunk_size))]
+            for i, offset in enumerate(offsets):
+                if i + 1 < len(offsets):
+                    handles.append(conn.send('UID', 'FETCH', str(uid),
+                                             '(BODY.PEEK[%s]<%d.%d>)' % (section, offsets[i + 1], chunk_size)))
+                chunk = ''
+                for record in self._iterInfo(conn, handles.pop(0), parseFetch):
+                    if record.uid == uid:
+                        chunk = record.section('BODY[%s]<%d>' % (section, offset)) or ''
+                yield chunk
+                if len(chunk) < chunk_size:
+                    break
+            # Collect the fetch sent ahead if the last chunk came short.
+            for handle in handles:
+                conn.wait(handle)
+
+    def noop(self):
+        """ Send NOOP, so the server does not log out an idle connection.
+        [6.1.2] The changes it reports update the state of the selected
+        mailbox.
+        """
+        with self._connection() as conn:
+            conn.NOOP()
 
     def logout(self):
         """ Logout the IMAP4 server.
+
+        With a pool, the idle connections of the account are logged out.
         """
-        self.server.LOGOUT()
+        if self.pool is None:
+            self.server.LOGOUT()
+        else:
+            self.pool.close(self.host, self.username)
 
 if __name__ == '__main__':
     """ The entry for debugging.
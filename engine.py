@@ -0,0 +1,277 @@
+import errno
+import select
+import socket
+import ssl
+import time
+import server
+from collections import deque
+from util import printd
+
+# This module drives many IMAP connections from one thread. Each connection is
+# a non-blocking socket registered to a Loop, which waits on all of them with
+# select() and feeds the received data to the same response framing and
+# command bookkeeping as the blocking IMAPServer. select() limits a loop to
+# FD_SETSIZE (usually 1024) connections.
+
+class Loop(object):
+    """ The event loop multiplexing IMAP connections.
+
+    Arguments:
+        servers: A dictionary maps socket file number to its AsyncIMAPServer.
+    """
+
+    def __init__(self):
+        """ Construct an empty loop.
+        """
+        self.servers = {}
+
+    def add(self, imap_server):
+        """ Register a connection to the loop.
+        """
+        self.servers[imap_server.sock.fileno()] = imap_server
+
+    def remove(self, imap_server):
+        """ Unregister a connection from the loop.
+        """
+        self.servers.pop(imap_server.sock.fileno(), None)
+
+    def run_once(self, timeout=None):
+        """ Wait until some connections are ready and handle them.
+
+        Connections waiting for a response without sending or receiving
+        anything for server.TIMEOUT seconds are closed.
+
+        Args:
+            timeout: The maximum seconds to wait, or None to wait forever.
+        """
+        if not self.servers:
+            return
+        if server.TIMEOUT is not None:
+            timeout = server.TIMEOUT if timeout is None else min(timeout, server.TIMEOUT)
+        readers = self.servers.keys()
+        writers = [fd for fd, s in self.servers.items() if s.writable()]
+        readable, writable, _ = select.select(readers, writers, [], timeout)
+        for fd in writable:
+            if fd in self.servers:
+                self.servers[fd].handle_write()
+        for fd in readable:
+            if fd in self.servers:
+                self.servers[fd].handle_read()
+        if server.TIMEOUT is not None:
+            deadline = time.time() - server.TIMEOUT
+            for s in self.servers.values():
+                if s.active < deadline and s.waiting():
+                    s.handle_close('Connection timed out')
+
+    def run_until(self, handle):
+        """ Run the loop until the given command has completed.
+
+        Args:
+            handle: The Command to wait for.
+        """
+        while not handle.done():
+            self.run_once()
+
+    def run(self):
+        """ Run the loop until no command is pending on any connection.
+        """
+        while any(s.busy() for s in self.servers.values()):
+            self.run_once()
+
+class AsyncIMAPServer(server.IMAPServer):
+    """ The IMAP server driven by an event loop.
+
+    It has the same command methods as IMAPServer, but each of them returns
+    the Command sent instead of its response. Call result() or
+    add_done_callback() on the Command, or run the loop.
+
+    Arguments:
+        loop:      The Loop the connection is registered to.
+        outbuf:    The buffers waiting to be written to the server, in order.
+        handshake: True while the TLS handshake is not finished.
+        active:    The time data was last sent or received.
+    """
+
+    def __init__(self, host, loop):
+        """ Start connecting to the IMAP server.
+
+        The connection is established in the background. Commands sent before
+        are written once the connection is ready.
+
+        Args:
+            host: The address of the IMAP server.
+            loop: The Loop to register the connection to.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock = ssl.wrap_socket(sock, do_handshake_on_connect=False)
+        self.sock.setblocking(0)
+        err = self.sock.connect_ex((host, server.IMAP_SSL_PORT))
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            raise socket.error(err, 'Cannot connect to ' + host)
+        self.loop = loop
+        self.outbuf = deque()
+        self.handshake = True
+        self.want_write = True
+        self.active = time.time()
+        self._setup()
+        loop.add(self)
+
+    def _interact(self, command, *params):
+        """ Send one command without waiting for its response.
+
+        Returns:
+            The Command sent.
+        """
+        return self.send(command, *params)
+
+    def _write(self, msg):
+        """ Queue the given message to be written by the loop.
+        """
+        self.outbuf.append(self._deflate(msg))
+
+    def poll(self, timeout=None):
+        """ Run the loop once, which may dispatch responses of this and other
+        connections.
+
+        Args:
+            timeout: The maximum seconds to wait, or None to wait forever.
+        """
+        self.loop.run_once(timeout)
+
+    def busy(self):
+        """ Return true if the connection has work in progress.
+        """
+        return self.greeting or bool(self.pending) or bool(self.outbuf)
+
+    def waiting(self):
+        """ Return true if the connection waits for a response which is
+        expected in time, so IDLE does not count.
+        """
+        if self.handshake or self.greeting or self.outbuf:
+            return True
+        return any(handle.name != 'IDLE' for handle in self.pending)
+
+    def writable(self):
+        """ Return true if the connection is waiting to write.
+        """
+        if self.handshake:
+            return self.want_write
+        return bool(self.outbuf)
+
+    def handle_write(self):
+        """ Write the queued data, as much as the socket accepts.
+        """
+        if self.handshake:
+            self._do_handshake()
+            return
+        # Small buffers, such as pipelined commands, are joined into one
+        # write.
+        data = self.outbuf[0]
+        if len(data) < server.BUFFER_SIZE and len(self.outbuf) > 1:
+            pieces = []
+            size = 0
+            while self.outbuf and size + len(self.outbuf[0]) <= server.BUFFER_SIZE:
+                piece = self.outbuf.popleft()
+                size += len(piece)
+                pieces.append(piece.tobytes() if isinstance(piece, memoryview) else piece)
+            if pieces:
+                data = ''.join(pieces)
+                self.outbuf.appendleft(data)
+        try:
+            sent = self.sock.send(data)
+        except ssl.SSLWantWriteError:
+            return
+        except (socket.error, ssl.SSLError), e:
+            self.handle_close(str(e))
+            return
+        self.active = time.time()
+        # The rest of a partly written buffer is kept without copy.
+        if sent < len(data):
+            self.outbuf[0] = memoryview(data)[sent:]
+        else:
+            self.outbuf.popleft()
+
+    def handle_read(self):
+        """ Read the available data and dispatch the complete responses.
+        """
+        if self.handshake:
+            self._do_handshake()
+            return
+        while 1:
+            try:
+                size = self.sock.recv_into(self.inbuf)
+            except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                break
+            except (socket.error, ssl.SSLError), e:
+                self.handle_close(str(e))
+                return
+            if not size:
+                self.handle_close('Connection closed by the server')
+                return
+            self.active = time.time()
+            try:
+                self._feed(self.inbuf, size)
+            except server.InvalidCommandError, e:
+                # The greeting or a tagged response is invalid.
+                self.handle_close(str(e))
+                return
+            # Decrypted data may be left in the TLS layer after one read.
+            if not self.sock.pending():
+                break
+
+    def handle_close(self, reason):
+        """ Close the connection and fail all pending commands.
+
+        Args:
+            reason: The reason the connection is closed.
+        """
+        printd('\n[connection closed: ' + reason + ']\n')
+        self.loop.remove(self)
+        self.sock.close()
+        self.greeting = False
+        self.outbuf.clear()
+        self._abort(reason)
+
+    def _do_handshake(self):
+        """ Advance the TLS handshake.
+        """
+        try:
+            self.sock.do_handshake()
+        except ssl.SSLWantReadError:
+            self.want_write = False
+        except ssl.SSLWantWriteError:
+            self.want_write = True
+        except (socket.error, ssl.SSLError), e:
+            # Not connected yet, or the connection failed.
+            if getattr(e, 'errno', None) in (errno.ENOTCONN, errno.EAGAIN):
+                self.want_write = True
+            else:
+                self.handle_close(str(e))
+        else:
+            self.handshake = False
+
+class IMAPServer(AsyncIMAPServer):
+    """ The blocking facade over AsyncIMAPServer.
+
+    It can replace server.IMAPServer: each command method waits for its
+    response. Other connections registered to the same loop keep running
+    while it waits.
+    """
+
+    def __init__(self, host, loop=None):
+        """ Connect to the IMAP server and receive the initial greeting.
+
+        Args:
+            host: The address of the IMAP server.
+            loop: The Loop to register the connection to. A new loop is
+                  created if not given.
+        """
+        AsyncIMAPServer.__init__(self, host, loop or Loop())
+        self.wait()
+        if self.state == 'LOGOUT':
+            raise server.AbortError('Cannot connect to ' + host)
+
+    def _interact(self, command, *params):
+        """ Make one client/server interaction and wait for the response.
+        """
+        return self.send(command, *params).result()
@@ -0,0 +1,302 @@
+import calendar
+import os
+import re
+import socket
+import time
+from collections import deque
+
+# This module writes exported emails to Maildir or mbox, streaming each email
+# literal to disk as it is received, and keeps the checkpoints of exported
+# mailboxes so an interrupted export resumes. It also reads a Maildir back for
+# restoring.
+
+# The number of UIDs fetched by one export command.
+EXPORT_BATCH = 1000
+# The name of the checkpoint file of a mailbox.
+CHECKPOINT = '.imapCMD-export'
+
+# Regular expression to match INTERNALDATE before a literal in a FETCH.
+InternalDate = re.compile(r'INTERNALDATE "(?P<date>[^"]*)"')
+
+# Maildir info letters of system flags, in ASCII order.
+MAILDIR_FLAGS = (('\\Draft', 'D'), ('\\Flagged', 'F'), ('\\Answered', 'R'),
+                 ('\\Seen', 'S'), ('\\Deleted', 'T'))
+
+class Error(Exception): pass
+
+class Checkpoint(object):
+    """ The progress of one exported mailbox.
+
+    The checkpoint is written after each batch, atomically by renaming.
+
+    Arguments:
+        path:        The checkpoint file.
+        uidvalidity: The UIDVALIDITY of the exported emails, None if new.
+        uid:         The last exported UID.
+        offset:      The size of the written output, for mbox.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.uidvalidity = None
+        self.uid = 0
+        self.offset = 0
+        if os.path.isfile(path):
+            with open(path) as f:
+                self.uidvalidity, self.uid, self.offset = [int(word) for word in f.read().split()]
+
+    def save(self, uidvalidity, uid, offset=0):
+        """ Record the progress.
+        """
+        self.uidvalidity, self.uid, self.offset = uidvalidity, uid, offset
+        with open(self.path + '.tmp', 'w') as f:
+            f.write('%d %d %d\n' % (uidvalidity, uid, offset))
+        os.rename(self.path + '.tmp', self.path)
+
+class _MboxWriter(object):
+    """ The writer of one email literal into an mbox file.
+
+    Line endings are converted to LF and lines starting with 'From ' are
+    quoted by '>' as in mboxrd. Incomplete lines are kept until the next
+    chunk, so chunks can split anywhere. Chunks are memoryviews, see
+    ResponseParser.
+    """
+
+    def __init__(self, export):
+        self.f = export.f
+        self.ends = export.ends
+        self.rest = ''
+
+    def write(self, data):
+        lines = (self.rest + data.tobytes()).split('\n')
+        self.rest = lines.pop()
+        self.f.write(''.join(self._quote(line) + '\n' for line in lines))
+
+    def close(self):
+        if self.rest:
+            self.f.write(self._quote(self.rest) + '\n')
+        self.f.write('\n')
+        self.ends.append(self.f.tell())
+
+    def _quote(self, line):
+        if line.endswith('\r'):
+            line = line[:-1]
+        if line.lstrip('>').startswith('From '):
+            line = '>' + line
+        return line
+
+class MboxExport(object):
+    """ The export of one mailbox into an mbox file.
+
+    Arguments:
+        path:       The mbox file.
+        checkpoint: The Checkpoint of the mailbox.
+        f:          The mbox file object.
+        ends:       The offsets where the received emails end, in order.
+        offset:     The offset where the last finished email ends.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.checkpoint = Checkpoint(path + CHECKPOINT)
+        self.f = None
+        self.ends = deque()
+        self.offset = 0
+
+    def start(self, uidvalidity):
+        """ Open the output and return the last exported UID.
+
+        Emails written after the last checkpoint are discarded, and the
+        export starts over if the UIDVALIDITY changed.
+        """
+        if self.checkpoint.uidvalidity != uidvalidity:
+            self.checkpoint.save(uidvalidity, 0, 0)
+        self.f = open(self.path, 'ab')
+        self.f.truncate(self.checkpoint.offset)
+        self.f.seek(self.checkpoint.offset)
+        self.offset = self.checkpoint.offset
+        return self.checkpoint.uid
+
+    def sink(self, prefix, size):
+        """ Return the writer of an email literal, see Command.sink.
+        """
+        if not prefix.endswith('BODY[] {%d}' % size):
+            return None
+        match = InternalDate.search(prefix)
+        try:
+            date = time.strptime(match.group('date')[:20], '%d-%b-%Y %H:%M:%S')
+        except (AttributeError, ValueError):
+            date = time.gmtime()
+        self.f.write('From MAILER-DAEMON ' + time.asctime(date) + '\n')
+        return _MboxWriter(self)
+
+    def done(self, record):
+        """ Finish an email after its FETCH response is received.
+
+        The literals of the next batch can be written before, so the end of
+        each email is kept in order of reception.
+        """
+        if record.section('BODY[]') is not None and self.ends:
+            self.offset = self.ends.popleft()
+
+    def commit(self, uid):
+        """ Flush the output and record the last exported UID.
+        """
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.checkpoint.save(self.checkpoint.uidvalidity, uid, self.offset)
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+
+class MaildirExport(object):
+    """ The export of one mailbox into a Maildir.
+
+    An email is written into tmp, then moved into cur with its flags when its
+    FETCH response is complete. File names are made of UIDVALIDITY and UID,
+    so resuming an export replaces the emails written after the checkpoint.
+
+    Arguments:
+        path:       The Maildir.
+        checkpoint: The Checkpoint of the mailbox.
+        temps:      The tmp files of the received emails, in order.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        for sub in ('cur', 'new', 'tmp'):
+            _makedirs(os.path.join(path, sub))
+        self.checkpoint = Checkpoint(os.path.join(path, CHECKPOINT))
+        self.temps = deque()
+        self.count = 0
+        self.host = socket.gethostname().replace('/', '\\057').replace(':', '\\072')
+
+    def start(self, uidvalidity):
+        """ Prepare the output and return the last exported UID.
+        """
+        if self.checkpoint.uidvalidity != uidvalidity:
+            self.checkpoint.save(uidvalidity, 0)
+        for name in os.listdir(os.path.join(self.path, 'tmp')):
+            os.remove(os.path.join(self.path, 'tmp', name))
+        # Remove the emails written after the checkpoint, and of an old
+        # UIDVALIDITY.
+        for name in os.listdir(os.path.join(self.path, 'cur')):
+            words = name.split('.', 2)
+            if len(words) == 3 and words[0].isdigit() and words[1].isdigit() and \
+               (int(words[0]) != uidvalidity or int(words[1]) > self.checkpoint.uid):
+                os.remove(os.path.join(self.path, 'cur', name))
+        return self.checkpoint.uid
+
+    def sink(self, prefix, size):
+        """ Return the writer of an email literal, see Command.sink.
+        """
+        if not prefix.endswith('BODY[] {%d}' % size):
+            return None
+        self.count += 1
+        temp = os.path.join(self.path, 'tmp', '%d.%d_%d.%s' % (time.time(), os.getpid(),
+                                                              self.count, self.host))
+        self.temps.append(temp)
+        return open(temp, 'wb')
+
+    def done(self, record):
+        """ Move a received email into cur with its flags. Its modification
+        time is set to its INTERNALDATE, which readMaildir restores.
+        """
+        if record.section('BODY[]') is None or not self.temps:
+            return
+        info = ''.join(letter for flag, letter in MAILDIR_FLAGS if flag in (record.flags or []))
+        name = '%d.%d.%s:2,%s' % (self.checkpoint.uidvalidity, record.uid, self.host, info)
+        dest = os.path.join(self.path, 'cur', name)
+        os.rename(self.temps.popleft(), dest)
+        timestamp = parseInternalDate(record.internaldate)
+        if timestamp is not None:
+            os.utime(dest, (timestamp, timestamp))
+
+    def commit(self, uid):
+        """ Record the last exported UID.
+        """
+        self.checkpoint.save(self.checkpoint.uidvalidity, uid)
+
+    def close(self):
+        for temp in self.temps:
+            if os.path.isfile(temp):
+                os.remove(temp)
+
+# The export classes by format.
+FORMATS = {'maildir': MaildirExport, 'mbox': MboxExport}
+
+def open_export(dest, mailbox, format, delimiter='/'):
+    """ Return the export of a mailbox under the destination directory.
+
+    Args:
+        dest:      The destination directory.
+        mailbox:   The mailbox name, not quoted. Its hierarchy becomes
+                   directories.
+        format:    'maildir' or 'mbox'.
+        delimiter: The hierarchy delimiter of the mailbox, as listed, None if
+                   flat. [6.3.8]
+    """
+    if format not in FORMATS:
+        raise Error('unknown export format: ' + format)
+    parts = mailbox.split(delimiter) if delimiter else [mailbox]
+    # A '/' within a part is escaped as in Maildir file names, so it never
+    # makes a directory.
+    path = os.path.join(dest, *[part.replace('/', '\\057') for part in parts if part not in ('', '.', '..')])
+    if format == 'mbox':
+        path += '.mbox'
+        _makedirs(os.path.dirname(path))
+    return FORMATS[format](path)
+
+def parseInternalDate(date):
+    """ Return the seconds since the epoch of an INTERNALDATE string, such
+    as '17-Jul-1996 02:44:25 -0700', None if invalid. [9]
+    """
+    try:
+        moment = calendar.timegm(time.strptime(date[:-6].strip(), '%d-%b-%Y %H:%M:%S'))
+        zone = int(date[-4:-2]) * 3600 + int(date[-2:]) * 60
+    except (TypeError, ValueError):
+        return None
+    return moment - zone if date[-5] == '+' else moment + zone
+
+def _makedirs(path):
+    """ Make a directory and its parents, which other workers may be making.
+    """
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+def _order(directory, name):
+    """ Return the sort key of an email of a Maildir: the UIDVALIDITY and UID
+    of a name written by MaildirExport, otherwise the modification time.
+    """
+    words = name.split('.', 2)
+    if len(words) == 3 and words[0].isdigit() and words[1].isdigit():
+        return (0, int(words[0]), int(words[1]), name)
+    return (1, os.path.getmtime(os.path.join(directory, name)), 0, name)
+
+def readMaildir(path):
+    """ Iterate over the emails of a Maildir, opening one file at a time.
+
+    Args:
+        path: The Maildir.
+
+    Returns:
+        Tuples of flags, INTERNALDATE and the open file, as appended by
+        IMAPServer.APPEND. The date is the modification time of the file.
+        Exported emails come in order of UID, so they are appended in their
+        order, and other emails follow by modification time.
+    """
+    letters = dict((letter, flag) for flag, letter in MAILDIR_FLAGS)
+    for sub in ('cur', 'new'):
+        directory = os.path.join(path, sub)
+        if not os.path.isdir(directory):
+            continue
+        for name in sorted(os.listdir(directory), key=lambda name: _order(directory, name)):
+            filename = os.path.join(directory, name)
+            info = name.split(':2,', 1)[1] if ':2,' in name else ''
+            flags = [letters[letter] for letter in info if letter in letters]
+            date = time.strftime('%d-%b-%Y %H:%M:%S +0000', time.gmtime(os.path.getmtime(filename)))
+            yield flags, date, open(filename, 'rb')
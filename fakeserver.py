@@ -0,0 +1,707 @@
+#!/usr/bin/env python -O
+
+import argparse
+import bisect
+import os
+import re
+import socket
+import ssl
+import threading
+import time
+import zlib
+import Queue
+from response import tokenize
+from util import printd
+
+# This module provides a local IMAP server with synthetic mailboxes, to test and
+# benchmark the client without a real host. It serves the commands the client
+# uses over TLS with a self-signed certificate, and it can delay its responses
+# to simulate the latency of a remote server.
+
+# The self-signed certificate and key of the server.
+CERTFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fakeserver.pem')
+# The capabilities advertised.
+CAPABILITIES = 'IMAP4rev1 LITERAL+ MULTIAPPEND COMPRESS=DEFLATE LIST-EXTENDED LIST-STATUS MOVE UIDPLUS UNSELECT'
+# The UIDVALIDITY of all mailboxes.
+UIDVALIDITY = 1
+# The hierarchy delimiter.
+DELIMITER = '/'
+# The maximum number of bytes read from a socket at once.
+BUFFER_SIZE = 65536
+
+CRLF = '\r\n'
+
+# Regular expression to match a literal at the end of a command line. [4.3]
+LiteralSize = re.compile(r'\{(?P<size>\d+)(?P<plus>\+?)\}$')
+# Regular expression to match the date of APPEND. [9]
+InternalDate = re.compile(r'^[ \d]\d-[A-Za-z]{3}-\d{4} \d\d:\d\d:\d\d [+-]\d{4}$')
+# Regular expression to match a partial body section, such as BODY[TEXT]<0.100>.
+Section = re.compile(r'^BODY(?P<peek>\.PEEK)?\[(?P<section>[^\]]*)\](?:<(?P<start>\d+)(?:\.(?P<length>\d+))?>)?$')
+
+class Error(Exception): pass
+
+class FakeMessage(object):
+    """ An email stored in a FakeMailbox.
+
+    Arguments:
+        uid:   The UID of the email.
+        data:  The whole email, with CRLF line endings.
+        flags: The list of flags.
+        date:  The INTERNALDATE string.
+    """
+
+    def __init__(self, uid, data, flags=None, date=None):
+        self.uid = uid
+        self.data = data
+        self.flags = list(flags or [])
+        self.date = date or time.strftime('%d-%b-%Y %H:%M:%S +0000', time.gmtime())
+
+    def header(self):
+        """ Return the header, with the blank line ending it. [2.6.3, RFC 5322]
+        """
+        end = self.data.find(CRLF + CRLF)
+        return self.data if end < 0 else self.data[:end + 4]
+
+    def text(self):
+        """ Return the body following the header.
+        """
+        return self.data[len(self.header()):]
+
+    def fields(self, names, exclude=False):
+        """ Return the header fields of the given names, or the other ones. [6.4.5]
+        """
+        names = [name.upper() for name in names]
+        lines = []
+        keep = False
+        for line in self.header().split(CRLF)[:-2]:
+            if not line[:1].isspace():
+                keep = (line.split(':', 1)[0].strip().upper() in names) != exclude
+            if keep:
+                lines.append(line + CRLF)
+        return ''.join(lines) + CRLF
+
+class FakeMailbox(object):
+    """ A mailbox of the FakeIMAPServer.
+
+    Arguments:
+        name:     The mailbox name.
+        messages: The list of FakeMessages, in order of sequence numbers.
+        uidnext:  The next UID.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.messages = []
+        self.uidnext = 1
+
+    def add(self, data, flags=None, date=None):
+        """ Add an email with the next UID and return it.
+        """
+        message = FakeMessage(self.uidnext, data, flags, date)
+        self.messages.append(message)
+        self.uidnext += 1
+        return message
+
+def makeMessage(num, size):
+    """ Return a synthetic email of about the given size.
+
+    Args:
+        num:  The number of the email, used in its header.
+        size: The number of bytes of the email.
+    """
+    header = ('From: Sender %d <sender%d@example.com>\r\n'
+              'To: Receiver <receiver@example.com>\r\n'
+              'Subject: Synthetic message number %d\r\n'
+              'Date: Mon, 1 Jan 2024 00:00:00 +0000\r\n'
+              'Message-ID: <%d@example.com>\r\n'
+              'Content-Type: text/plain; charset=us-ascii\r\n\r\n') % (num % 97, num % 97, num, num)
+    line = 'The quick brown fox jumps over the lazy dog %d times.\r\n' % num
+    body = line * max(1, (size - len(header)) // len(line))
+    return header + body
+
+def makeMailboxes(messages=100, size=2048, folders=0):
+    """ Return synthetic mailboxes.
+
+    Args:
+        messages: The number of emails in INBOX.
+        size:     The size of each email in bytes.
+        folders:  The number of empty folders, in a tree of ten folders per
+                  level under Archive.
+
+    Returns:
+        A dictionary maps mailbox names to FakeMailboxes.
+    """
+    mailboxes = {'INBOX': FakeMailbox('INBOX')}
+    for num in range(1, messages + 1):
+        mailboxes['INBOX'].add(makeMessage(num, size), ['\\Seen'] if num % 3 else [])
+    for num in range(folders):
+        parts = ['Archive'] + list(str(num))
+        for i in range(1, len(parts) + 1):
+            name = DELIMITER.join(parts[:i])
+            if name not in mailboxes:
+                mailboxes[name] = FakeMailbox(name)
+    return mailboxes
+
+class _Reader(object):
+    """ The buffered reader of a connection, inflating the data once the
+    connection is compressed.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buf = ''
+        self.inflater = None
+
+    def _fill(self):
+        data = self.sock.recv(BUFFER_SIZE)
+        if not data:
+            return False
+        if self.inflater is not None:
+            data = self.inflater.decompress(data)
+        self.buf += data
+        return True
+
+    def readline(self):
+        """ Return the next line without CRLF, or None at the end.
+        """
+        while CRLF not in self.buf:
+            if not self._fill():
+                return None
+        line, self.buf = self.buf.split(CRLF, 1)
+        return line
+
+    def read(self, size):
+        """ Return the given number of bytes, or None at the end.
+        """
+        while len(self.buf) < size:
+            if not self._fill():
+                return None
+        data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+class _Session(threading.Thread):
+    """ The thread serving one client connection.
+
+    Responses are queued and written by another thread after the latency, so
+    pipelined commands are delayed once, as by a network.
+
+    Arguments:
+        server:   The FakeIMAPServer.
+        sock:     The TLS socket of the connection.
+        reader:   The _Reader of the commands.
+        outbox:   The queue of the responses and the times to write them.
+        deflater: The zlib stream of a compressed connection, or None.
+        mailbox:  The selected FakeMailbox, or None.
+    """
+
+    def __init__(self, server, sock):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.server = server
+        self.sock = sock
+        self.reader = _Reader(sock)
+        self.outbox = Queue.Queue()
+        self.deflater = None
+        self.mailbox = None
+        self.writer = threading.Thread(target=self._write)
+        self.writer.daemon = True
+
+    def run(self):
+        self.writer.start()
+        try:
+            self.send('* OK [CAPABILITY ' + self.server.capabilities + '] Fake IMAP server ready')
+            while 1:
+                command = self._readCommand()
+                if command is None or not self._handle(command):
+                    break
+        except (socket.error, ssl.SSLError), e:
+            printd('\n[fake server connection failed: ' + str(e) + ']\n')
+        finally:
+            self.outbox.put((None, None))
+
+    def send(self, line):
+        """ Queue one line of response.
+        """
+        data = line + CRLF
+        if self.deflater is not None:
+            data = self.deflater.compress(data) + self.deflater.flush(zlib.Z_SYNC_FLUSH)
+        self.outbox.put((time.time() + self.server.latency, data))
+
+    def _write(self):
+        """ Write the queued responses when they are due.
+        """
+        while 1:
+            due, data = self.outbox.get()
+            if data is None:
+                break
+            # Gather what is due at the same time into one write.
+            while not self.outbox.empty():
+                more = self.outbox.get()
+                if more[1] is None:
+                    self.outbox.put(more)
+                    break
+                data += more[1]
+                due = more[0]
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                self.sock.sendall(data)
+            except (socket.error, ssl.SSLError):
+                break
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+    def _readCommand(self):
+        """ Read one command with its literals in place, or None at the end.
+        """
+        line = self.reader.readline()
+        if line is None:
+            return None
+        pieces = []
+        match = LiteralSize.search(line)
+        while match:
+            size = int(match.group('size'))
+            if not match.group('plus'):
+                self.send('+ Ready for literal data')
+            data = self.reader.read(size)
+            rest = self.reader.readline()
+            if data is None or rest is None:
+                return None
+            pieces.append(line[:match.start()] + '{%d}' % size + CRLF + data)
+            line = rest
+            match = LiteralSize.search(line)
+        return ''.join(pieces) + line
+
+    def _handle(self, command):
+        """ Answer one command. Return false if the connection ends.
+
+        A command method returns False to end the connection, or a response
+        code to send with the completion result.
+        """
+        tag, text = (command.split(' ', 1) + [''])[:2]
+        name, args = (text.split(' ', 1) + [''])[:2]
+        name = name.upper()
+        if name == 'UID':
+            name, args = (args.split(' ', 1) + [''])[:2]
+            name = 'UID ' + name.upper()
+        method = getattr(self, 'do_' + name.replace(' ', '_'), None)
+        if method is None:
+            self.send(tag + ' BAD Unknown command')
+            return True
+        try:
+            result = method(args)
+        except Error, e:
+            self.send(tag + ' ' + str(e))
+            return True
+        except (IndexError, ValueError, TypeError), e:
+            self.send(tag + ' BAD Invalid arguments')
+            return True
+        code = result + ' ' if isinstance(result, str) else ''
+        self.send(tag + ' OK ' + code + name + ' completed')
+        if name == 'COMPRESS':
+            self.deflater = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+            self.reader.inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+        return result is not False
+
+    def _select(self):
+        """ Return the selected mailbox.
+
+        Raise:
+            Error: If no mailbox is selected.
+        """
+        if self.mailbox is None:
+            raise Error('BAD No mailbox selected')
+        return self.mailbox
+
+    def _find(self, name):
+        """ Return the mailbox of the given name.
+
+        Raise:
+            Error: If the mailbox does not exist.
+        """
+        if name.upper() == 'INBOX':
+            name = 'INBOX'
+        mailbox = self.server.mailboxes.get(name)
+        if mailbox is None:
+            raise Error('NO Mailbox does not exist')
+        return mailbox
+
+    # Commands without a mailbox.
+    def do_CAPABILITY(self, args):
+        self.send('* CAPABILITY ' + self.server.capabilities)
+
+    def do_NOOP(self, args):
+        pass
+
+    def do_LOGIN(self, args):
+        return '[CAPABILITY ' + self.server.capabilities + ']'
+
+    def do_LOGOUT(self, args):
+        self.send('* BYE Fake IMAP server logging out')
+        return False
+
+    def do_COMPRESS(self, args):
+        if self.deflater is not None:
+            raise Error('NO [COMPRESSIONACTIVE] Already compressed')
+        if args.upper() != 'DEFLATE':
+            raise Error('BAD Unknown mechanism')
+
+    def do_ENABLE(self, args):
+        self.send('* ENABLED')
+
+    # Mailbox commands.
+    def do_LIST(self, args):
+        tokens = tokenize(args)
+        reference, pattern = tokens[0] or '', tokens[1] or ''
+        status = None
+        if len(tokens) > 3 and tokens[2].upper() == 'RETURN' and 'STATUS' in [token.upper() for token in tokens[3] if isinstance(token, str)]:
+            status = tokens[3][tokens[3].index('STATUS') + 1]
+        regex = re.compile('^' + re.escape(reference + pattern).replace('\\*', '.*').replace('\\%', '[^/]*') + '$')
+        for name in sorted(self.server.mailboxes):
+            if not regex.match(name):
+                continue
+            children = any(other.startswith(name + DELIMITER) for other in self.server.mailboxes)
+            self.send('* LIST (%s) "%s" %s' % ('\\HasChildren' if children else '\\HasNoChildren',
+                                               DELIMITER, _quote(name)))
+            if status is not None:
+                self._status(self.server.mailboxes[name], status)
+
+    def do_STATUS(self, args):
+        tokens = tokenize(args)
+        self._status(self._find(tokens[0]), tokens[1])
+
+    def _status(self, mailbox, items):
+        values = {'MESSAGES': len(mailbox.messages), 'UIDNEXT': mailbox.uidnext,
+                  'UIDVALIDITY': UIDVALIDITY, 'RECENT': 0,
+                  'UNSEEN': len([message for message in mailbox.messages if '\\Seen' not in message.flags])}
+        self.send('* STATUS %s (%s)' % (_quote(mailbox.name),
+                  ' '.join('%s %d' % (item.upper(), values[item.upper()]) for item in items)))
+
+    def do_SELECT(self, args):
+        self.mailbox = None
+        mailbox = self._find(tokenize(args)[0])
+        self.send('* %d EXISTS' % len(mailbox.messages))
+        self.send('* 0 RECENT')
+        self.send('* FLAGS (\\Answered \\Flagged \\Deleted \\Seen \\Draft)')
+        self.send('* OK [UIDVALIDITY %d] UIDs valid' % UIDVALIDITY)
+        self.send('* OK [UIDNEXT %d] Predicted next UID' % mailbox.uidnext)
+        self.mailbox = mailbox
+
+    do_EXAMINE = do_SELECT
+
+    def do_CLOSE(self, args):
+        # CLOSE removes the emails marked \Deleted without responses. [6.4.2]
+        mailbox = self._select()
+        self._expunge(mailbox, set(message.uid for message in mailbox.messages if '\\Deleted' in message.flags), True)
+        self.mailbox = None
+
+    def do_UNSELECT(self, args):
+        # UNSELECT leaves the mailbox without expunging. [RFC 3691]
+        self._select()
+        self.mailbox = None
+
+    def do_CREATE(self, args):
+        name = tokenize(args)[0].rstrip(DELIMITER)
+        with self.server.lock:
+            if name in self.server.mailboxes:
+                raise Error('NO Mailbox already exists')
+            self.server.mailboxes[name] = FakeMailbox(name)
+
+    def do_DELETE(self, args):
+        name = self._find(tokenize(args)[0]).name
+        with self.server.lock:
+            del self.server.mailboxes[name]
+
+    def do_APPEND(self, args):
+        tokens = tokenize(args)
+        try:
+            mailbox = self._find(tokens[0])
+        except Error:
+            raise Error('NO [TRYCREATE] Mailbox does not exist')
+        tokens = tokens[1:]
+        # Several emails with MULTIAPPEND. [RFC 3502]
+        with self.server.lock:
+            while tokens:
+                flags = tokens.pop(0) if isinstance(tokens[0], list) else None
+                date = tokens.pop(0) if len(tokens) > 1 and InternalDate.match(tokens[0]) else None
+                mailbox.add(tokens.pop(0), flags, date)
+
+    # Commands of the selected mailbox.
+    def do_FETCH(self, args, uid=False):
+        mailbox = self._select()
+        tokens = tokenize(args)
+        items = tokens[1] if isinstance(tokens[1], list) else tokens[1:]
+        items = [item.upper() for item in items]
+        if 'ALL' in items or 'FAST' in items or 'FULL' in items:
+            items = ['FLAGS', 'INTERNALDATE', 'RFC822.SIZE']
+        if uid and 'UID' not in items:
+            items.insert(0, 'UID')
+        for num, message in self._messages(mailbox, tokens[0], uid):
+            self.send('* %d FETCH (%s)' % (num, ' '.join(self._item(message, item) for item in items)))
+
+    def do_UID_FETCH(self, args):
+        self.do_FETCH(args, True)
+
+    def do_SEARCH(self, args, uid=False):
+        # Only sequence sets, UID, ALL and flag keys are supported. [6.4.4]
+        mailbox = self._select()
+        tokens = args.upper().split(' ')
+        found = set(enumerate(mailbox.messages, 1))
+        while tokens:
+            key = tokens.pop(0)
+            if key == 'ALL':
+                continue
+            if key[:1].isdigit() or key[:1] == '*':
+                found &= set(self._messages(mailbox, key, False))
+            elif key == 'UID':
+                found &= set(self._messages(mailbox, tokens.pop(0), True))
+            elif (key[2:] if key.startswith('UN') else key) in ('ANSWERED', 'DELETED', 'DRAFT', 'FLAGGED', 'SEEN'):
+                flag = '\\' + (key[2:] if key.startswith('UN') else key).capitalize()
+                found = set((num, message) for num, message in found
+                            if (flag in message.flags) != key.startswith('UN'))
+            else:
+                raise Error('BAD Unknown search key ' + key)
+        self.send(' '.join(['* SEARCH'] + [str(message.uid if uid else num) for num, message in sorted(found)]))
+
+    def do_UID_SEARCH(self, args):
+        self.do_SEARCH(args, True)
+
+    def do_STORE(self, args, uid=False):
+        mailbox = self._select()
+        tokens = tokenize(args)
+        item = tokens[1].upper()
+        flags = tokens[2] if isinstance(tokens[2], list) else tokens[2:]
+        if item.split('.')[0] not in ('FLAGS', '+FLAGS', '-FLAGS'):
+            raise Error('BAD Unknown data item ' + item)
+        with self.server.lock:
+            for num, message in self._messages(mailbox, tokens[0], uid):
+                if item[0] == '+':
+                    message.flags += [flag for flag in flags if flag not in message.flags]
+                elif item[0] == '-':
+                    message.flags = [flag for flag in message.flags if flag not in flags]
+                else:
+                    message.flags = list(flags)
+                if not item.endswith('.SILENT'):
+                    self.send('* %d FETCH (%s%s)' % (num, 'UID %d ' % message.uid if uid else '',
+                                                    self._item(message, 'FLAGS')))
+
+    def do_UID_STORE(self, args):
+        self.do_STORE(args, True)
+
+    def do_COPY(self, args, uid=False):
+        mailbox = self._select()
+        tokens = tokenize(args)
+        try:
+            dest = self._find(tokens[1])
+        except Error:
+            raise Error('NO [TRYCREATE] Mailbox does not exist')
+        with self.server.lock:
+            messages = [message for num, message in self._messages(mailbox, tokens[0], uid)]
+            copies = [dest.add(message.data, message.flags, message.date) for message in messages]
+        if not messages:
+            return
+        # The UIDs of the copies. [RFC 4315]
+        return '[COPYUID %d %s %s]' % (UIDVALIDITY, ','.join(str(message.uid) for message in messages),
+                                       ','.join(str(message.uid) for message in copies))
+
+    def do_UID_COPY(self, args):
+        return self.do_COPY(args, True)
+
+    def do_MOVE(self, args, uid=False):
+        mailbox = self._select()
+        uids = set(message.uid for num, message in self._messages(mailbox, tokenize(args)[0], uid))
+        # The COPYUID comes before the EXPUNGE responses. [4.3, RFC 6851]
+        code = self.do_COPY(args, uid)
+        if code is not None:
+            self.send('* OK ' + code)
+        self._expunge(mailbox, uids)
+
+    def do_UID_MOVE(self, args):
+        self.do_MOVE(args, True)
+
+    def do_EXPUNGE(self, args):
+        mailbox = self._select()
+        self._expunge(mailbox, set(message.uid for message in mailbox.messages if '\\Deleted' in message.flags))
+
+    def do_UID_EXPUNGE(self, args):
+        # Only the given emails marked \Deleted are removed. [RFC 4315]
+        mailbox = self._select()
+        self._expunge(mailbox, set(message.uid for num, message in self._messages(mailbox, args, True)
+                                   if '\\Deleted' in message.flags))
+
+    def _expunge(self, mailbox, uids, silent=False):
+        """ Remove the emails of the given UIDs, and send their EXPUNGE
+        responses unless silent. [7.4.1]
+        """
+        kept = []
+        with self.server.lock:
+            for message in mailbox.messages:
+                if message.uid not in uids:
+                    kept.append(message)
+                elif not silent:
+                    self.send('* %d EXPUNGE' % (len(kept) + 1))
+            mailbox.messages = kept
+
+    def _messages(self, mailbox, sequence, uid):
+        """ Return the sequence numbers and emails of a sequence set. [9]
+        """
+        messages = mailbox.messages
+        if not messages:
+            return []
+        last = messages[-1].uid if uid else len(messages)
+        ranges = []
+        for part in sequence.split(','):
+            first, _, end = part.partition(':')
+            first = last if first == '*' else int(first)
+            end = first if not end else (last if end == '*' else int(end))
+            ranges.append((min(first, end), max(first, end)))
+        # The UIDs are ascending, so each range is found by bisection.
+        uids = [message.uid for message in messages] if uid else None
+        indexes = set()
+        for first, end in ranges:
+            if uid:
+                indexes.update(xrange(bisect.bisect_left(uids, first), bisect.bisect_right(uids, end)))
+            else:
+                indexes.update(xrange(max(first, 1) - 1, min(end, len(messages))))
+        return [(i + 1, messages[i]) for i in sorted(indexes)]
+
+    def _item(self, message, item):
+        """ Return one data item of a FETCH response. [7.4.2]
+        """
+        if item == 'UID':
+            return 'UID %d' % message.uid
+        if item == 'FLAGS':
+            return 'FLAGS (%s)' % ' '.join(message.flags)
+        if item == 'INTERNALDATE':
+            return 'INTERNALDATE "%s"' % message.date
+        if item == 'RFC822.SIZE':
+            return 'RFC822.SIZE %d' % len(message.data)
+        if item in ('BODYSTRUCTURE', 'BODY'):
+            text = message.text()
+            return '%s ("TEXT" "PLAIN" ("CHARSET" "us-ascii") NIL NIL "7BIT" %d %d)' % (
+                   item, len(text), text.count(CRLF))
+        if item in ('RFC822', 'RFC822.HEADER', 'RFC822.TEXT'):
+            data = {'RFC822': message.data, 'RFC822.HEADER': message.header(),
+                    'RFC822.TEXT': message.text()}[item]
+            return '%s {%d}%s%s' % (item, len(data), CRLF, data)
+        match = Section.match(item)
+        if match is None:
+            raise Error('BAD Unknown data item ' + item)
+        section = match.group('section')
+        if section == '':
+            data = message.data
+        elif section in ('HEADER', '0'):
+            data = message.header()
+        elif section in ('TEXT', '1'):
+            data = message.text()
+        elif section.startswith('HEADER.FIELDS'):
+            data = message.fields(section.split('(', 1)[1].rstrip(')').split(), section.startswith('HEADER.FIELDS.NOT'))
+        else:
+            data = ''
+        name = 'BODY[%s]' % section
+        if match.group('start') is not None:
+            start = int(match.group('start'))
+            end = start + int(match.group('length')) if match.group('length') else len(data)
+            data = data[start:end]
+            name += '<%d>' % start
+        if not match.group('peek') and '\\Seen' not in message.flags:
+            message.flags.append('\\Seen')
+        return '%s {%d}%s%s' % (name, len(data), CRLF, data)
+
+class FakeIMAPServer(object):
+    """ A local IMAP server over TLS, serving synthetic mailboxes from
+    memory. Any username and password are accepted.
+
+    Arguments:
+        mailboxes:    A dictionary maps mailbox names to FakeMailboxes.
+        latency:      The seconds each response is delayed.
+        capabilities: The capabilities advertised.
+        host:         The address listened on.
+        port:         The port listened on, chosen by the system if 0.
+        certfile:     The certificate and key of the server.
+        lock:         The lock guarding changes of the mailboxes.
+        sock:         The listening socket, None until started.
+        sessions:     The threads serving connections.
+    """
+
+    def __init__(self, mailboxes=None, latency=0, capabilities=CAPABILITIES,
+                 host='127.0.0.1', port=0, certfile=CERTFILE):
+        self.mailboxes = makeMailboxes() if mailboxes is None else mailboxes
+        self.latency = latency
+        self.capabilities = capabilities
+        self.host = host
+        self.port = port
+        self.certfile = certfile
+        self.lock = threading.Lock()
+        self.sock = None
+        self.sessions = []
+
+    def start(self):
+        """ Listen and serve connections in the background. Return the port.
+        """
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.host, self.port))
+        self.sock.listen(64)
+        self.port = self.sock.getsockname()[1]
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+        return self.port
+
+    def _accept(self):
+        """ Accept connections until the server is stopped.
+        """
+        while 1:
+            try:
+                conn = self.sock.accept()[0]
+            except socket.error:
+                break
+            try:
+                conn = ssl.wrap_socket(conn, server_side=True, certfile=self.certfile)
+            except (socket.error, ssl.SSLError), e:
+                printd('\n[fake server handshake failed: ' + str(e) + ']\n')
+                conn.close()
+                continue
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            session = _Session(self, conn)
+            self.sessions.append(session)
+            session.start()
+
+    def stop(self, timeout=1):
+        """ Stop accepting connections, and wait for the connections to be
+        logged out.
+
+        Args:
+            timeout: The maximum seconds to wait for each connection.
+        """
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        for session in self.sessions:
+            session.join(timeout)
+            session.writer.join(timeout)
+
+def _quote(name):
+    """ Return a mailbox name as a quoted string. [4.3]
+    """
+    return '"' + name.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local IMAP server with synthetic mailboxes.')
+    parser.add_argument('-p', '--port', type=int, default=1993, help='port (default: 1993)')
+    parser.add_argument('-n', '--messages', type=int, default=1000, help='emails in INBOX (default: 1000)')
+    parser.add_argument('-s', '--size', type=int, default=2048, help='bytes per email (default: 2048)')
+    parser.add_argument('-f', '--folders', type=int, default=100, help='folders in the tree (default: 100)')
+    parser.add_argument('-l', '--latency', type=float, default=0, help='seconds of latency (default: 0)')
+    args = parser.parse_args()
+    fake = FakeIMAPServer(makeMailboxes(args.messages, args.size, args.folders), args.latency, port=args.port)
+    print('Listening on port %d.' % fake.start())
+    try:
+        while 1:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.stop()
@@ -0,0 +1,131 @@
+import re
+from response import tokenize
+
+# This module builds the tree of mailboxes from LIST responses, with their
+# status from LIST-STATUS or STATUS. [6.3.8, RFC 5819]
+
+# The seconds a folder tree is used before it is listed again.
+FOLDER_TTL = 60
+# The status items of each folder.
+STATUS_ITEMS = '(MESSAGES UNSEEN UIDNEXT)'
+
+# Regular expression to match a mailbox name sent as an atom. [9]
+AtomName = re.compile(r'^[^\s(){%*"\\\]\x00-\x1f\x7f]+$')
+
+class Folder(object):
+    """ A mailbox in the tree of mailboxes.
+
+    The root folder has no name and holds the top level mailboxes. A folder
+    not listed but with listed sub-folders is added as \\Noselect.
+
+    Arguments:
+        name:      The full mailbox name, None for the root.
+        delimiter: The hierarchy delimiter, None if flat.
+        flags:     The list of mailbox flags, such as '\\HasChildren'.
+        status:    A dictionary maps status items, such as 'MESSAGES', to
+                   numbers, None if not asked.
+        parent:    The parent Folder, None for the root.
+        children:  A dictionary maps the last part of the names of the
+                   sub-folders to them.
+        names:     In the root, a dictionary maps every mailbox name to its
+                   Folder.
+    """
+
+    def __init__(self, name=None, delimiter=None, flags=(), parent=None):
+        self.name = name
+        self.delimiter = delimiter
+        self.flags = list(flags)
+        self.status = None
+        self.parent = parent
+        self.children = {}
+        self.names = {}
+
+    def selectable(self):
+        """ Return true if the mailbox can be selected. [7.2.2]
+        """
+        flags = [flag.upper() for flag in self.flags]
+        return self.name is not None and '\\NOSELECT' not in flags and '\\NONEXISTENT' not in flags
+
+    def basename(self):
+        """ Return the last part of the name.
+        """
+        if self.name is None or not self.delimiter:
+            return self.name
+        return self.name.split(self.delimiter)[-1]
+
+    def child(self, path):
+        """ Return the sub-folder at a path of parts separated by '/', or None.
+        """
+        folder = self
+        for part in path.split('/'):
+            if part in ('', '.'):
+                continue
+            if part == '..':
+                folder = folder.parent or folder
+                continue
+            folder = folder.children.get(part)
+            if folder is None:
+                return None
+        return folder
+
+    def walk(self):
+        """ Iterate over the folder and all its sub-folders, sorted by name.
+        """
+        yield self
+        for name in sorted(self.children):
+            for folder in self.children[name].walk():
+                yield folder
+
+def parseList(untagged):
+    """ Return the root Folder of the tree listed by LIST responses.
+
+    STATUS responses, sent with LIST-STATUS or separately, fill in the status
+    of the folders.
+
+    Args:
+        untagged: The untagged responses of LIST and STATUS.
+    """
+    root = Folder()
+    statuses = []
+    for info in untagged:
+        tokens = tokenize(info)
+        if len(tokens) >= 4 and tokens[0].upper() == 'LIST' and isinstance(tokens[1], list):
+            _add(root, tokens[3], tokens[2], tokens[1])
+        elif len(tokens) >= 3 and tokens[0].upper() == 'STATUS' and isinstance(tokens[2], list):
+            statuses.append((tokens[1], tokens[2]))
+    for name, items in statuses:
+        folder = root.names.get(_normalize(name))
+        if folder is not None:
+            folder.status = dict((items[i].upper(), int(items[i + 1]))
+                                 for i in range(0, len(items) - 1, 2))
+    return root
+
+def _add(root, name, delimiter, flags):
+    """ Add a listed mailbox, and its missing parents, to the tree.
+    """
+    name = _normalize(name)
+    parts = name.split(delimiter) if delimiter else [name]
+    parent = root
+    for i in range(len(parts)):
+        full = delimiter.join(parts[:i + 1]) if delimiter else name
+        folder = parent.children.get(parts[i])
+        if folder is None:
+            folder = Folder(full, delimiter, ['\\Noselect'], parent)
+            parent.children[parts[i]] = folder
+            root.names[full] = folder
+        parent = folder
+    parent.flags = list(flags)
+
+def _normalize(name):
+    """ Return the mailbox name, with INBOX in upper case. [5.1]
+    """
+    if name.upper() == 'INBOX' or name[:6].upper() == 'INBOX/' or name[:6].upper() == 'INBOX.':
+        return 'INBOX' + name[5:]
+    return name
+
+def quote(name):
+    """ Return a mailbox name as an atom if possible, otherwise quoted. [4.3]
+    """
+    if AtomName.match(name):
+        return name
+    return '"' + name.replace('\\', '\\\\').replace('"', '\\"') + '"'
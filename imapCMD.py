@@ -1,7 +1,24 @@
 #!/usr/bin/env python -O
 
+import sys
+
+# A command run in a background session needs none of the IMAP modules, so
+# they are not imported on this path. See session.py.
+if __name__ == '__main__' and sys.argv[1:2] == ['--session']:
+    import session
+    sys.exit(session.main(sys.argv[2:]))
+
 import argparse
+import time
 import client
+import server
+from cache import HeaderCache
+from export import Error as ExportError
+from email.utils import parseaddr, parsedate_tz
+from folders import quote
+from index import TextIndex
+from message import decodeHeaders, headerFields
+from stats import Histogram
 from getpass import getpass
 from util import printd, printe
 
@@ -9,6 +26,8 @@ from util import printd, printe
 WELCOME = 'Welcome using IMAP cmd.\n' +\
           'Only limited command with limited function is implemented for now.\n' + \
           'IMAP4 use \'/\' as file seperator.\n'
+# The public methods of Cmd which are not commands.
+NOT_COMMANDS = ('execute', 'loop')
 
 class Error(Exception): pass
 
@@ -24,41 +43,73 @@ class Cmd(object):
     user command with high-level function from client.py.
 
     Arguements:
-        client: The IMAP client object.
-        curr:   The current working directory.
+        client:    The IMAP client object.
+        curr:      The current working directory.
+        histogram: The Histogram of the measured commands, None if not
+                   measured.
     """
 
-    def __init__(self, host=None, username=None, password=None):
+    def __init__(self, host=None, username=None, password=None, cache=None, index=None, stats=False):
         """ Initialize the client with connect established.
 
         Args:
             host:     The address of the IMAP SSL host.
             username: The username.
             password: The password.
+            cache:    The directory of the header cache, no cache if None.
+            index:    The directory of the full-text index, no index if None.
+            stats:    Measure the commands for the stats command if true.
         """
-        if not host:     host = raw_input('host: ')
-        if not username: username = raw_input('username: ')
-        if not password: password = getpass()
+        host, username, password = ask(host, username, password)
         printd('Login information: ' + host + ' ' + username + ' ' + password)
-        self.client = client.IMAPClient(host, username, password)
+        if cache:
+            cache = HeaderCache(cache)
+        if index:
+            index = TextIndex(index)
+        self.histogram = None
+        if stats:
+            self.histogram = Histogram()
+            server.addHook(self.histogram)
+        self.client = client.IMAPClient(host, username, password, cache=cache, index=index)
         self.curr = ''
+
+    def loop(self):
+        """ Read and run commands until the program terminates.
+        """
         print(WELCOME)
-        print('Login to ' + host + '.\n')
+        print('Login to ' + self.client.host + '.\n')
         while 1:
-            command = raw_input(username + '$ ').lstrip().split(' ')
-            try:
-                # Avoid accessing private methods.
-                if len(command[0]) > 0:
-                    if command[0][0] == '_':
-                        raise CommandError(command[0], 'command not found')
-                    try:
-                        getattr(self, command[0])(*command[1:])
-                    except AttributeError:
-                        raise CommandError(command[0], 'command not found')
-                    except TypeError:
-                        raise CommandError(command[0], 'command with invalid parameters')
-            except CommandError, e:
-                printe(e)
+            self.execute(raw_input(self.client.username + '$ ').lstrip().split(' '))
+
+    def execute(self, command):
+        """ Run one command and print its output or its error.
+
+        Args:
+            command: The list of the command and its arguments, such as
+                     ['ls', '-l'].
+
+        Returns:
+            False if an error was printed, True otherwise.
+        """
+        try:
+            # Avoid accessing private methods.
+            if len(command[0]) > 0:
+                if command[0][0] == '_' or command[0] in NOT_COMMANDS:
+                    raise CommandError(command[0], 'command not found')
+                try:
+                    getattr(self, command[0])(*command[1:])
+                except AttributeError:
+                    raise CommandError(command[0], 'command not found')
+                except TypeError:
+                    raise CommandError(command[0], 'command with invalid parameters')
+        except CommandError, e:
+            printe(e)
+            return False
+        except server.AbortError, e:
+            # The next command connects again.
+            printe('imapCMD: ' + command[0] + ': Connection lost: ' + str(e))
+            return False
+        return True
 
     def pwd(self):
         """ Get current working directory.
@@ -77,49 +128,187 @@ class Cmd(object):
         print('IMAP4 connection closed.')
         sys.exit(0)
 
-    def ls(self):
-        """ list the subdirectories in the current working directory.
+    def ls(self, *options):
+        """ list the subdirectories in the current working directory, or in
+        the directory path if given. With '-l', list the number of emails,
+        unseen emails and the next UID too.
+        """
+        detail = '-l' in options
+        paths = [option for option in options if not option.startswith('-')]
+        folder = self._folder(status=detail)
+        if paths:
+            folder = self._lookup('ls', paths[0], detail)
+        if not detail:
+            print('\t'.join(sorted(folder.children)))
+            return
+        for name in sorted(folder.children):
+            status = folder.children[name].status or {}
+            print('\t'.join([name] + [str(status.get(item, '-')) for item in ('MESSAGES', 'UNSEEN', 'UIDNEXT')]))
+
+    def _folder(self, status=False):
+        """ Return the Folder of the current working directory.
+        """
+        root = self.client.getFolders(status)
+        return root.names.get(self.curr, root) if self.curr else root
+
+    def _lookup(self, command, path, status=False):
+        """ Return the Folder of a path, absolute or relative to the current
+        working directory.
         """
-        # Hide multiple level folder names.
-        mailboxs = []
-        for mbox in self._ls():
-            if len(self.curr) != 0:
-                mbox = mbox[len(self.curr) + 1:]
-            pos = mbox.rfind('/')
-            mbox = mbox[:pos] if pos > 0 else mbox
-            if mbox not in mailboxs:
-                mailboxs.append(mbox)
-        print('\t'.join(mailboxs))
+        folder = (self.client.getFolders(status) if path[0] == '/' else self._folder(status)).child(path)
+        if folder is None:
+            raise CommandError(command, path + ': No such directory')
+        return folder
 
-    def _ls(self):
-        """ Return a list of mailbox.
+    def _name(self, path):
+        """ Return the mailbox name of a path, absolute or relative to the
+        current working directory.
         """
-        # Get the mailbox list.
-        directory = '""' if len(self.curr) == 0 else self.curr + '/'
-        mailboxs = self.client.getMailBoxs(directory)
-        return mailboxs
+        if path[0] == '/':
+            return path[1:]
+        return path if len(self.curr) == 0 else self.curr + '/' + path
 
     def _path(self):
         """ Return the path safily for message retrieval.
         """
         return '""' if len(self.curr) == 0 else self.curr
 
-    def lm(self):
-        """ list the number of mails in the current working directory.
+    def lm(self, page='1'):
+        """ list the mails in the current working directory, newest first, a
+        page at a time from page 'page': number, flags, date, sender, size and
+        subject. On a terminal, Enter shows the next page and 'q' stops.
         """
-        # Get the email uids.
-        # In low-level, use FETCH instead of just SELECT, because EXIST is not
-        # mandatory information and mailbox can receive new email after SELECT.
-        num = len(self.client.getEmails(self._path()))
-        to = num - 10 if num >= 10 else 1
-        emails = self.client.getEmails(self._path(), '(RFC822.HEADER.LINES (Subject))', str(num) + ':' + str(to))
-        print('emails(' + str(num) + ')')
+        if not page.isdigit() or int(page) < 1:
+            raise CommandError('lm', page + ': Invalid page number')
+        # The next page is fetched while the current one is read.
+        pages = self.client.iterPages(self._path(), client.PAGE_SIZE, int(page))
+        interactive = hasattr(sys.stdout, 'isatty') and sys.stdout.isatty()
+        try:
+            for index, count, num, records in pages:
+                print('\n'.join(_preview(records)))
+                if not interactive or index == count:
+                    print('emails(%d) page %d/%d' % (num, index, count))
+                    break
+                if raw_input('-- page %d/%d, Enter for more, q to quit -- ' % (index, count)).strip() == 'q':
+                    break
+            else:
+                # Nothing is listed in an empty directory.
+                if int(page) > 1:
+                    raise CommandError('lm', page + ': No such page')
+                print('emails(0)')
+        finally:
+            pages.close()
 
     def cat(self, num):
         """ display the emil in the current working directory with mail id num.
         """
-        head, body = self.client.getEmail(self._path(), num)
-        print(head + '\n\n' + body)
+        # Only the text part is downloaded, attachments are just listed.
+        email = self.client.getMessage(self._path(), num)
+        if email is None:
+            raise CommandError('cat', str(num) + ': No such email')
+        text = email.find('text/plain', 'text/html')
+        body = text.text().encode('utf-8').replace('\r\n', '\n') if text else ''
+        print(email.header + '\n\n' + body)
+        for part in email.parts():
+            if part is not text and (part.disposition == 'attachment' or part.filename):
+                print('[attachment: %s, %s, %d bytes]' % (part.filename or part.section, part.type, part.size))
+
+    def export(self, dest, format='maildir'):
+        """ export the current working directory and its sub-directories into
+        the local directory dest, as Maildirs or mbox files.
+        """
+        mailboxs = [quote(folder.name) for folder in self._folder().walk() if folder.selectable()]
+        try:
+            result = self.client.export(mailboxs, dest, format)
+        except (ExportError, IOError, OSError), e:
+            raise CommandError('export', str(e))
+        for mailbox in mailboxs:
+            if result.get(mailbox) is None:
+                printe('export: ' + mailbox + ': No such directory')
+            else:
+                print(mailbox + ': ' + str(result[mailbox]) + ' emails')
+
+    def restore(self, src):
+        """ append the emails of the local Maildir src to the current working
+        directory.
+        """
+        if len(self.curr) == 0:
+            raise CommandError('restore', 'No directory selected')
+        try:
+            num = self.client.restore(src, self.curr)
+        except (IOError, OSError), e:
+            raise CommandError('restore', str(e))
+        print(str(num) + ' emails restored')
+
+    def grep(self, *words):
+        """ list the emails containing the words in the current working
+        directory.
+        """
+        if len(words) == 0:
+            raise CommandError('grep', 'No text given')
+        uids = self.client.grep(self._path(), ' '.join(words))
+        records = self.client.getRecordsByUID(self._path(), uids,
+                                              '(UID BODY.PEEK[HEADER.FIELDS (FROM SUBJECT)])')
+        for record in sorted(records, key=lambda record: record.seq):
+            fields = (record.section('BODY[HEADER.FIELDS (FROM SUBJECT)]') or '').strip().split('\r\n')
+            print(str(record.seq) + '\t' + '\t'.join(fields))
+        print('emails(' + str(len(records)) + ')')
+
+    def mv(self, messages, path):
+        """ move the emails with the message numbers, such as '1:10,15', from
+        the current working directory to the directory path.
+        """
+        name = self._name(path)
+        folder = self.client.getFolders().names.get(name)
+        if folder is None or not folder.selectable():
+            raise CommandError('mv', path + ': No such directory')
+        num = self.client.move(self.curr, self._uids('mv', messages), quote(name))
+        print(str(num) + ' emails moved')
+
+    def rm(self, messages):
+        """ delete the emails with the message numbers, such as '1:10,15', in
+        the current working directory.
+        """
+        num = self.client.delete(self.curr, self._uids('rm', messages))
+        print(str(num) + ' emails deleted')
+
+    def flag(self, messages, *flags):
+        """ add flags to the emails with the message numbers, such as
+        '1:10,15', in the current working directory. Remove them if the
+        first flag starts with '-', such as 'flag 3 -\\Seen'.
+        """
+        if len(flags) == 0:
+            raise CommandError('flag', 'No flag given')
+        mode = flags[0][0] if flags[0][0] in '+-' else '+'
+        flags = [flags[0].lstrip('+-')] + list(flags[1:])
+        num = self.client.store(self.curr, self._uids('flag', messages), flags, mode)
+        print(str(num) + ' emails flagged')
+
+    def _uids(self, command, messages):
+        """ Return the UIDs of the emails with the message numbers in the
+        current working directory.
+        """
+        if len(self.curr) == 0:
+            raise CommandError(command, 'No directory selected')
+        if not all(part.isdigit() or part == '*' for part in messages.replace(':', ',').split(',')):
+            raise CommandError(command, messages + ': Invalid message numbers')
+        # The UIDs seen since the directory was selected are known, and one
+        # FETCH asks for the others.
+        return self.client.getUIDs(self.curr, messages)
+
+    def index(self):
+        """ index the emails in the current working directory for grep.
+        """
+        if self.client.index is None:
+            raise CommandError('index', 'No index, start with -i dir')
+        print(str(self.client.indexEmails(self._path())) + ' emails indexed')
+
+    def stats(self):
+        """ display the latency and byte counts of the commands sent.
+        """
+        if self.histogram is None:
+            raise CommandError('stats', 'No statistics, start with -s')
+        print('\n'.join(self.histogram.report()))
 
     def cd(self, path):
         """ access the directory path. Step back to the parent directory if
@@ -128,29 +317,8 @@ class Cmd(object):
         # Only deal with first parameter (same as UNIX).
         if type(path) == type([]):
             path = path[0]
-        # Step back.
-        if path == '..':
-            if self.curr != '""':
-                pos = self.curr.rfind('/')
-                if pos > 0:
-                    self.curr = self.curr[:pos]
-                else:
-                    self.curr = ''
-        # Step into folder.
-        else:
-            mailboxs = self._ls()
-            # If given an absolute path.
-            if path[0] == '/':
-                if path[1:] in mailboxs:
-                    self.curr = path[1:]
-                else:
-                    raise CommandError('ls', 'No such directory', '')
-            else:
-                path = ('' if len(self.curr) == 0 else self.curr + '/') + path
-                if path in mailboxs:
-                    self.curr = path
-                else:
-                    raise CommandError('ls', 'No such directory', '')
+        # An absolute path starts from the root.
+        self.curr = self._lookup('cd', path).name or ''
 
     def pwd(self):
         """ display the current working directory.
@@ -174,11 +342,7 @@ class Cmd(object):
     def _mkdir(self, path):
         """ Make one directory with given path.
         """
-        # If given an absolute path.
-        if path[0] == '/':
-            self.client.makeMailBox(path)
-        else:
-            self.client.makeMailBox(self.curr + '/' + path)
+        self.client.makeMailBox(self._name(path))
 
     def rmdir(self, *paths):
         """ remove sub-directories in the current working directory.
@@ -193,17 +357,59 @@ class Cmd(object):
     def _rmdir(self, path):
         """ Remove one directory with given path.
         """
-        # If given an absolute path.
-        if path[0] == '/':
-            self.client.removeMailBox(path)
-        else:
-            self.client.removeMailBox(self.curr + '/' + path)
+        self.client.removeMailBox(self._name(path))
+
+def _preview(records):
+    """ Return the lines listing EmailRecords of PREVIEW_ITEMS.
+
+    The header fields of all the emails are decoded at once.
+    """
+    fields = [headerFields(record.section('BODY[HEADER.FIELDS (DATE FROM SUBJECT)]') or '')
+              for record in records]
+    senders = decodeHeaders([field.get('from', '') for field in fields])
+    subjects = decodeHeaders([field.get('subject', '') for field in fields])
+    lines = []
+    for record, field, sender, subject in zip(records, fields, senders, subjects):
+        flags = record.flags or []
+        marks = ('N' if '\\Seen' not in flags else ' ') + ('A' if '\\Answered' in flags else ' ') + \
+                ('F' if '\\Flagged' in flags else ' ') + ('D' if '\\Deleted' in flags else ' ')
+        name, address = parseaddr(sender)
+        line = u'%6d %s %-16s %-20.20s %6s  %s' % (
+               record.seq, marks, _date(field.get('date', '')), name or address,
+               _size(record.size or 0), subject)
+        lines.append(line.encode('utf-8'))
+    return lines
+
+def _date(value):
+    """ Return the date of a Date field as 'YYYY-MM-DD HH:MM', in the time
+    zone of the sender, or '' if it cannot be read.
+    """
+    date = parsedate_tz(value)
+    try:
+        return time.strftime('%Y-%m-%d %H:%M', date[:9]) if date else ''
+    except ValueError:
+        return ''
+
+def _size(size):
+    """ Return a size in bytes for humans, such as 3.8K.
+    """
+    for unit in ('', 'K', 'M'):
+        if size < 1024:
+            return '%d%s' % (size, unit) if unit == '' or size >= 10 else '%.1f%s' % (size, unit)
+        size /= 1024.0
+    return '%.1fG' % size
+
+def ask(host, username, password):
+    """ Return the host, username and password, asking for the missing ones.
+    """
+    if not host:     host = raw_input('host: ')
+    if not username: username = raw_input('username: ')
+    if not password: password = getpass()
+    return host, username, password
 
 if __name__ == '__main__':
     """ Program entry.
     """
-    import sys
-
     # Initialize the argument parser.
     parser = argparse.ArgumentParser(
                         description = 'UNIX bash like IMAP4 client.',
@@ -221,6 +427,22 @@ if __name__ == '__main__':
                               metavar = 'password',
                               nargs   = '?',
                               help    = 'password')
+    option_group.add_argument('-c', '--cache',
+                              metavar = 'dir',
+                              help    = 'cache headers in the directory')
+    option_group.add_argument('-i', '--index',
+                              metavar = 'dir',
+                              help    = 'keep a full-text index in the directory')
+    option_group.add_argument('-s', '--stats',
+                              action  = 'store_true',
+                              help    = 'measure the commands for stats')
+    option_group.add_argument('--serve',
+                              metavar = 'name',
+                              help    = 'keep the login as the background session name')
+    option_group.add_argument('--session',
+                              metavar = 'name',
+                              help    = 'run one command in the session name, given as '
+                                        'the first option: --session name command [args]')
 
     # Check user input.
     # Print the help information, if user does not provide any command line parameter.
@@ -229,5 +451,22 @@ if __name__ == '__main__':
         sys.exit(0)
     # Parse the command line arguments.
     args = parser.parse_args()
+    if args.session:
+        parser.error('--session must be the first option')
+    if args.serve:
+        import session
+        login = ask(args.host, args.username, args.password)
+        try:
+            session.start(args.serve, lambda: Cmd(*(login + (args.cache, args.index, args.stats))))
+        except session.Error, e:
+            printe('imapCMD: --serve: ' + str(e))
+            sys.exit(1)
+        print('Session ' + args.serve + ' started.')
+        sys.exit(0)
     # Execute the program.
-    Cmd(args.host, args.username, args.password)
+    try:
+        cmd = Cmd(args.host, args.username, args.password, args.cache, args.index, args.stats)
+    except server.Error, e:
+        printe('imapCMD: ' + str(e))
+        sys.exit(1)
+    cmd.loop()
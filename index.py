@@ -0,0 +1,202 @@
+import email
+import os
+import sqlite3
+import threading
+import Queue
+from cache import CACHE_DIR, SQL_BATCH
+from message import decodeHeaders, decodeText
+from seqset import UIDSet
+from util import printd
+
+# This module keeps a local full-text index of fetched emails, so repeated
+# searches are answered without the server.
+
+# The number of bytes of the body text fetched for indexing. Text beyond it is
+# not indexed.
+INDEX_TEXT_SIZE = 256 * 1024
+
+class Error(Exception): pass
+
+class TextIndex(object):
+    """ The persistent full-text index of emails, in SQLite FTS5.
+
+    Emails are keyed by (account, mailbox, UIDVALIDITY, UID) as in the header
+    cache. The trigram tokenizer matches any substring of at least three
+    characters, like SEARCH TEXT does. [6.4.4] Emails are added by a
+    background thread, so indexing never blocks the fetching.
+
+    Arguments:
+        db:     The SQLite connection.
+        lock:   The lock guarding the database.
+        queue:  The emails waiting to be indexed.
+        thread: The thread writing the queued emails, None until started.
+    """
+
+    def __init__(self, directory=CACHE_DIR):
+        """ Open the index database in the given directory.
+
+        Args:
+            directory: The directory of the index database.
+
+        Raise:
+            Error: If SQLite is built without FTS5 or trigrams.
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.db = sqlite3.connect(os.path.join(directory, 'index.db'), check_same_thread=False)
+        try:
+            self.db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS texts USING fts5("
+                            "header, body, tokenize='trigram')")
+        except sqlite3.OperationalError, e:
+            raise Error('SQLite full-text search is not available: ' + str(e))
+        # The row of an email is the row of its text.
+        self.db.execute('CREATE TABLE IF NOT EXISTS docs ('
+                        'account TEXT, mailbox TEXT, uidvalidity INTEGER, uid INTEGER, '
+                        'PRIMARY KEY (account, mailbox, uidvalidity, uid))')
+        self.db.commit()
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue()
+        self.thread = None
+
+    def add(self, account, mailbox, uidvalidity, uid, header, body):
+        """ Queue an email to be indexed in the background.
+
+        Args:
+            account:     The account, such as 'user@host'.
+            mailbox:     The mailbox name.
+            uidvalidity: The UIDVALIDITY of the mailbox.
+            uid:         The UID of the email.
+            header:      The header of the email.
+            body:        The body of the email, possibly truncated.
+        """
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+        self.queue.put((account, mailbox, uidvalidity, uid, header, body))
+
+    def flush(self):
+        """ Wait until all queued emails are indexed.
+        """
+        self.queue.join()
+
+    def _run(self):
+        """ Index the queued emails, committing them in batches.
+        """
+        while 1:
+            items = [self.queue.get()]
+            while len(items) < SQL_BATCH:
+                try:
+                    items.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            try:
+                with self.lock:
+                    try:
+                        for account, mailbox, uidvalidity, uid, header, body in items:
+                            try:
+                                self._put(account, mailbox, uidvalidity, uid, header, body)
+                            except sqlite3.Error:
+                                raise
+                            except Exception, e:
+                                # The thread outlives a malformed email, which
+                                # is left to the server to search.
+                                printd('\n[index skipped UID %d: %s]\n' % (uid, e))
+                        self.db.commit()
+                    except sqlite3.Error, e:
+                        # The emails are indexed again when fetched next time.
+                        printd('\n[index failed: ' + str(e) + ']\n')
+                        self.db.rollback()
+            finally:
+                for item in items:
+                    self.queue.task_done()
+
+    def _put(self, account, mailbox, uidvalidity, uid, header, body):
+        """ Index one email, replacing its old text. The caller must hold the
+        lock.
+        """
+        # The text is extracted first, so an email failing to parse changes
+        # nothing.
+        texts = (extractText(header), extractText(header, body))
+        key = (account, mailbox, uidvalidity, uid)
+        row = self.db.execute('SELECT rowid FROM docs WHERE account = ? AND mailbox = ? '
+                              'AND uidvalidity = ? AND uid = ?', key).fetchone()
+        if row is not None:
+            self.db.execute('DELETE FROM texts WHERE rowid = ?', row)
+            self.db.execute('DELETE FROM docs WHERE rowid = ?', row)
+        rowid = self.db.execute('INSERT INTO docs VALUES (?, ?, ?, ?)', key).lastrowid
+        self.db.execute('INSERT INTO texts (rowid, header, body) VALUES (?, ?, ?)',
+                        (rowid,) + texts)
+
+    def invalidate(self, account, mailbox, uidvalidity):
+        """ Remove the emails of a mailbox indexed with another UIDVALIDITY.
+        """
+        self.flush()
+        with self.lock:
+            where = ' WHERE account = ? AND mailbox = ? AND uidvalidity != ?'
+            params = (account, mailbox, uidvalidity)
+            self.db.execute('DELETE FROM texts WHERE rowid IN (SELECT rowid FROM docs' + where + ')', params)
+            self.db.execute('DELETE FROM docs' + where, params)
+            self.db.commit()
+
+    def covered(self, account, mailbox, uidvalidity):
+        """ Return the UIDSet of the indexed emails of a mailbox.
+        """
+        self.flush()
+        with self.lock:
+            rows = self.db.execute('SELECT uid FROM docs WHERE account = ? AND mailbox = ? '
+                                   'AND uidvalidity = ?', (account, mailbox, uidvalidity))
+            return UIDSet(row[0] for row in rows)
+
+    def search(self, account, mailbox, uidvalidity, text):
+        """ Return the UIDSet of the indexed emails containing the text,
+        ignoring case.
+
+        Args:
+            account:     The account, such as 'user@host'.
+            mailbox:     The mailbox name.
+            uidvalidity: The UIDVALIDITY of the mailbox.
+            text:        The text searched in headers and bodies.
+        """
+        self.flush()
+        if isinstance(text, str):
+            text = text.decode('utf-8', 'replace')
+        if len(text) >= 3:
+            # A phrase of trigrams matches the text as a substring.
+            match, params = 'texts MATCH ?', ['"' + text.replace('"', '""') + '"']
+        else:
+            escaped = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            match = "(texts.header LIKE ? ESCAPE '\\' OR texts.body LIKE ? ESCAPE '\\')"
+            params = ['%' + escaped + '%'] * 2
+        with self.lock:
+            rows = self.db.execute('SELECT d.uid FROM texts JOIN docs d ON d.rowid = texts.rowid '
+                                   'WHERE ' + match + ' AND d.account = ? AND d.mailbox = ? '
+                                   'AND d.uidvalidity = ?', params + [account, mailbox, uidvalidity])
+            return UIDSet(row[0] for row in rows)
+
+def extractText(header, body=None):
+    """ Return the searchable text of an email as unicode.
+
+    Without body, the decoded header fields are returned. Otherwise the text
+    parts of the body are decoded by their transfer encodings and charsets,
+    and attachments are left out.
+
+    Args:
+        header: The header of the email.
+        body:   The body of the email, possibly truncated.
+    """
+    message = email.message_from_string(header + (body or ''))
+    if body is None:
+        return u'\n'.join(_decodeHeader(name, value) for name, value in message.items())
+    texts = []
+    for part in message.walk():
+        if part.is_multipart() or part.get_content_maintype() != 'text' or \
+           part.get('Content-Disposition', '').lower().startswith('attachment'):
+            continue
+        texts.append(decodeText(part.get_payload(decode=True) or '', part.get_content_charset()))
+    return u'\n'.join(texts)
+
+def _decodeHeader(name, value):
+    """ Return a header field with its encoded words decoded. [RFC 2047]
+    """
+    return name + u': ' + decodeHeaders([value])[0]
@@ -0,0 +1,249 @@
+import base64
+import quopri
+import re
+from email.errors import HeaderParseError
+from email.header import decode_header
+
+# This module provides emails whose body parts are downloaded on demand. The
+# MIME structure is read from BODYSTRUCTURE, then each part is fetched by its
+# section number, in ranges of at most CHUNK_SIZE bytes. [6.4.5, 7.4.2]
+# It also decodes the header fields of emails.
+
+# The default number of bytes fetched by one partial FETCH.
+CHUNK_SIZE = 256 * 1024
+
+# Regular expression to match the line break of a folded header field.
+# [2.2.3, RFC 5322]
+Fold = re.compile(r'\r?\n(?=[ \t])')
+
+class Part(object):
+    """ One MIME part of a LazyEmail.
+
+    Arguments:
+        email:       The LazyEmail the part belongs to.
+        section:     The section number, such as '1' or '2.1'.
+        type:        The lower-case MIME type, such as 'text/plain'.
+        params:      A dictionary maps lower-case parameter names, such as
+                     'charset', to their values.
+        encoding:    The lower-case content transfer encoding.
+        size:        The size of the encoded part in bytes.
+        disposition: The lower-case disposition, such as 'attachment', or None.
+        filename:    The file name of the part, or None.
+        children:    The list of sub-parts of a multipart part.
+    """
+
+    def __init__(self, email, section, type, params=None, encoding='7bit', size=0):
+        self.email = email
+        self.section = section
+        self.type = type
+        self.params = params or {}
+        self.encoding = encoding
+        self.size = size
+        self.disposition = None
+        self.filename = self.params.get('name')
+        self.children = []
+        self.content = None
+
+    def iterChunks(self, chunk_size=CHUNK_SIZE):
+        """ Iterate over the encoded content in chunks, downloading each chunk
+        when it is needed.
+
+        Args:
+            chunk_size: The maximum number of bytes fetched by one command.
+        """
+        if self.content is not None:
+            yield self.content
+            return
+        for chunk in self.email.client._iterSection(self.email.directory, self.email.uid,
+                                                    self.section, self.size, chunk_size):
+            yield chunk
+
+    def read(self):
+        """ Return the encoded content, downloading it once.
+        """
+        if self.content is None:
+            self.content = ''.join(self.iterChunks())
+        return self.content
+
+    def decode(self):
+        """ Return the content with its transfer encoding removed.
+        """
+        if self.encoding == 'base64':
+            return base64.b64decode(self.read())
+        if self.encoding == 'quoted-printable':
+            return quopri.decodestring(self.read())
+        return self.read()
+
+    def text(self):
+        """ Return the decoded content as unicode, by the charset of the part.
+        """
+        return decodeText(self.decode(), self.params.get('charset'))
+
+    def walk(self):
+        """ Iterate over the part and all its sub-parts, depth first.
+        """
+        yield self
+        for child in self.children:
+            for part in child.walk():
+                yield part
+
+    def __repr__(self):
+        return '<Part %s %s %d>' % (self.section, self.type, self.size)
+
+class LazyEmail(object):
+    """ An email whose body parts are downloaded when they are accessed.
+
+    Arguments:
+        client:    The IMAPClient the email is fetched with.
+        directory: The mailbox where the email stays.
+        uid:       The UID of the email.
+        header:    The header fields fetched with the structure.
+        body:      The root Part.
+    """
+
+    def __init__(self, client, directory, uid, header, structure):
+        """ Construct the email from its BODYSTRUCTURE.
+
+        Args:
+            client:    The IMAPClient the email is fetched with.
+            directory: The mailbox where the email stays.
+            uid:       The UID of the email.
+            header:    The header fields fetched with the structure.
+            structure: The tokens of the BODYSTRUCTURE.
+        """
+        self.client = client
+        self.directory = directory
+        self.uid = uid
+        self.header = header
+        self.body = self._parse(structure, '')
+
+    def parts(self):
+        """ Return the list of leaf parts, which have content.
+        """
+        return [part for part in self.body.walk() if not part.children]
+
+    def find(self, *types):
+        """ Return the first inline leaf part of the first given type found,
+        or None.
+
+        Args:
+            types: The MIME types in order of preference, such as 'text/plain'.
+        """
+        for type in types:
+            for part in self.parts():
+                if part.type == type and part.disposition != 'attachment':
+                    return part
+        return None
+
+    def _parse(self, tokens, section):
+        """ Parse the tokens of a body structure into a Part.
+
+        Args:
+            tokens:  The tokens of the body structure.
+            section: The section number of the parent, '' for the root.
+        """
+        # A multipart body starts with its sub-parts. [7.4.2]
+        if tokens and isinstance(tokens[0], list):
+            children = []
+            while tokens and isinstance(tokens[0], list):
+                children.append(tokens.pop(0))
+            part = Part(self, section or 'TEXT', 'multipart/' + _lower(tokens[0] if tokens else 'mixed'),
+                        _params(tokens[1] if len(tokens) > 1 else None))
+            for i, child in enumerate(children):
+                part.children.append(self._parse(child, (section + '.' if section else '') + str(i + 1)))
+            return part
+        type = _lower(tokens[0]) + '/' + _lower(tokens[1])
+        # A non-multipart root is the first part. [6.4.5]
+        part = Part(self, section or '1', type, _params(tokens[2]), _lower(tokens[5]) or '7bit',
+                    int(tokens[6] or 0))
+        # Extension data follows the basic fields, a line count for text and
+        # more fields for an encapsulated message.
+        if type == 'message/rfc822':
+            extension = 10
+        elif tokens[0].upper() == 'TEXT':
+            extension = 8
+        else:
+            extension = 7
+        # Skip the MD5 to reach the disposition.
+        if len(tokens) > extension + 1 and isinstance(tokens[extension + 1], list):
+            disposition = tokens[extension + 1]
+            part.disposition = _lower(disposition[0])
+            if len(disposition) > 1:
+                part.filename = _params(disposition[1]).get('filename', part.filename)
+        return part
+
+def decodeText(data, charset):
+    """ Return bytes decoded by a charset as unicode, with invalid bytes
+    replaced.
+
+    An unknown charset raises LookupError, but a codec which is not a
+    charset, such as base64 or zlib, raises an AssertionError, its own error
+    once assertions are off with -O, or returns bytes. The data of either is
+    decoded as latin-1.
+
+    Args:
+        data:    The bytes.
+        charset: The charset, None for us-ascii.
+    """
+    try:
+        text = data.decode(charset or 'us-ascii', 'replace')
+    except Exception:
+        text = None
+    if not isinstance(text, unicode):
+        text = data.decode('latin-1')
+    return text
+
+def _lower(value):
+    """ Return a lower-case string, or None for NIL.
+    """
+    return value.lower() if value is not None else None
+
+def _params(tokens):
+    """ Return the dictionary of a body parameter list.
+    """
+    if not isinstance(tokens, list):
+        return {}
+    return dict((_lower(tokens[i]), tokens[i + 1]) for i in range(0, len(tokens) - 1, 2))
+
+def headerFields(header):
+    """ Return the dictionary of the fields of a header, by lower-case name,
+    unfolded. Of repeated fields, the first one is kept.
+
+    Args:
+        header: The header, or header fields such as those of
+                BODY[HEADER.FIELDS (DATE FROM SUBJECT)].
+    """
+    fields = {}
+    for line in Fold.sub('', header).splitlines():
+        name, colon, value = line.partition(':')
+        if colon and name.strip():
+            fields.setdefault(name.strip().lower(), value.strip())
+    return fields
+
+def decodeHeaders(values):
+    """ Return the list of header field values with their encoded words
+    decoded, as unicode. [RFC 2047]
+
+    The values of many emails are decoded at once. Each distinct value is
+    decoded once, since the same senders and subjects repeat, and a value
+    without encoded words skips the decoder.
+
+    Args:
+        values: The list of raw field values.
+    """
+    decoded = {}
+    result = []
+    for value in values:
+        if value not in decoded:
+            decoded[value] = _decodeWords(value) if '=?' in value else value.decode('latin-1')
+        result.append(decoded[value])
+    return result
+
+def _decodeWords(value):
+    """ Return a header field value with its encoded words decoded.
+    """
+    try:
+        words = decode_header(value)
+    except HeaderParseError:
+        return value.decode('latin-1')
+    return u' '.join(decodeText(text, charset or 'latin-1') for text, charset in words)
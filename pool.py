@@ -0,0 +1,218 @@
+import threading
+import time
+import server
+from util import printd
+
+# The default maximum number of connections per account. Many servers limit
+# the number of concurrent connections from one user.
+MAX_CONNECTIONS = 4
+# The default seconds a connection may stay idle before it is checked with
+# NOOP. Servers may log out an idle client after 30 minutes. [5.4]
+KEEPALIVE = 300
+
+class Error(Exception): pass
+
+# This exception occors if no connection becomes available in time.
+class PoolTimeoutError(Error): pass
+
+class ConnectionPool(object):
+    """ A pool of authenticated IMAP connections.
+
+    Connections are keyed by (host, username). Checking out a connection
+    prefers one which already has the requested mailbox selected, so the
+    mailbox does not have to be selected again.
+
+    Arguments:
+        engine:          The IMAP server class used to connect.
+        max_connections: The maximum number of connections per account.
+        keepalive:       The seconds an idle connection stays unchecked.
+        idle:            A dictionary maps an account to its idle connections,
+                         each as a tuple of connection and time of last use.
+        opened:          A dictionary maps an account to its number of opened
+                         connections.
+        lock:            The condition guarding the pool.
+    """
+
+    def __init__(self, engine=server.IMAPServer, max_connections=MAX_CONNECTIONS,
+                 keepalive=KEEPALIVE):
+        """ Construct an empty pool.
+
+        Args:
+            engine:          The IMAP server class used to connect.
+            max_connections: The maximum number of connections per account.
+            keepalive:       The seconds an idle connection stays unchecked.
+        """
+        self.engine = engine
+        self.max_connections = max_connections
+        self.keepalive = keepalive
+        self.idle = {}
+        self.opened = {}
+        self.lock = threading.Condition()
+
+    def checkout(self, host, username, password, mailbox=None, timeout=None):
+        """ Take an authenticated connection out of the pool.
+
+        A new connection is opened if none is idle and the account has not
+        reached its limit. Otherwise wait for a connection to be checked in.
+
+        Args:
+            host:     The address of the IMAP SSL host.
+            username: The username.
+            password: The password.
+            mailbox:  The mailbox the caller is going to select, if any.
+            timeout:  The maximum seconds to wait, or None to wait forever.
+
+        Raise:
+            PoolTimeoutError: If no connection is available in time.
+
+        Returns:
+            The connection, which must be given back by checkin().
+        """
+        key = (host, username)
+        deadline = None if timeout is None else time.time() + timeout
+        while 1:
+            with self.lock:
+                conn, last_used = self._take(key, mailbox, deadline)
+            if conn is None:
+                return self._open(key, password)
+            # Check the connection if it has been idle for a long time.
+            if time.time() - last_used < self.keepalive or self._check(conn):
+                return conn
+            self._discard(key, conn)
+
+    def checkin(self, conn):
+        """ Give a connection back to the pool.
+
+        A connection which is logged out, ended by the server with BYE or
+        still has pending commands is closed instead.
+
+        Args:
+            conn: The connection taken by checkout().
+        """
+        key = conn.pool_key
+        if conn.state in ('NONAUTH', 'LOGOUT') or conn.bye is not None or conn.pending:
+            self._discard(key, conn)
+            return
+        with self.lock:
+            self.idle.setdefault(key, []).append((conn, time.time()))
+            self.lock.notify_all()
+
+    def ping(self):
+        """ Send NOOP on every connection idle longer than keepalive.
+
+        Broken connections are dropped from the pool.
+        """
+        now = time.time()
+        with self.lock:
+            stale = []
+            for key, conns in self.idle.items():
+                for item in list(conns):
+                    if now - item[1] >= self.keepalive:
+                        conns.remove(item)
+                        stale.append((key, item[0]))
+        for key, conn in stale:
+            if self._check(conn):
+                self.checkin(conn)
+            else:
+                self._discard(key, conn)
+
+    def start_keepalive(self):
+        """ Start a daemon thread calling ping() periodically.
+        """
+        def run():
+            while 1:
+                time.sleep(self.keepalive)
+                self.ping()
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def close(self, host=None, username=None):
+        """ Logout the idle connections of one account, or of all accounts.
+
+        Args:
+            host:     The address of the IMAP SSL host.
+            username: The username.
+        """
+        with self.lock:
+            keys = [(host, username)] if host else self.idle.keys()
+            conns = []
+            for key in keys:
+                conns.extend((key, item[0]) for item in self.idle.pop(key, []))
+        for key, conn in conns:
+            try:
+                conn.LOGOUT()
+            except (server.Error, EnvironmentError):
+                pass
+            self._discard(key, conn)
+
+    def _take(self, key, mailbox, deadline):
+        """ Remove an idle connection from the pool, waiting if necessary.
+
+        The caller must hold the lock.
+
+        Returns:
+            A tuple of connection and time of last use. The connection is
+            None if a new connection should be opened.
+        """
+        while 1:
+            conns = self.idle.get(key)
+            if conns:
+                # Prefer the connection with the mailbox selected, then the
+                # most recently used one.
+                for item in reversed(conns):
+                    if mailbox is not None and item[0].mailbox == mailbox:
+                        break
+                else:
+                    item = conns[-1]
+                conns.remove(item)
+                return item
+            if self.opened.get(key, 0) < self.max_connections:
+                self.opened[key] = self.opened.get(key, 0) + 1
+                return None, None
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                raise PoolTimeoutError('No connection available for ' + key[1] + '@' + key[0])
+            self.lock.wait(remaining)
+
+    def _open(self, key, password):
+        """ Open and authenticate a new connection.
+
+        The account must already have a slot reserved in opened.
+        """
+        try:
+            conn = self.engine(key[0])
+            # The response code tells whether the failure is temporary, such
+            # as [UNAVAILABLE]. [RFC 5530]
+            data = conn.LOGIN(key[1], password)[1]
+            if conn.state != 'AUTH':
+                raise server.InvalidCommandError('Login failed for ' + key[1] + '@' + key[0] + ': ' + data)
+            if server.COMPRESS_DEFLATE:
+                conn.compress()
+        except:
+            self._discard(key, None)
+            raise
+        conn.pool_key = key
+        printd('\n[pool opened connection for ' + key[1] + '@' + key[0] + ']\n')
+        return conn
+
+    def _check(self, conn):
+        """ Return true if the connection answers NOOP.
+        """
+        try:
+            return conn.NOOP()[0] == 'OK'
+        except (server.Error, EnvironmentError):
+            return False
+
+    def _discard(self, key, conn):
+        """ Release the slot of a connection which is closed or broken.
+        """
+        if conn is not None:
+            try:
+                conn.sock.close()
+            except EnvironmentError:
+                pass
+        with self.lock:
+            self.opened[key] = self.opened.get(key, 1) - 1
+            self.lock.notify_all()
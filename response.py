@@ -0,0 +1,263 @@
+import re
+
+# This module parses IMAP4 server responses. [7, 9]
+# ResponseParser frames the received data into complete responses. It works
+# incrementally, so data may arrive in chunks of any size, and the bytes of a
+# literal are never copied more than once. tokenize() then turns the text of a
+# complete response into atoms, strings and lists.
+
+CRLF = '\r\n'
+
+# Regular expression to match a literal at the end of a line. [4.3]
+Literal = re.compile(r'\{(?P<size>\d+)\}$')
+# Regular expression to match a literal in a response text.
+LiteralToken = re.compile(r'\{(?P<size>\d+)\}\r\n')
+# Regular expression to match an atom. A body section such as
+# BODY[HEADER.FIELDS (SUBJECT)]<0> is kept as one atom. [7.4.2]
+Atom = re.compile(r'(?:[^\s()"{\[\]]+|\[[^\]]*\])+')
+# Regular expression to match a quoted string. [4.3]
+Quoted = re.compile(r'"((?:[^"\\]|\\.)*)"')
+Escaped = re.compile(r'\\(.)')
+
+class ResponseParser(object):
+    """ The incremental framer of IMAP server responses.
+
+    A response is one line, unless the line ends with a literal. Then the
+    literal and the line following it are parts of the same response, and
+    there may be more literals in the middle of it. [4.3]
+
+    Lines are searched in the received data in place, and only a line split
+    between two receptions is buffered. The bytes of a literal going to a
+    sink are never copied.
+
+    Arguments:
+        handler: The function called with each complete response.
+        buf:     The start of a line split between two receptions.
+        pieces:  The pieces of the response being framed.
+        literal: The number of literal bytes still to be read, or None if a
+                 line is being read.
+        sink:    The function deciding where a literal goes, see __init__.
+        writer:  The writer of the literal being read, if it goes to a sink.
+    """
+
+    def __init__(self, handler, sink=None):
+        """ Construct the parser.
+
+        Args:
+            handler: A function called as handler(tag, info) with each complete
+                     response, as soon as it is framed.
+            sink:    A function called as sink(prefix, size) at the start of
+                     each literal, where prefix is the response text before
+                     the literal. It returns a file like object to write the
+                     literal to, or None to keep the literal in the response.
+                     The object is given memoryview slices of the received
+                     data, valid only during the write() call. It is closed at
+                     the end of the literal, and the literal is left empty in
+                     the response.
+        """
+        self.handler = handler
+        self.buf = bytearray()
+        self.pieces = []
+        self.literal = None
+        self.sink = sink
+        self.writer = None
+
+    def feed(self, data, size=None):
+        """ Frame the received data.
+
+        The data may be a receive buffer reused afterwards, since nothing
+        refers to it once feed() returns.
+
+        Args:
+            data: The data received from the server, a string or a bytearray.
+            size: The number of received bytes at the start of data, all of
+                  it if None.
+        """
+        if size is None:
+            size = len(data)
+        view = memoryview(data)
+        pos = 0
+        while pos < size:
+            if self.literal:
+                # The bytes of a literal are taken from the data directly.
+                length = min(self.literal, size - pos)
+                self._literal(view[pos:pos + length])
+                pos += length
+                continue
+            # A CRLF may be split between two receptions.
+            if self.buf and self.buf[-1] == 13 and data[pos:pos + 1] == '\n':
+                line = str(self.buf[:-1])
+                pos += 1
+            else:
+                end = data.find(CRLF, pos, size)
+                if end < 0:
+                    self.buf += view[pos:size]
+                    break
+                line = view[pos:end].tobytes()
+                if self.buf:
+                    line = str(self.buf) + line
+                pos = end + 2
+            del self.buf[:]
+            self._line(line)
+
+    def _line(self, line):
+        """ Frame one complete line.
+        """
+        match = Literal.search(line)
+        if match:
+            self._start_literal(line, int(match.group('size')))
+        else:
+            self.pieces.append(line)
+            response = ''.join(self.pieces)
+            self.pieces = []
+            self.handler(*(response.split(' ', 1) + [''])[:2])
+
+    def _start_literal(self, line, size):
+        """ Start reading a literal announced at the end of the line.
+        """
+        self.writer = None
+        if self.sink is not None:
+            self.writer = self.sink(''.join(self.pieces) + line, size)
+        if self.writer is not None:
+            line = line[:line.rfind('{')] + '{0}'
+        self.pieces.append(line)
+        self.pieces.append(CRLF)
+        self.literal = size
+        if size == 0:
+            self._end_literal()
+
+    def _literal(self, data):
+        """ Keep or write the given bytes of the current literal, a memoryview.
+        """
+        if self.writer is not None:
+            self.writer.write(data)
+        else:
+            self.pieces.append(data.tobytes())
+        self.literal -= len(data)
+        if self.literal == 0:
+            self._end_literal()
+
+    def _end_literal(self):
+        """ Finish the current literal, then a line is read.
+        """
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        self.literal = None
+
+def tokenize(text, pos=0):
+    """ Parse the text of a response into tokens.
+
+    Atoms are returned as strings, NIL as None, quoted strings and literals as
+    strings, and parenthesized lists as lists.
+
+    Args:
+        text: The response text, with literals in place.
+        pos:  The position to start parsing.
+
+    Returns:
+        A list of tokens.
+    """
+    stack = [[]]
+    size = len(text)
+    while pos < size:
+        char = text[pos]
+        if char in ' \r\n':
+            pos += 1
+        elif char == '(':
+            tokens = []
+            stack[-1].append(tokens)
+            stack.append(tokens)
+            pos += 1
+        elif char == ')':
+            if len(stack) > 1:
+                stack.pop()
+            pos += 1
+        elif char == '"':
+            match = Quoted.match(text, pos)
+            if match is None:
+                stack[-1].append(text[pos + 1:])
+                break
+            stack[-1].append(Escaped.sub(r'\1', match.group(1)))
+            pos = match.end()
+        elif char == '{' and LiteralToken.match(text, pos):
+            match = LiteralToken.match(text, pos)
+            end = match.end() + int(match.group('size'))
+            stack[-1].append(text[match.end():end])
+            pos = end
+        else:
+            match = Atom.match(text, pos)
+            atom = match.group() if match else char
+            stack[-1].append(None if atom == 'NIL' else atom)
+            pos += len(atom)
+    return stack[0]
+
+class EmailRecord(object):
+    """ The data items of one email returned by FETCH. [7.4.2]
+
+    Arguments:
+        seq:          The message sequence number.
+        uid:          The unique identifier, None if not fetched.
+        flags:        A list of flags, None if not fetched.
+        size:         The RFC822.SIZE, None if not fetched.
+        internaldate: The INTERNALDATE string, None if not fetched.
+        sections:     A dictionary maps body section names, such as
+                      'BODY[HEADER]' or 'RFC822.TEXT', to their content.
+        items:        A dictionary maps other data item names, such as
+                      'ENVELOPE', to their tokens.
+    """
+    __slots__ = ('seq', 'uid', 'flags', 'size', 'internaldate', 'sections', 'items')
+
+    def __init__(self, seq):
+        self.seq = seq
+        self.uid = None
+        self.flags = None
+        self.size = None
+        self.internaldate = None
+        self.sections = {}
+        self.items = {}
+
+    def section(self, name):
+        """ Return the content of a body section, or None if not fetched.
+
+        Section names are case-insensitive, and BODY.PEEK is answered as BODY,
+        so both names find the same section.
+        """
+        return self.sections.get(name.upper().replace('BODY.PEEK[', 'BODY['))
+
+    def __repr__(self):
+        return '<EmailRecord %d uid=%r flags=%r size=%r sections=%r>' % (
+                self.seq, self.uid, self.flags, self.size, sorted(self.sections))
+
+def parseFetch(info):
+    """ Parse an untagged FETCH response into an EmailRecord.
+
+    Any combination of data items is accepted.
+
+    Args:
+        info: The untagged response information, such as
+              '12 FETCH (UID 40 FLAGS (\\Seen) RFC822.SIZE 320)'.
+
+    Returns:
+        The EmailRecord, or None if the response is not a FETCH response.
+    """
+    tokens = tokenize(info)
+    if len(tokens) < 3 or tokens[1] != 'FETCH' or not isinstance(tokens[2], list):
+        return None
+    record = EmailRecord(int(tokens[0]))
+    items = tokens[2]
+    for i in range(0, len(items) - 1, 2):
+        name, value = items[i].upper(), items[i + 1]
+        if name == 'UID':
+            record.uid = int(value)
+        elif name == 'FLAGS':
+            record.flags = value
+        elif name == 'RFC822.SIZE':
+            record.size = int(value)
+        elif name == 'INTERNALDATE':
+            record.internaldate = value
+        elif name.startswith(('BODY[', 'BINARY[', 'RFC822')):
+            record.sections[name] = value
+        else:
+            record.items[name] = value
+    return record
@@ -0,0 +1,208 @@
+import datetime
+from response import tokenize
+from seqset import UIDSet
+from server import Literal
+
+# This module builds the search criteria of SEARCH, SORT and THREAD, and parses
+# their responses. [6.4.4, RFC 4731, RFC 5256]
+
+# The month names of search dates, which do not depend on the locale. [9]
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+          'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+class Error(Exception): pass
+
+class Query(object):
+    """ The search criteria, built by chaining keys, such as
+    Query().unseen().sender('alice').since(date(2024, 1, 1)).
+
+    All keys must match, as in SEARCH. Strings with non-ASCII characters are
+    sent as UTF-8 literals.
+
+    Arguments:
+        keys:    The list of search keys, each a list of the key name and its
+                 arguments, strings or Literals.
+        charset: 'UTF-8' if a string is not ASCII, otherwise None.
+    """
+
+    def __init__(self, *keys):
+        """ Construct the query with the given raw search keys.
+
+        Args:
+            keys: Search keys, such as 'UNSEEN'. No key matches all emails.
+        """
+        self.keys = [[key] for key in keys]
+        self.charset = None
+
+    def params(self):
+        """ Return the search keys sent with the command.
+        """
+        if not self.keys:
+            return ['ALL']
+        return [token for key in self.keys for token in key]
+
+    def key(self, name, *args):
+        """ Add a search key with arguments, quoting strings. Return the query.
+        """
+        key = [name]
+        for arg in args:
+            if isinstance(arg, (datetime.date, datetime.datetime)):
+                key.append('%d-%s-%d' % (arg.day, MONTHS[arg.month - 1], arg.year))
+            elif isinstance(arg, (int, long)):
+                key.append(str(arg))
+            else:
+                key.append(self._string(arg))
+        self.keys.append(key)
+        return self
+
+    def atoms(self, *tokens):
+        """ Add a search key of atoms, such as a sequence set, which are sent
+        as given. Return the query.
+        """
+        self.keys.append(list(tokens))
+        return self
+
+    def _string(self, text):
+        """ Return a string argument as a quoted string or a literal. [4.3]
+        """
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        try:
+            text.decode('ascii')
+        except UnicodeDecodeError:
+            self.charset = 'UTF-8'
+            return Literal(text)
+        if '\r' in text or '\n' in text:
+            return Literal(text)
+        return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+    # Flags.
+    def answered(self, yes=True): return self.key('ANSWERED' if yes else 'UNANSWERED')
+    def deleted(self, yes=True):  return self.key('DELETED' if yes else 'UNDELETED')
+    def draft(self, yes=True):    return self.key('DRAFT' if yes else 'UNDRAFT')
+    def flagged(self, yes=True):  return self.key('FLAGGED' if yes else 'UNFLAGGED')
+    def seen(self, yes=True):     return self.key('SEEN' if yes else 'UNSEEN')
+    def unseen(self):             return self.key('UNSEEN')
+    def new(self):                return self.key('NEW')
+    def keyword(self, flag):      return self.atoms('KEYWORD', flag)
+
+    # Dates, by INTERNALDATE or by the Date header with sent set.
+    def before(self, date, sent=False): return self.key('SENTBEFORE' if sent else 'BEFORE', date)
+    def on(self, date, sent=False):     return self.key('SENTON' if sent else 'ON', date)
+    def since(self, date, sent=False):  return self.key('SENTSINCE' if sent else 'SINCE', date)
+
+    # Contents.
+    def sender(self, text):           return self.key('FROM', text)
+    def to(self, text):               return self.key('TO', text)
+    def cc(self, text):               return self.key('CC', text)
+    def subject(self, text):          return self.key('SUBJECT', text)
+    def body(self, text):             return self.key('BODY', text)
+    def text(self, text):             return self.key('TEXT', text)
+    def header(self, name, text):     return self.key('HEADER', name, text)
+
+    # Sizes and sets.
+    def larger(self, size):           return self.key('LARGER', size)
+    def smaller(self, size):          return self.key('SMALLER', size)
+    def uid(self, uids):              return self.atoms('UID', str(uids))
+
+    def or_(self, one, other):
+        """ Add a key matching either query. Return the query.
+        """
+        self.keys.append(['OR'] + self._group(one) + self._group(other))
+        self.charset = self.charset or one.charset or other.charset
+        return self
+
+    def not_(self, query):
+        """ Add a key matching what the query does not. Return the query.
+        """
+        self.keys.append(['NOT'] + self._group(query))
+        self.charset = self.charset or query.charset
+        return self
+
+    def _group(self, query):
+        """ Return the tokens of a query as one search key.
+
+        Raise:
+            Error: If a query of several keys ends with a literal, which
+                   cannot be followed by the closing parenthesis.
+        """
+        tokens = query.params()
+        if len(query.keys) <= 1:
+            return tokens
+        if isinstance(tokens[-1], Literal):
+            raise Error('A grouped query cannot end with a non-ASCII string')
+        return ['(' + tokens[0]] + tokens[1:-1] + [tokens[-1] + ')']
+
+def parseSearch(untagged):
+    """ Return the numbers of SEARCH responses as a UIDSet. [7.2.5]
+    """
+    numbers = []
+    for info in untagged:
+        words = info.split(' ')
+        if words[0].upper() == 'SEARCH':
+            numbers.extend(int(word) for word in words[1:] if word)
+    return UIDSet(numbers)
+
+def parseESearch(untagged):
+    """ Return the results of an ESEARCH response. [3.1, RFC 4731]
+
+    Returns:
+        A dictionary maps MIN, MAX and COUNT to numbers and ALL to a UIDSet.
+        Missing results are absent, such as MIN of no match.
+    """
+    result = {}
+    for info in untagged:
+        tokens = tokenize(info)
+        if not tokens or tokens[0].upper() != 'ESEARCH':
+            continue
+        tokens = tokens[1:]
+        # Skip the search correlator and the UID indicator.
+        if tokens and isinstance(tokens[0], list):
+            tokens = tokens[1:]
+        if tokens and tokens[0].upper() == 'UID':
+            tokens = tokens[1:]
+        for i in range(0, len(tokens) - 1, 2):
+            name = tokens[i].upper()
+            if name == 'ALL':
+                result[name] = UIDSet.parse(tokens[i + 1])
+            elif name in ('MIN', 'MAX', 'COUNT'):
+                result[name] = int(tokens[i + 1])
+    return result
+
+def parseSort(untagged):
+    """ Return the numbers of SORT responses in order. [4, RFC 5256]
+    """
+    numbers = []
+    for info in untagged:
+        words = info.split(' ')
+        if words[0].upper() == 'SORT':
+            numbers.extend(int(word) for word in words[1:] if word)
+    return numbers
+
+def parseThread(untagged):
+    """ Return the threads of THREAD responses. [4, RFC 5256]
+
+    Returns:
+        A list of threads. A thread is a list of numbers, each the parent of
+        the next, ending with a list of the branching threads, if any.
+    """
+    threads = []
+    for info in untagged:
+        tokens = tokenize(info)
+        if tokens and tokens[0].upper() == 'THREAD':
+            threads.extend(_thread(tokens) for tokens in tokens[1:])
+    return threads
+
+def _thread(tokens):
+    """ Convert the tokens of one thread into numbers.
+    """
+    thread = []
+    branches = []
+    for token in tokens:
+        if isinstance(token, list):
+            branches.append(_thread(token))
+        else:
+            thread.append(int(token))
+    if branches:
+        thread.append(branches)
+    return thread
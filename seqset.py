@@ -0,0 +1,203 @@
+import bisect
+from array import array
+
+# This module converts between sequence sets, such as '1:3,7', and lists of
+# message numbers or UIDs, and holds big sets of them as ranges. [9]
+
+def compress(numbers):
+    """ Return the shortest sequence set of the given numbers, such as '1:3,7'.
+
+    Args:
+        numbers: An iterable of message numbers or UIDs.
+    """
+    parts = []
+    numbers = sorted(set(numbers))
+    start = 0
+    for i in range(1, len(numbers) + 1):
+        if i == len(numbers) or numbers[i] != numbers[i - 1] + 1:
+            if i - 1 == start:
+                parts.append(str(numbers[start]))
+            else:
+                parts.append('%d:%d' % (numbers[start], numbers[i - 1]))
+            start = i
+    return ','.join(parts)
+
+def expand(text, last=None):
+    """ Return the sorted list of numbers in a sequence set.
+
+    Args:
+        text: The sequence set, such as '1:3,7'.
+        last: The number '*' stands for.
+    """
+    numbers = set()
+    for item in text.split(','):
+        if not item:
+            continue
+        bounds = [last if bound == '*' else int(bound) for bound in item.split(':')]
+        numbers.update(xrange(min(bounds), max(bounds) + 1))
+    return sorted(numbers)
+
+class UIDSet(object):
+    """ A set of message numbers or UIDs, stored as ranges.
+
+    The ranges are kept sorted and disjoint in one array, so a set of a
+    million consecutive UIDs takes two integers, and two sets are intersected
+    by merging their ranges.
+
+    Arguments:
+        ranges: The array of first and last numbers of each range.
+    """
+
+    def __init__(self, numbers=()):
+        """ Construct the set of the given numbers.
+
+        Args:
+            numbers: An iterable of message numbers or UIDs.
+        """
+        self.ranges = array('L')
+        for number in sorted(set(numbers)):
+            if self.ranges and self.ranges[-1] + 1 == number:
+                self.ranges[-1] = number
+            else:
+                self.ranges.extend((number, number))
+
+    @classmethod
+    def parse(cls, text, last=None):
+        """ Return the set of a sequence set without expanding it.
+
+        Args:
+            text: The sequence set, such as '1:3,7'.
+            last: The number '*' stands for.
+        """
+        bounds = []
+        for item in text.split(','):
+            if not item:
+                continue
+            pair = [last if bound == '*' else int(bound) for bound in item.split(':')]
+            bounds.append((min(pair), max(pair)))
+        return cls._fromRanges(sorted(bounds))
+
+    @classmethod
+    def _fromRanges(cls, bounds):
+        """ Return the set of the given sorted (first, last) ranges, merging
+        overlapping and adjacent ones.
+        """
+        result = cls()
+        ranges = result.ranges
+        for first, last in bounds:
+            if ranges and first <= ranges[-1] + 1:
+                ranges[-1] = max(ranges[-1], last)
+            else:
+                ranges.extend((first, last))
+        return result
+
+    def _pairs(self):
+        """ Return the list of (first, last) ranges.
+        """
+        return zip(self.ranges[::2], self.ranges[1::2])
+
+    def __len__(self):
+        return sum(last - first + 1 for first, last in self._pairs())
+
+    def __nonzero__(self):
+        return len(self.ranges) > 0
+
+    def __contains__(self, number):
+        # The index of the first bound above the number is odd inside a range.
+        i = bisect.bisect_left(self.ranges, number)
+        return i < len(self.ranges) and (i % 2 == 1 or self.ranges[i] == number)
+
+    def __iter__(self):
+        for first, last in self._pairs():
+            for number in xrange(first, last + 1):
+                yield number
+
+    def __and__(self, other):
+        bounds = []
+        mine, theirs = self._pairs(), other._pairs()
+        i = j = 0
+        while i < len(mine) and j < len(theirs):
+            first = max(mine[i][0], theirs[j][0])
+            last = min(mine[i][1], theirs[j][1])
+            if first <= last:
+                bounds.append((first, last))
+            if mine[i][1] < theirs[j][1]:
+                i += 1
+            else:
+                j += 1
+        return UIDSet._fromRanges(bounds)
+
+    def __or__(self, other):
+        return UIDSet._fromRanges(sorted(self._pairs() + other._pairs()))
+
+    def __sub__(self, other):
+        bounds = []
+        theirs = other._pairs()
+        j = 0
+        for first, last in self._pairs():
+            while j < len(theirs) and theirs[j][1] < first:
+                j += 1
+            k = j
+            while first <= last and k < len(theirs) and theirs[k][0] <= last:
+                if theirs[k][0] > first:
+                    bounds.append((first, theirs[k][0] - 1))
+                first = max(first, theirs[k][1] + 1)
+                k += 1
+            if first <= last:
+                bounds.append((first, last))
+        return UIDSet._fromRanges(bounds)
+
+    def __eq__(self, other):
+        return isinstance(other, UIDSet) and self.ranges == other.ranges
+
+    def __ne__(self, other):
+        return not self == other
+
+    def min(self):
+        """ Return the smallest number, None if the set is empty.
+        """
+        return int(self.ranges[0]) if self.ranges else None
+
+    def max(self):
+        """ Return the largest number, None if the set is empty.
+        """
+        return int(self.ranges[-1]) if self.ranges else None
+
+    def shift(self, offset):
+        """ Return the set of the numbers plus offset, keeping those above 0,
+        such as message numbers after emails before them are expunged.
+        """
+        return UIDSet._fromRanges([(max(first + offset, 1), last + offset)
+                                   for first, last in self._pairs() if last + offset >= 1])
+
+    def split(self, length):
+        """ Return the list of disjoint sets making this one, each written as
+        a sequence set of at most length characters.
+
+        A set of few ranges stays whole, so 100000 UIDs with gaps still take
+        a few commands. [9]
+
+        Args:
+            length: The maximum length of each sequence set.
+        """
+        sets = []
+        bounds = []
+        size = -1
+        for first, last in self._pairs():
+            part = len(str(first)) if first == last else len(str(first)) + len(str(last)) + 1
+            if bounds and size + 1 + part > length:
+                sets.append(UIDSet._fromRanges(bounds))
+                bounds = []
+                size = -1
+            bounds.append((first, last))
+            size += 1 + part
+        if bounds:
+            sets.append(UIDSet._fromRanges(bounds))
+        return sets
+
+    def __str__(self):
+        return ','.join(str(first) if first == last else '%d:%d' % (first, last)
+                        for first, last in self._pairs())
+
+    def __repr__(self):
+        return '<UIDSet %s>' % self
@@ -1,7 +1,14 @@
+import os
+import select
 import socket
 import ssl
-import random
+import time
+import itertools
 import re
+import zlib
+from collections import deque
+from response import ResponseParser
+from state import MailboxState
 from util import printd
 
 # This module follows RFC2060 and RFC3501. Comments will reference the section
@@ -12,6 +19,18 @@ from util import printd
 IMAP_SSL_PORT = 993
 # Line terminator in IMAP/IMAPrev1
 CRLF = '\r\n'
+# The maximum number of bytes read from the socket at once.
+BUFFER_SIZE = 65536
+# The maximum size of a non-synchronizing literal with LITERAL-. [5, RFC 7888]
+LITERAL_MINUS_MAX = 4096
+# Compress connections with COMPRESS=DEFLATE after login, if the server
+# supports it. [RFC 4978]
+COMPRESS_DEFLATE = True
+# The zlib level of the data sent compressed.
+COMPRESS_LEVEL = 6
+# The seconds without any data from the server before a connection waiting for
+# a response is considered lost, None to wait forever. IDLE is not limited.
+TIMEOUT = 300
 
 # IMAP states. [6]
 STATES = ('NONAUTH', 'AUTH', 'SELECTED', 'LOGOUT')
@@ -33,9 +52,11 @@ COMMANDS = {
         'CHECK':        ((                   'SELECTED'          ),(None,       None  )),
         'CLOSE':        ((                   'SELECTED'          ),('AUTH',     None  )),
         'COPY':         ((                   'SELECTED'          ),(None,       None  )),
+        'COMPRESS':     ((           'AUTH', 'SELECTED'          ),(None,       None  )),
         'CREATE':       ((           'AUTH', 'SELECTED'          ),(None,       None  )),
         'DELETE':       ((           'AUTH', 'SELECTED'          ),(None,       None  )),
         'DELETEACL':    ((           'AUTH', 'SELECTED'          ),(None,       None  )),
+        'ENABLE':       ((           'AUTH'                      ),(None,       None  )),
         'EXAMINE':      ((           'AUTH', 'SELECTED'          ),('SELECTED', 'AUTH')),
         'EXPUNGE':      ((                   'SELECTED'          ),(None,       None  )),
         'FETCH':        ((                   'SELECTED'          ),(None,       None  )),
@@ -43,11 +64,13 @@ COMMANDS = {
         'GETANNOTATION':((           'AUTH', 'SELECTED'          ),(None,       None  )),
         'GETQUOTA':     ((           'AUTH', 'SELECTED'          ),(None,       None  )),
         'GETQUOTAROOT': ((           'AUTH', 'SELECTED'          ),(None,       None  )),
+        'IDLE':         ((           'AUTH', 'SELECTED'          ),(None,       None  )),
         'MYRIGHTS':     ((           'AUTH', 'SELECTED'          ),(None,       None  )),
         'LIST':         ((           'AUTH', 'SELECTED'          ),(None,       None  )),
         'LOGIN':        (('NONAUTH'                              ),('AUTH',     None  )),
         'LOGOUT':       (('NONAUTH', 'AUTH', 'SELECTED', 'LOGOUT'),('LOGOUT',   None  )),
         'LSUB':         ((           'AUTH', 'SELECTED'          ),(None,       None  )),
+        'MOVE':         ((                   'SELECTED'          ),(None,       None  )),
         'NAMESPACE':    ((           'AUTH', 'SELECTED'          ),(None,       None  )),
         'NOOP':         (('NONAUTH', 'AUTH', 'SELECTED', 'LOGOUT'),(None,       None  )),
         'PARTIAL':      ((                   'SELECTED'          ),(None,       None  )),
@@ -64,11 +87,16 @@ COMMANDS = {
         'SUBSCRIBE':    ((           'AUTH', 'SELECTED'          ),(None,       None  )),
         'THREAD':       ((                   'SELECTED'          ),(None,       None  )),
         'UID':          ((                   'SELECTED'          ),(None,       None  )),
+        'UNSELECT':     ((                   'SELECTED'          ),('AUTH',     None  )),
         'UNSUBSCRIBE':  ((           'AUTH', 'SELECTED'          ),(None,       None  ))
         }
 
-# Regular expression to match IMAP4 iteral. [4.3]
-Literal = re.compile(r'.*{(?P<size>\d+)}$')
+# The functions called with each completed Command, for instrumentation. While
+# it is empty, commands are not measured. See addHook().
+HOOKS = []
+
+# Regular expression to match the CAPABILITY response code. [7.1]
+Capability = re.compile(r'\[CAPABILITY (?P<capabilities>[^\]]*)\]')
 
 class Error(Exception): pass
 
@@ -77,15 +105,219 @@ class Error(Exception): pass
 # the command is in.
 class InvalidCommandError(Error): pass
 
+# This exception occors if the connection is closed before a command completes.
+class AbortError(Error): pass
+
+class Literal(object):
+    """ A literal parameter of a command. [4.3]
+
+    The data is streamed to the server when the command is sent, so a big
+    email is never held in memory.
+
+    Arguments:
+        data: A string, a file object, or an iterable of strings.
+        size: The number of bytes of the data.
+    """
+
+    def __init__(self, data, size=None):
+        """ Construct the literal.
+
+        Args:
+            data: A string, a file object read from its current position, or
+                  an iterable of strings.
+            size: The number of bytes of the data, which must be given for an
+                  iterable.
+        """
+        if size is None:
+            if isinstance(data, str):
+                size = len(data)
+            elif hasattr(data, 'fileno'):
+                size = os.fstat(data.fileno()).st_size - data.tell()
+            else:
+                raise Error('The size of an iterable literal must be given')
+        self.data = data
+        self.size = size
+
+    def chunks(self):
+        """ Iterate over the data in chunks of at most BUFFER_SIZE bytes.
+
+        The chunks of a string are memoryview slices of it, not copies.
+        """
+        if isinstance(self.data, str):
+            if len(self.data) <= BUFFER_SIZE:
+                yield self.data
+                return
+            view = memoryview(self.data)
+            for i in range(0, len(self.data), BUFFER_SIZE):
+                yield view[i:i + BUFFER_SIZE]
+        elif hasattr(self.data, 'read'):
+            while 1:
+                chunk = self.data.read(BUFFER_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        else:
+            for chunk in self.data:
+                yield chunk
+
+class Command(object):
+    """ A tagged IMAP command sent to the server.
+
+    A command is returned as soon as it is written to the socket, so several
+    commands can be in flight at once. Untagged responses are collected by the
+    oldest pending command, since the server answers commands in order.
+
+    Arguments:
+        server:       The IMAPServer the command was sent through.
+        tag:          The tag identifying the command.
+        name:         The IMAP command name.
+        params:       The parameters sent with the command.
+        sink:         The function deciding where the literals of its untagged
+                      responses go, see ResponseParser.
+        untagged:     A list of untagged responses received for the command.
+        continuation: The last continuation request ('+') from the server.
+        type:         The completion result (OK/NO/BAD), None while pending.
+                      It is ABORT if the connection was lost.
+        data:         The text following the completion result.
+        callbacks:    The functions called with the command once completed.
+        selected:     The MailboxState built from the untagged responses of
+                      SELECT or EXAMINE, None for other commands.
+
+    The following are measured only if hooks are installed, see addHook().
+        sent:      The time the command was sent, None if not measured.
+        first:     The time its first response was received.
+        completed: The time its completion result was received.
+        bytes_out: The number of bytes sent, with the literals.
+        bytes_in:  The number of bytes of its responses, with the literals.
+        literals:  The list of the sizes of the literals received.
+        responses: The number of untagged responses received.
+    """
+
+    def __init__(self, server, tag, name, params=(), sink=None):
+        self.server = server
+        self.tag = tag
+        self.name = name
+        self.params = params
+        self.sink = sink
+        self.untagged = []
+        self.continuation = None
+        self.type = None
+        self.data = None
+        self.callbacks = []
+        self.selected = None
+        self.sent = None
+        self.first = None
+        self.completed = None
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.literals = []
+        self.responses = 0
+
+    def done(self):
+        """ Return true if the tagged completion response was received.
+        """
+        return self.type is not None
+
+    def result(self):
+        """ Wait for the command to complete and return its response.
+
+        Raise:
+            InvalidCommandError: If the server rejected the command (BAD).
+
+        Returns:
+            A tuple of three elements, as returned by IMAPServer._interact.
+        """
+        if not self.done():
+            self.server.wait(self)
+        if self.type == 'BAD':
+            raise InvalidCommandError(self.data)
+        if self.type == 'ABORT':
+            raise AbortError(self.data)
+        return self.type, self.data, self.untagged
+
+    def add_done_callback(self, callback):
+        """ Call the given function with this command once it completes.
+
+        Args:
+            callback: A function taking the completed Command.
+        """
+        if self.done():
+            callback(self)
+        else:
+            self.callbacks.append(callback)
+
+def _bytes(data):
+    """ Return the data as a string, copying a memoryview.
+    """
+    return data.tobytes() if isinstance(data, memoryview) else data
+
+def _silentStore(handle):
+    """ Return true if a Command is STORE or UID STORE with .SILENT.
+    """
+    params = handle.params
+    if handle.name == 'UID' and params and params[0].upper() == 'STORE':
+        params = params[1:]
+    elif handle.name != 'STORE':
+        return False
+    return len(params) > 1 and params[1].upper().endswith('.SILENT')
+
+def addHook(hook):
+    """ Install a function called with each completed Command, with its
+    timing and byte counts measured.
+
+    Commands are measured only while a hook is installed, so instrumentation
+    costs nothing otherwise. Hooks are called on the thread reading the
+    responses, and must not send commands.
+
+    Args:
+        hook: A function taking the completed Command.
+    """
+    HOOKS.append(hook)
+
+def removeHook(hook):
+    """ Uninstall a function installed by addHook().
+    """
+    if hook in HOOKS:
+        HOOKS.remove(hook)
+
+def appendParams(mailbox, messages):
+    """ Return the parameters of APPEND for the given emails.
+
+    Args:
+        mailbox:  The mailbox name.
+        messages: Tuples of flags, date and data. Flags is a list of flags and
+                  date an INTERNALDATE string, both None if not given. The data
+                  is a Literal, a string or a file object.
+    """
+    params = [mailbox]
+    for flags, date, data in messages:
+        if flags is not None:
+            params.append('(' + ' '.join(flags) + ')')
+        if date is not None:
+            params.append('"' + date + '"')
+        params.append(data if isinstance(data, Literal) else Literal(data))
+    return params
+
 class IMAPServer(object):
     """ The IMAP server with simplified API.
 
     This class provide convenient api for IMAP client.
 
     Arguments:
-        sock:     The client socket connets to the IMAP server.
-        buffer:   The file like object stores the IMAP server response.
-        state:    The current state.
+        sock:         The client socket connets to the IMAP server.
+        state:        The current state.
+        mailbox:      The selected mailbox, None if no mailbox is selected.
+        uidvalidity:  The UIDVALIDITY of the opened mailbox, None if unknown.
+        selected:     The MailboxState of the mailbox opened by SELECT or
+                      EXAMINE, None if no mailbox is opened.
+        capabilities: The set of capabilities, None if not asked yet.
+        enabled:      The set of extensions enabled by ENABLE.
+        pending:      The commands sent but not completed, oldest first.
+        greeting:     True while the initial greeting is not received.
+        parser:       The ResponseParser framing the received data.
+        bye:          The BYE response of the server, None if not received.
+        lost:         The reason the connection was lost, None while it is
+                      usable.
     """
 
     def __init__(self, host):
@@ -104,13 +336,42 @@ class IMAPServer(object):
 
         # Establishment of a client/server network connection.
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.settimeout(TIMEOUT)
         self.sock = ssl.wrap_socket(self.sock)
         self.sock.connect((host, IMAP_SSL_PORT))
-        self.buffer = self.sock.makefile('rb')
+        self._setup()
 
         # Receive an initial greeting from the server.
-        tag, init_greeting = self._recv_line()
-        # Set the initial state by initial greeting. [3]
+        self.wait()
+
+    def _setup(self):
+        """ Initialize the command and response bookkeeping.
+        """
+        self.state = 'NONAUTH'
+        self.mailbox = None
+        self.uidvalidity = None
+        self.selected = None
+        self.capabilities = None
+        self.enabled = set()
+        # Tags are taken from a monotonic counter, so they never collide.
+        self.tags = itertools.count(1)
+        self.pending = deque()
+        self.greeting = True
+        self.parser = ResponseParser(self._on_response, self._literal_sink)
+        # The buffer the data is received into, reused for each reception.
+        self.inbuf = bytearray(BUFFER_SIZE)
+        # The zlib streams of a compressed connection. [RFC 4978]
+        self.deflater = None
+        self.inflater = None
+        self.bye = None
+        self.lost = None
+
+    def _greet(self, init_greeting):
+        """ Set the initial state by initial greeting. [3]
+
+        Args:
+            init_greeting: The greeting information.
+        """
         type = init_greeting.split(' ')[0]
         if type == 'PREAUTH':
             self.state = 'AUTH'
@@ -141,75 +402,406 @@ class IMAPServer(object):
             response. Tag and tagged response are strings, and untagged response
             is a list of string.
         """
+        return self.send(command, *params).result()
 
-        # Send client command to IMAP4 server.
+    def send(self, command, *params, **options):
+        """ Send one command without waiting for its response.
+
+        Several commands can be sent before any response is read, which saves
+        one round-trip per command. The state is checked against the state the
+        connection will be in once all pending commands have succeeded.
+
+        A Literal parameter is sent as a literal. With LITERAL+, it follows its
+        size at once. Otherwise the command waits for the continuation request
+        of the server before the data is sent, and the rest of the command is
+        not sent if the server rejects it.
+
+        Args:
+            command: The IMAP4 command.
+            params:  The parameter passed with command, strings or Literals.
+            options: sink, the function deciding where the literals of the
+                     untagged responses go, see ResponseParser.
+
+        Raise:
+            InvalidCommandError: If a non-existing command is given or invaild
+                                 state for the command is in.
+            AbortError:          If the connection is lost.
+
+        Returns:
+            The Command sent. Call its result() for the response.
+        """
+        if self.lost is not None:
+            raise AbortError(self.lost)
         command = command.upper()
         if command not in COMMANDS:
             raise InvalidCommandError('Command ' + command + ' dees not exists')
-        if self.state not in COMMANDS[command][0]:
-            raise InvalidCommandError('Command ' + command + ' is not available in ' + self.state + ' state')
+        state = self._projected_state()
+        if state not in COMMANDS[command][0]:
+            raise InvalidCommandError('Command ' + command + ' is not available in ' + state + ' state')
         # Generate a different tag for each command. [2.2.1]
-        # The tag is generated to be a random 6-bit hexadecimal value.
-        tag = hex(random.randint(1048576, 16777215))[2:]
-        params = ' ' + ' '.join(params) if len(params) > 0 else ''
-        msg = tag + ' ' + command + params + CRLF
-        self.sock.send(msg)
-        printd('\n' + msg)
-
-        # Receive server response.
-        tagged_response = ''
-        untagged_response = []
-        while 1:
-            curr_tag, info = self._recv_line()
-            # Decide action by type.
-            if curr_tag == '*':
-                # Add quoted string if literal.
-                match = re.match(Literal, info)
-                if match:
-                    size = match.group('size')
-                    # Read the literal and the tail.
-                    quoted = self.buffer.read(int(size)) + self.buffer.readline()
-                    printd(quoted)
-                    info += CRLF + quoted[:-2]
-                untagged_response.append(info)
-            elif curr_tag == '+':
-                # [7.5]
-                self._recv_line()
-            elif curr_tag == tag:
-                tagged_response = info
-                break
-            else:
-                raise InvalidCommandError('Receive invalid tagged response')
+        tag = 'A%04d' % next(self.tags)
+        handle = Command(self, tag, command, params, options.get('sink'))
+        if command in ('SELECT', 'EXAMINE'):
+            # The untagged responses of the command describe the new mailbox.
+            # [6.3.1]
+            handle.selected = MailboxState(params[0])
+        if HOOKS:
+            handle.sent = time.time()
+        self.pending.append(handle)
+        # The pieces not written yet. The command is written by one write,
+        # unless it waits for a continuation or streams a big literal.
+        out = [tag + ' ' + command]
+        for param in params:
+            if not isinstance(param, Literal):
+                out.append(' ' + param)
+                continue
+            nonsync = self._nonsync(param.size)
+            out.append(' {%d%s}' % (param.size, '+' if nonsync else '') + CRLF)
+            if not nonsync:
+                self._flush(out, handle)
+                if not self._continuation(handle):
+                    return handle
+                handle.continuation = None
+            if param.size <= BUFFER_SIZE:
+                out.extend(_bytes(chunk) for chunk in param.chunks())
+                continue
+            self._flush(out, handle)
+            # The last chunk goes with the rest of the command, so no small
+            # write waits for an acknowledgement. [RFC 896]
+            last = None
+            for chunk in param.chunks():
+                if last is not None:
+                    handle.bytes_out += len(last)
+                    self._write(last)
+                last = chunk
+            if last is not None:
+                out.append(_bytes(last))
+        out.append(CRLF)
+        self._flush(out, handle)
+        return handle
+
+    def _flush(self, out, handle):
+        """ Write the pieces of a command not written yet, as one buffer.
+
+        Args:
+            out:    The list of pieces, emptied.
+            handle: The Command sent.
+        """
+        msg = ''.join(out)
+        del out[:]
+        handle.bytes_out += len(msg)
+        self._write(msg)
+        if __debug__:
+            printd('\n' + msg)
+
+    def _nonsync(self, size):
+        """ Return true if a literal of the given size can be sent without
+        waiting for the continuation request. [RFC 7888]
+        """
+        if self.capabilities is None:
+            return False
+        return 'LITERAL+' in self.capabilities or \
+               ('LITERAL-' in self.capabilities and size <= LITERAL_MINUS_MAX)
+
+    def _continuation(self, handle):
+        """ Wait for a continuation request for the given command.
+
+        Returns:
+            False if the command completed instead.
+        """
+        while handle.continuation is None and not handle.done():
+            self.poll()
+        return not handle.done()
+
+    def _projected_state(self):
+        """ Return the state after all pending commands have succeeded.
+        """
+        state = self.state
+        for handle in self.pending:
+            state = COMMANDS[handle.name][1][0] or state
+        return state
+
+    def wait(self, handle=None):
+        """ Read responses until the given command has completed.
+
+        Responses for other pending commands are dispatched to them on the
+        way. If no command is given, wait for all pending commands.
+
+        Args:
+            handle: The Command to wait for.
+        """
+        while (self.greeting or self.pending) and (handle is None or not handle.done()):
+            self.poll()
+
+    def _write(self, msg):
+        """ Write the given message to the server.
+
+        Raise:
+            AbortError: If the connection is lost.
+        """
+        try:
+            self.sock.sendall(self._deflate(msg))
+        except socket.error, e:
+            self._lose(str(e) or 'Connection timed out')
+
+    def _deflate(self, msg):
+        """ Return the given message as written on a compressed connection.
+
+        Each message is flushed, so the server can read it without waiting for
+        more data. [4, RFC 4978]
+        """
+        if self.deflater is None:
+            return msg
+        return self.deflater.compress(_bytes(msg)) + self.deflater.flush(zlib.Z_SYNC_FLUSH)
 
+    def poll(self, timeout=None):
+        """ Receive the available data and dispatch the complete responses.
+
+        It blocks until some data is received. Together with the untagged
+        responses of a pending command, it allows to consume the responses as
+        they arrive.
+
+        Args:
+            timeout: The maximum seconds to wait, or None to wait forever.
+
+        Raise:
+            AbortError: If the connection is closed by the server, broken or
+                        silent for TIMEOUT seconds.
+        """
+        # Decrypted data may be left in the TLS layer, unseen by select().
+        if timeout is not None and not self.sock.pending():
+            if not select.select([self.sock], [], [], timeout)[0]:
+                return
+        try:
+            size = self.sock.recv_into(self.inbuf)
+        except socket.timeout:
+            self._lose('Connection timed out')
+        except socket.error, e:
+            self._lose(str(e))
+        if not size:
+            self._lose('Connection closed by the server')
+        self._feed(self.inbuf, size)
+
+    def _lose(self, reason):
+        """ Fail all pending commands and close the lost connection.
+
+        Raise:
+            AbortError: Always, with the reason.
+        """
+        self._abort(reason)
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+        raise AbortError(self.lost)
+
+    def _feed(self, data, size):
+        """ Frame the received data into complete responses.
+
+        Args:
+            data: The receive buffer.
+            size: The number of bytes received at the start of the buffer.
+        """
+        if self.inflater is not None:
+            data = self.inflater.decompress(buffer(data, 0, size))
+            size = len(data)
+        self.parser.feed(data, size)
+
+    def _on_response(self, tag, info):
+        """ Handle one complete response as soon as it is framed.
+
+        Args:
+            tag:  The response tag.
+            info: The response information.
+        """
+        if __debug__:
+            printd(tag + ' ' + info + CRLF)
+        if self.greeting:
+            self.greeting = False
+            self._greet(info)
+        else:
+            self._dispatch(tag, info)
+
+    def _literal_sink(self, prefix, size):
+        """ Decide where a literal goes by the command receiving it.
+
+        Untagged responses belong to the oldest pending command.
+        """
+        if not self.pending:
+            return None
+        handle = self.pending[0]
+        if handle.sent is not None:
+            handle.literals.append(size)
+        if handle.sink is not None:
+            writer = handle.sink(prefix, size)
+            # The literal is not left in the response to be counted.
+            if writer is not None and handle.sent is not None:
+                handle.bytes_in += size
+            return writer
+        return None
+
+    def _dispatch(self, tag, info):
+        """ Deliver one response to the pending command it belongs to.
+
+        Args:
+            tag:  The response tag ('*', '+' or a command tag).
+            info: The response information.
+        """
+        if tag == '*':
+            # The server closes the connection after BYE. [7.1.5]
+            if info[:4].upper() == 'BYE ':
+                self.bye = info
+            # The mailbox being opened comes first, then the opened one.
+            if self.pending and self.pending[0].selected is not None:
+                self.pending[0].selected.update(info)
+            elif self.selected is not None:
+                self.selected.update(info)
+            if self.pending:
+                handle = self.pending[0]
+                handle.untagged.append(info)
+                if handle.sent is not None:
+                    self._measure(handle, tag, info)
+                    handle.responses += 1
+        elif tag == '+':
+            # [7.5]
+            if self.pending:
+                handle = self.pending[-1]
+                handle.continuation = info
+                if handle.sent is not None:
+                    self._measure(handle, tag, info)
+        else:
+            # Commands are normally completed in order, but the server is
+            # allowed to complete them out of order. [5.5]
+            for handle in self.pending:
+                if handle.tag == tag:
+                    self.pending.remove(handle)
+                    if handle.sent is not None:
+                        self._measure(handle, tag, info)
+                    self._complete(handle, info)
+                    return
+            raise InvalidCommandError('Receive invalid tagged response')
+
+    def _measure(self, handle, tag, info):
+        """ Count one response of a measured command.
+        """
+        if handle.first is None:
+            handle.first = time.time()
+        handle.bytes_in += len(tag) + len(info) + 3
+
+    def _complete(self, handle, tagged_response):
+        """ Record the completion result of a command and update the state.
+
+        Args:
+            handle:          The completed Command.
+            tagged_response: The tagged response information.
+        """
         # Analysis and interact with server response.
         # Check response type.
-        type, tagged_data = tagged_response.split(' ', 1)
-        if type == 'BAD':
-            raise InvalidCommandError(tagged_data)
+        handle.type, handle.data = (tagged_response.split(' ', 1) + [''])[:2]
         # Update current states.
+        # Remember the enabled extensions. [3.1, RFC 5161]
+        if handle.name == 'ENABLE' and handle.type == 'OK':
+            for info in handle.untagged:
+                words = info.upper().split(' ')
+                if words[0] == 'ENABLED':
+                    self.enabled.update(words[1:])
         new_state = {
-                'OK': COMMANDS[command][1][0],
-                'NO': COMMANDS[command][1][1]
-                }.get(type, None)
+                'OK': COMMANDS[handle.name][1][0],
+                'NO': COMMANDS[handle.name][1][1]
+                }.get(handle.type, None)
         if new_state != None:
-            self.state = COMMANDS[command][1][0]
-            printd('\n[current state swith to ' + self.state + ']\n')
+            self.state = new_state
+            if __debug__:
+                printd('\n[current state swith to ' + self.state + ']\n')
+            # The capabilities may change after login. [6.2] Servers often
+            # send the new ones with the completion result.
+            if handle.name in ('LOGIN', 'AUTHENTICATE'):
+                self.capabilities = None
+                match = Capability.search(handle.data)
+                if handle.type == 'OK' and match:
+                    self.capabilities = set(match.group('capabilities').upper().split(' '))
+            # Remember the selected mailbox. A mailbox opened by EXAMINE is
+            # read-only, so it is not remembered.
+            if handle.name == 'SELECT' and handle.type == 'OK':
+                self.mailbox = handle.params[0]
+            else:
+                self.mailbox = None
+            # Remember the state and the UIDVALIDITY of the opened mailbox.
+            # [7.1]
+            self.selected = handle.selected if handle.type == 'OK' else None
+            self.uidvalidity = None if self.selected is None else self.selected.uidvalidity
+        # The flags changed by STORE with .SILENT are not reported. [6.4.6]
+        if self.selected is not None and handle.type == 'OK' and _silentStore(handle):
+            self.selected.forgetFlags()
+        # The responses following a successful COMPRESS are compressed, and so
+        # are the commands. [3, RFC 4978]
+        if handle.name == 'COMPRESS' and handle.type == 'OK':
+            self.deflater = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+            self.inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+        for callback in handle.callbacks:
+            callback(handle)
+        if handle.sent is not None:
+            handle.completed = time.time()
+            for hook in HOOKS:
+                hook(handle)
+
+    def _abort(self, reason):
+        """ Fail all pending commands after the connection is lost.
+
+        Args:
+            reason: The reason the connection is lost.
+        """
+        if self.bye is not None:
+            reason += ' (' + self.bye + ')'
+        self.lost = reason
+        self.state = 'LOGOUT'
+        self.selected = None
+        while self.pending:
+            self._complete(self.pending.popleft(), 'ABORT ' + reason)
+
+    def _done(self, idle):
+        """ End an IDLE command and wait for its completion. [3, RFC 2177]
+
+        Args:
+            idle: The IDLE Command. Its untagged responses not consumed yet
+                  stay in it.
+        """
+        # DONE may only be sent after the continuation request.
+        if self._continuation(idle):
+            self._write('DONE' + CRLF)
+            printd('\nDONE' + CRLF)
+        return idle.result()
+
+    def capable(self, capability):
+        """ Return true if the server advertises the given capability.
+
+        The capabilities are asked once and remembered.
+
+        Args:
+            capability: The capability name, such as 'IDLE'.
+        """
+        if self.capabilities is None:
+            self.capabilities = set()
+            for info in self.CAPABILITY()[2]:
+                words = info.upper().split(' ')
+                if words[0] == 'CAPABILITY':
+                    self.capabilities.update(words[1:])
+        return capability.upper() in self.capabilities
+
+    def compress(self):
+        """ Compress the connection with DEFLATE, if the server supports it.
+        [RFC 4978]
 
-        # Return response for further processing in higher level functions.
-        return type, tagged_data, untagged_response
+        It is called after login, once no other command is pending, since the
+        server compresses everything after its response.
 
-    def _recv_line(self):
-        """ Receive one response line with ending CRLF removed.
+        Returns:
+            True if the connection is compressed.
         """
-        msg_line = ''
-        # Retrieve an complete line end with CRLF.
-        while 1:
-            line = self.buffer.readline()
-            msg_line += line
-            if line[-2:] == CRLF: break
-        printd(msg_line)
-        # Remove the ending CRLF.
-        return msg_line[:-2].split(' ', 1)
+        if self.deflater is None and self.capable('COMPRESS=DEFLATE'):
+            self.wait()
+            self.COMPRESS('DEFLATE')
+        return self.deflater is not None
 
     # IMAP4 Commands
     # Each of the following fucntion reacting the same as the IMAP command with
@@ -220,41 +812,63 @@ class IMAPServer(object):
     # Because of time, only simple commands have been implemented.
     # TODO : complete the simplified command (e.g. SELECT without randomly),
     #        implement other commands.
-    #def APPEND(): pass
+    def APPEND(self, mailbox, *messages):
+        """ Append emails to a mailbox. [6.3.11]
+
+        Several emails are appended by one command with MULTIAPPEND, which
+        the caller must check. [RFC 3502]
+
+        Args:
+            mailbox:  The mailbox name.
+            messages: Tuples of flags, date and data, see appendParams.
+        """
+        return self._interact('APPEND', *appendParams(mailbox, messages))
     #def AUTHENTICATE(): pass
     def CAPABILITY(self):                        return self._interact('CAPABILITY')
     def CHECK(self):                             return self._interact('CHECK')
     def CLOSE(self):                             return self._interact('CLOSE')
     def COPY(self, messages, mailbox):           return self._interact('COPY', messages, mailbox)
+    def COMPRESS(self, mechanism):               return self._interact('COMPRESS', mechanism)
     def CREATE(self, mailbox):                   return self._interact('CREATE', mailbox)
     def DELETE(self, mailbox):                   return self._interact('DELETE', mailbox)
     def DELETEACL(self, mailbox):                return self._interact('DELETEACL', mailbox)
+    def ENABLE(self, *capabilities):             return self._interact('ENABLE', *capabilities)
     def EXPUNGE(self):                           return self._interact('EXPUNGE')
     def FETCH(self, messages, parts):            return self._interact('FETCH', messages, parts)
     def GETACL(self):                            return self._interact('GETACL')
     def GETANNOTATION(self):                     return self._interact('GETANNOTATION')
     def GETQUOTAROOT(self, mailbox):             return self._interact('GETQUOTAROOT')
-    def LIST(self, directory='""', pattern='*'): return self._interact('LIST', directory, pattern)
+    def IDLE(self):                              return self.send('IDLE')
+    def DONE(self, idle):                        return self._done(idle)
+    def LIST(self, directory='""', pattern='*', *returns):
+        """ List mailboxes. Return options, such as 'STATUS (MESSAGES)', need
+        LIST-EXTENDED. [RFC 5258]
+        """
+        if returns:
+            return self._interact('LIST', directory, pattern, 'RETURN', '(' + ' '.join(returns) + ')')
+        return self._interact('LIST', directory, pattern)
     def LOGIN(self, username, password):         return self._interact('LOGIN', username, password)
     def LOGOUT(self):                            return self._interact('LOGOUT')
     def LSUB(self, directory='""', pattern='*'): return self._interact('LSUB', directory, pattern)
+    def MOVE(self, messages, mailbox):           return self._interact('MOVE', messages, mailbox)
     def MYRIGHTS(self, mailbox):                 return self._interact('MYRIGHTS', mailbox)
     def NAMESPACE(self):                         return self._interact('NAMESPACE')
     def NOOP(self):                              return self._interact('NOOP')
     def PARTIAL(self, num, part, start, length): return self._interact('PARTIAL', num, part, start, length)
     def PROXYAUTH(self, user):                   return self._interact('PROXYAUTH', user)
     def RENAME(self, old_mailbox, new_mailbox):  return self._interact('RENAME', old_mailbox, new_mailbox)
-    #def SEARCH(self): pass
+    def SEARCH(self, *criteria):                 return self._interact('SEARCH', *criteria)
     def SELECT(self, mailbox):                   return self._interact('SELECT', mailbox)
     def SELECTACL(self, mailbox, who, what):     return self._interact('SELECT', mailbox, who, what)
     def SETANNOTATION(self, *annotations):       return self._interact('SETANNOTATION', *annotations)
     def SETQUOTA(self, root, limits):            return self._interact('SETQUOTA', root, limits)
-    #def SORT(self): pass
-    def STATUS(self, mailbox, names):            return self._interact('STATES', mailbox, names)
-    #def STORE(self, messages, command, flags): pass
+    def SORT(self, keys, charset, *criteria):    return self._interact('SORT', keys, charset, *criteria)
+    def STATUS(self, mailbox, names):            return self._interact('STATUS', mailbox, names)
+    def STORE(self, messages, command, flags):   return self._interact('STORE', messages, command, flags)
     def SUBSCRIBE(self, mailbox):                return self._interact('SUBSCRIBE', mailbox)
-    #def THREAD(): pass
-    #def UID(self): pass
+    def THREAD(self, algorithm, charset, *criteria): return self._interact('THREAD', algorithm, charset, *criteria)
+    def UID(self, command, *params):             return self._interact('UID', command, *params)
+    def UNSELECT(self):                          return self._interact('UNSELECT')
     def UNSUBSCRIBE(self, mailbox):              return self._interact('UNSUBSCRIBE', mailbox)
     #def xatom(self): pass
 
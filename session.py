@@ -0,0 +1,271 @@
+import errno
+import os
+import socket
+import sys
+from cStringIO import StringIO
+
+# This module keeps a shell logged in as a background session, and runs single
+# commands in it from other processes over a Unix socket:
+#
+#     ./imapCMD.py --serve work host username password
+#     ./imapCMD.py --session work ls -l /INBOX
+#     ./imapCMD.py --session work logout
+#
+# The command line arguments are sent separated by NUL bytes, and the exit
+# status of the command comes back on the first line of the reply, followed by
+# its output. The client side imports nothing of the IMAP modules, so a command
+# costs the start of the interpreter and one local round-trip.
+
+# The directory of the session sockets.
+SESSION_DIR = os.path.join(os.path.expanduser('~'), '.imapCMD', 'sessions')
+# The seconds a session waits for a command before its connection is checked
+# with NOOP. Servers may log out an idle client after 30 minutes. [5.4]
+KEEPALIVE = 300
+# The seconds a session waits for the rest of a command once a client
+# connected.
+REQUEST_TIMEOUT = 10
+# The maximum number of bytes of a command.
+REQUEST_MAX = 65536
+# The maximum number of bytes read from the socket at once.
+BUFFER_SIZE = 65536
+
+class Error(Exception): pass
+
+def path(name):
+    """ Return the path of the socket of a session.
+
+    Raise:
+        Error: If the name is not a plain file name.
+    """
+    if not name or name.startswith('.') or '/' in name or '\0' in name:
+        raise Error(name + ': Invalid session name')
+    return os.path.join(SESSION_DIR, name + '.sock')
+
+def call(name, command):
+    """ Run one command in a session.
+
+    Args:
+        name:    The session name.
+        command: The list of the command and its arguments, such as
+                 ['ls', '-l'].
+
+    Raise:
+        Error: If the session is not running.
+
+    Returns:
+        A tuple of the exit status of the command and its output.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(path(name))
+        except socket.error, e:
+            if e.errno in (errno.ENOENT, errno.ECONNREFUSED):
+                raise Error('No session ' + name + ', start it with --serve ' + name)
+            raise
+        sock.sendall('\0'.join(command))
+        sock.shutdown(socket.SHUT_WR)
+        reply = _readAll(sock)
+    finally:
+        sock.close()
+    if '\n' not in reply:
+        raise Error('Session ' + name + ' ended')
+    status, output = reply.split('\n', 1)
+    return int(status), output
+
+def start(name, create):
+    """ Start a session in a background process.
+
+    The process is detached from the terminal. It logs in first, so a failed
+    login is reported here.
+
+    Args:
+        name:   The session name.
+        create: The function returning the imapCMD.Cmd of the session, called
+                in the background process.
+
+    Raise:
+        Error: If the session is running already or cannot start.
+    """
+    # The socket is bound before the login, so two sessions of the same name
+    # never start.
+    sock = _listen(path(name))
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid:
+        sock.close()
+        os.close(write)
+        with os.fdopen(read) as pipe:
+            message = pipe.read()
+        os.waitpid(pid, 0)
+        if message:
+            raise Error(message)
+        return
+    # The second fork leaves a process which is not a session leader, so it
+    # never gets a controlling terminal again.
+    try:
+        os.close(read)
+        os.setsid()
+        if os.fork():
+            os._exit(0)
+        cmd = create()
+    except BaseException, e:
+        try:
+            os.unlink(path(name))
+        except OSError:
+            pass
+        os.write(write, str(e) or e.__class__.__name__)
+        os._exit(1)
+    os.close(write)
+    null = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(null, fd)
+    try:
+        SessionServer(name, cmd, sock).serve()
+    finally:
+        os._exit(0)
+
+def main(argv):
+    """ Run the command of the command line arguments in a session, print its
+    output, and return its exit status.
+
+    Args:
+        argv: The session name followed by the command and its arguments.
+    """
+    if len(argv) < 2:
+        sys.stderr.write('imapCMD: --session: A session name and a command are needed\n')
+        return 2
+    try:
+        status, output = call(argv[0], argv[1:])
+    except (Error, socket.error), e:
+        sys.stderr.write('imapCMD: --session: ' + str(e) + '\n')
+        return 2
+    sys.stdout.write(output)
+    return status
+
+class SessionServer(object):
+    """ The server of a background session.
+
+    The commands of the clients run one at a time in the same shell, so they
+    share its connection and its current working directory.
+
+    Arguments:
+        name: The session name.
+        cmd:  The imapCMD.Cmd running the commands.
+        sock: The listening Unix socket.
+    """
+
+    def __init__(self, name, cmd, sock):
+        self.name = name
+        self.cmd = cmd
+        self.sock = sock
+
+    def serve(self):
+        """ Run the commands of the clients until one ends the shell, such as
+        logout.
+        """
+        self.sock.settimeout(KEEPALIVE)
+        try:
+            while 1:
+                try:
+                    conn = self.sock.accept()[0]
+                except socket.timeout:
+                    self._keepalive()
+                    continue
+                try:
+                    if not self._handle(conn):
+                        return
+                except (Error, socket.error):
+                    # The client went away or sent a bad command.
+                    pass
+                finally:
+                    conn.close()
+        finally:
+            self.sock.close()
+            try:
+                os.unlink(path(self.name))
+            except OSError:
+                pass
+
+    def _handle(self, conn):
+        """ Run the command of one client and send back its exit status and
+        output.
+
+        Returns:
+            False once the shell ended, True otherwise.
+        """
+        conn.settimeout(REQUEST_TIMEOUT)
+        command = _readAll(conn, REQUEST_MAX).split('\0')
+        output = StringIO()
+        stdout, sys.stdout = sys.stdout, output
+        running = True
+        try:
+            ok = self.cmd.execute(command)
+        except SystemExit:
+            running = False
+            ok = True
+        except Exception, e:
+            # The session outlives a failed command.
+            output.write('imapCMD: ' + command[0] + ': ' + str(e) + '\n')
+            ok = False
+        finally:
+            sys.stdout = stdout
+        conn.settimeout(None)
+        conn.sendall(('0' if ok else '1') + '\n' + output.getvalue())
+        return running
+
+    def _keepalive(self):
+        """ Check the idle connection with NOOP, which also brings the state
+        of the selected mailbox up to date.
+        """
+        try:
+            self.cmd.client.noop()
+        except Exception:
+            # The next command connects again.
+            pass
+
+def _listen(filename):
+    """ Return a Unix socket listening at a path, readable by its user only.
+
+    A socket left by a session which did not end cleanly is replaced.
+
+    Raise:
+        Error: If a session is listening at the path.
+    """
+    directory = os.path.dirname(filename)
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0700)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    if os.path.exists(filename):
+        try:
+            sock.connect(filename)
+        except socket.error:
+            os.unlink(filename)
+        else:
+            sock.close()
+            raise Error('Session ' + os.path.basename(filename)[:-5] + ' is running already')
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0177)
+    try:
+        sock.bind(filename)
+    finally:
+        os.umask(umask)
+    sock.listen(8)
+    return sock
+
+def _readAll(sock, limit=None):
+    """ Read from a socket until the other side shuts down writing.
+
+    Raise:
+        Error: If more than limit bytes are sent.
+    """
+    chunks = []
+    size = 0
+    while 1:
+        chunk = sock.recv(BUFFER_SIZE)
+        if not chunk:
+            return ''.join(chunks)
+        size += len(chunk)
+        if limit is not None and size > limit:
+            raise Error('Command too long')
+        chunks.append(chunk)
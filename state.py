@@ -0,0 +1,200 @@
+import re
+from array import array
+from response import Atom, LiteralToken, Quoted
+from seqset import UIDSet
+
+# This module keeps the state of the selected mailbox as the server reports it.
+# Every untagged response updates the state, whichever command it came with,
+# so the number of emails, and the UIDs and flags of the emails already seen,
+# are known without asking the server again. [7.3, 7.4]
+
+# Regular expression to match an untagged FETCH response, up to its data items.
+Fetch = re.compile(r'(?P<seq>\d+) FETCH \(')
+# Regular expression to match the UID or FLAGS data item of a FETCH response.
+# [7.4.2]
+Item = re.compile(r'UID (?P<uid>\d+)|FLAGS \((?P<flags>[^)]*)\)', re.I)
+# Regular expression to match the UIDVALIDITY and UIDNEXT response codes. [7.1]
+ResponseCode = re.compile(r'OK \[(?P<name>UIDVALIDITY|UIDNEXT) (?P<value>\d+)\]', re.I)
+
+class MailboxState(object):
+    """ The state of a mailbox opened by SELECT or EXAMINE.
+
+    The emails are kept by message number in two arrays, so an EXPUNGE
+    response shifts the following emails as it does on the server. [7.4.1]
+
+    Arguments:
+        name:        The mailbox name.
+        exists:      The number of emails.
+        recent:      The number of emails with the \\Recent flag.
+        uidvalidity: The UIDVALIDITY, None if unknown.
+        uidnext:     The UIDNEXT, None if unknown. It grows past the UIDs of
+                     the new emails seen.
+        flags:       The list of flags defined in the mailbox.
+        uids:        The array of the UIDs of the emails by message number
+                     minus one, 0 where unknown.
+        msgflags:    The list of the flags of the emails by message number
+                     minus one, None where unknown.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.exists = 0
+        self.recent = 0
+        self.uidvalidity = None
+        self.uidnext = None
+        self.flags = []
+        self.uids = array('L')
+        self.msgflags = []
+
+    def update(self, info):
+        """ Update the state from one untagged response.
+
+        Args:
+            info: The untagged response information, such as '12 EXISTS'.
+        """
+        words = info.split(' ', 2)
+        if words[0].isdigit() and len(words) > 1:
+            num, name = int(words[0]), words[1].upper()
+            if name == 'FETCH':
+                self._fetch(info)
+            elif name == 'EXISTS':
+                self._resize(num)
+            elif name == 'RECENT':
+                self.recent = num
+            elif name == 'EXPUNGE' and 0 < num <= self.exists:
+                del self.uids[num - 1]
+                del self.msgflags[num - 1]
+                self.exists -= 1
+            return
+        name = words[0].upper()
+        if name == 'FLAGS' and len(words) > 1:
+            self.flags = info[6:].strip('()').split()
+        elif name == 'VANISHED' and len(words) > 1:
+            # The UIDs reported while selecting with QRESYNC were expunged
+            # before, and are not counted. [3.2.10, RFC 7162]
+            if words[1].upper() != '(EARLIER)':
+                self._vanish(UIDSet.parse(words[1]))
+        elif name == 'OK':
+            match = ResponseCode.match(info)
+            if match:
+                setattr(self, match.group('name').lower(), int(match.group('value')))
+
+    def forgetFlags(self):
+        """ Forget the flags of the emails, once changed without being
+        reported, such as by STORE with .SILENT. [6.4.6]
+        """
+        self.msgflags = [None] * self.exists
+
+    def uidOf(self, num):
+        """ Return the UID of an email, None if unknown.
+
+        Args:
+            num: The message number.
+        """
+        if 0 < num <= self.exists and self.uids[num - 1]:
+            return int(self.uids[num - 1])
+        return None
+
+    def flagsOf(self, num):
+        """ Return the list of flags of an email, None if unknown.
+
+        Args:
+            num: The message number.
+        """
+        if 0 < num <= self.exists and self.msgflags[num - 1] is not None:
+            return list(self.msgflags[num - 1])
+        return None
+
+    def _resize(self, exists):
+        """ Set the number of emails. The new emails are unknown.
+        """
+        if exists > self.exists:
+            self.uids.extend(array('L', [0]) * (exists - self.exists))
+            self.msgflags.extend([None] * (exists - self.exists))
+        else:
+            # Only EXPUNGE may decrease the number. [7.3.1]
+            del self.uids[exists:]
+            del self.msgflags[exists:]
+        self.exists = exists
+
+    def _fetch(self, info):
+        """ Update the UID and flags of an email from a FETCH response.
+
+        Only the data items are scanned, and literals are skipped without
+        being copied, so a FETCH of bodies costs little.
+        """
+        match = Fetch.match(info)
+        if match is None:
+            return
+        num = int(match.group('seq'))
+        if num > self.exists:
+            self._resize(num)
+        pos, size = match.end(), len(info)
+        while pos < size and info[pos] != ')':
+            if info[pos] == ' ':
+                pos += 1
+                continue
+            item = Item.match(info, pos)
+            if item is None:
+                # Skip the name and the value of another data item.
+                pos = _skip(info, pos)
+                while pos < size and info[pos] == ' ':
+                    pos += 1
+                pos = _skip(info, pos)
+            elif item.group('uid') is not None:
+                uid = int(item.group('uid'))
+                self.uids[num - 1] = uid
+                if self.uidnext is not None and uid >= self.uidnext:
+                    self.uidnext = uid + 1
+                pos = item.end()
+            else:
+                self.msgflags[num - 1] = tuple(item.group('flags').split())
+                pos = item.end()
+
+    def _vanish(self, uids):
+        """ Remove the emails of the expunged UIDs. [3.2.10, RFC 7162]
+        """
+        keep = [i for i, uid in enumerate(self.uids) if uid not in uids]
+        exists = self.exists - len(uids)
+        if len(keep) != exists:
+            # Some expunged emails were unknown, so the message numbers of the
+            # known ones are lost.
+            self.uids = array('L')
+            self.msgflags = []
+            self.exists = 0
+            self._resize(max(exists, 0))
+            return
+        self.uids = array('L', (self.uids[i] for i in keep))
+        self.msgflags = [self.msgflags[i] for i in keep]
+        self.exists = exists
+
+def _skip(text, pos):
+    """ Return the position following the atom, string, literal or
+    parenthesized list at pos.
+    """
+    depth = 0
+    size = len(text)
+    while pos < size:
+        char = text[pos]
+        if char == '(':
+            depth += 1
+            pos += 1
+        elif char == ')':
+            if depth == 0:
+                return pos
+            depth -= 1
+            pos += 1
+        elif char == ' ':
+            pos += 1
+        elif char == '"':
+            match = Quoted.match(text, pos)
+            pos = match.end() if match else size
+        elif char == '{' and LiteralToken.match(text, pos):
+            match = LiteralToken.match(text, pos)
+            pos = match.end() + int(match.group('size'))
+        else:
+            match = Atom.match(text, pos)
+            pos += len(match.group()) if match else 1
+        if depth == 0:
+            return pos
+    return pos
@@ -0,0 +1,130 @@
+import threading
+
+# This module aggregates the measured commands in memory. A Histogram is
+# installed as a hook by server.addHook(), and keeps per command name the
+# counts, byte totals and latencies in buckets doubling in milliseconds.
+
+# The upper bounds of the latency buckets in milliseconds. Slower commands go
+# into the last bucket.
+BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+
+class CommandStats(object):
+    """ The aggregated measures of one command name.
+
+    Arguments:
+        count:     The number of completed commands.
+        failed:    The number of commands not completed by OK.
+        first:     The total milliseconds until the first responses.
+        total:     The total milliseconds until the completions.
+        slowest:   The most milliseconds until a completion.
+        buckets:   The numbers of completions by latency, see BUCKETS.
+        bytes_out: The total bytes sent.
+        bytes_in:  The total bytes received.
+        literals:  The number of literals received.
+        literal:   The total bytes of the literals received.
+        largest:   The largest literal received.
+        responses: The total number of untagged responses.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.failed = 0
+        self.first = 0.0
+        self.total = 0.0
+        self.slowest = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.literals = 0
+        self.literal = 0
+        self.largest = 0
+        self.responses = 0
+
+    def add(self, command):
+        """ Add the measures of a completed server.Command.
+        """
+        elapsed = (command.completed - command.sent) * 1000
+        self.count += 1
+        if command.type != 'OK':
+            self.failed += 1
+        self.first += ((command.first or command.completed) - command.sent) * 1000
+        self.total += elapsed
+        self.slowest = max(self.slowest, elapsed)
+        self.buckets[_bucket(elapsed)] += 1
+        self.bytes_out += command.bytes_out
+        self.bytes_in += command.bytes_in
+        self.literals += len(command.literals)
+        self.literal += sum(command.literals)
+        self.largest = max([self.largest] + command.literals)
+        self.responses += command.responses
+
+    def percentile(self, fraction):
+        """ Return the upper bound in milliseconds of the bucket holding the
+        given fraction of the completions, such as 0.9.
+        """
+        rank = fraction * self.count
+        seen = 0
+        for i, num in enumerate(self.buckets):
+            seen += num
+            if seen >= rank and num:
+                return BUCKETS[i] if i < len(BUCKETS) else self.slowest
+        return 0
+
+class Histogram(object):
+    """ The in-memory aggregator of measured commands, installed with
+    server.addHook(histogram).
+
+    Arguments:
+        commands: A dictionary maps command names to their CommandStats. A
+                  UID command is kept by its sub-command, such as UID FETCH.
+        lock:     The lock guarding the statistics, since commands complete
+                  on the threads of their connections.
+    """
+
+    def __init__(self):
+        self.commands = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, command):
+        """ Add a completed server.Command.
+        """
+        name = command.name
+        if name == 'UID' and command.params:
+            name += ' ' + command.params[0].upper()
+        with self.lock:
+            if name not in self.commands:
+                self.commands[name] = CommandStats()
+            self.commands[name].add(command)
+
+    def clear(self):
+        """ Forget the statistics.
+        """
+        with self.lock:
+            self.commands = {}
+
+    def report(self):
+        """ Return the statistics as lines of text, one line per command name
+        and one line of its latency buckets.
+        """
+        lines = ['%-12s %6s %6s %9s %9s %9s %9s %10s %10s %8s %8s' % (
+                 'command', 'count', 'failed', 'first ms', 'mean ms', 'p90 ms', 'max ms',
+                 'bytes out', 'bytes in', 'literals', 'untagged')]
+        with self.lock:
+            for name in sorted(self.commands):
+                stats = self.commands[name]
+                lines.append('%-12s %6d %6d %9.1f %9.1f %9.1f %9.1f %10d %10d %8d %8d' % (
+                             name, stats.count, stats.failed, stats.first / stats.count,
+                             stats.total / stats.count, stats.percentile(0.9), stats.slowest,
+                             stats.bytes_out, stats.bytes_in, stats.literals, stats.responses))
+                buckets = ['<%dms:%d' % (BUCKETS[i], num) if i < len(BUCKETS) else '>=%dms:%d' % (BUCKETS[-1], num)
+                           for i, num in enumerate(stats.buckets) if num]
+                lines.append('%-12s %s' % ('', ' '.join(buckets)))
+        return lines
+
+def _bucket(elapsed):
+    """ Return the index of the bucket of a latency in milliseconds.
+    """
+    for i, bound in enumerate(BUCKETS):
+        if elapsed < bound:
+            return i
+    return len(BUCKETS)
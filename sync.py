@@ -0,0 +1,252 @@
+import os
+import re
+import sqlite3
+import threading
+import seqset
+import server
+from cache import CACHE_DIR
+from response import parseFetch, tokenize
+
+# This module synchronizes mailboxes incrementally. It follows RFC 7162
+# (CONDSTORE and QRESYNC) and falls back to comparing UIDs on servers
+# without these extensions.
+
+# Regular expression to match the response codes of SELECT. [7.1, RFC 3501]
+ResponseCode = re.compile(r'OK \[(?P<name>UIDVALIDITY|UIDNEXT|HIGHESTMODSEQ) (?P<value>\d+)\]')
+
+class SyncState(object):
+    """ The persistent state of synchronized mailboxes.
+
+    For each (account, mailbox) it keeps the UIDVALIDITY, UIDNEXT,
+    HIGHESTMODSEQ and the sequence set of known UIDs.
+
+    Arguments:
+        db:   The SQLite connection.
+        lock: The lock guarding the database.
+    """
+
+    def __init__(self, directory=CACHE_DIR):
+        """ Open the state database in the given directory.
+
+        Args:
+            directory: The directory of the state database.
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.db = sqlite3.connect(os.path.join(directory, 'sync.db'), check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS mailboxes ('
+                        'account TEXT, mailbox TEXT, uidvalidity INTEGER, uidnext INTEGER, '
+                        'highestmodseq INTEGER, uids TEXT, PRIMARY KEY (account, mailbox))')
+        self.db.commit()
+        self.lock = threading.Lock()
+
+    def get(self, account, mailbox):
+        """ Return the state of a mailbox.
+
+        Returns:
+            A tuple of UIDVALIDITY, UIDNEXT, HIGHESTMODSEQ and the list of known
+            UIDs, or None if the mailbox was never synchronized.
+        """
+        with self.lock:
+            row = self.db.execute('SELECT uidvalidity, uidnext, highestmodseq, uids FROM mailboxes '
+                                  'WHERE account = ? AND mailbox = ?', (account, mailbox)).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1], row[2], seqset.expand(row[3])
+
+    def put(self, account, mailbox, uidvalidity, uidnext, highestmodseq, uids):
+        """ Store the state of a mailbox.
+        """
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO mailboxes VALUES (?, ?, ?, ?, ?, ?)',
+                            (account, mailbox, uidvalidity, uidnext, highestmodseq,
+                             seqset.compress(uids)))
+            self.db.commit()
+
+class SyncResult(object):
+    """ The changes of a mailbox since the last synchronization.
+
+    Arguments:
+        new:      A list of EmailRecords of the new emails.
+        changed:  A list of EmailRecords, with UID and FLAGS, of the emails
+                  whose flags changed. With full set, it has all the emails.
+        vanished: A list of UIDs of the expunged emails.
+        full:     True if the mailbox was synchronized from scratch, or flag
+                  changes could not be told apart.
+    """
+
+    def __init__(self):
+        self.new = []
+        self.changed = []
+        self.vanished = []
+        self.full = False
+
+    def __repr__(self):
+        return '<SyncResult new=%d changed=%d vanished=%d full=%r>' % (
+                len(self.new), len(self.changed), len(self.vanished), self.full)
+
+class Synchronizer(object):
+    """ The incremental mailbox synchronization over one connection.
+
+    With QRESYNC, the changes are fetched while selecting the mailbox. With
+    CONDSTORE, only the emails changed since the last HIGHESTMODSEQ are
+    fetched. Otherwise the UIDs are compared with the known ones.
+
+    Arguments:
+        conn:    The authenticated blocking IMAPServer.
+        account: The account name in the state.
+        state:   The SyncState.
+    """
+
+    def __init__(self, conn, account, state):
+        """ Prepare the synchronization, enabling QRESYNC if supported.
+
+        Args:
+            conn:    The authenticated blocking IMAPServer.
+            account: The account name in the state, such as 'user@host'.
+            state:   The SyncState.
+        """
+        self.conn = conn
+        self.account = account
+        self.state = state
+        # QRESYNC must be enabled before selecting a mailbox. [3.2.3, RFC 7162]
+        if 'QRESYNC' not in conn.enabled and conn.state == 'AUTH' and conn.capable('QRESYNC'):
+            conn.ENABLE('QRESYNC')
+        self.qresync = 'QRESYNC' in conn.enabled
+        self.condstore = self.qresync or conn.capable('CONDSTORE')
+
+    def sync(self, mailbox, items='(UID FLAGS)'):
+        """ Synchronize a mailbox and return its changes.
+
+        Args:
+            mailbox: The mailbox name.
+            items:   The data items fetched for new emails. UID is always
+                     fetched.
+
+        Returns:
+            The SyncResult, or None if the mailbox cannot be selected.
+        """
+        known = self.state.get(self.account, mailbox)
+        params = [mailbox]
+        if known is not None and self.qresync and known[2]:
+            params.append('(QRESYNC (%d %d%s))' % (known[0], known[2],
+                          ' ' + seqset.compress(known[3]) if known[3] else ''))
+        elif self.condstore:
+            params.append('(CONDSTORE)')
+        select = self.conn.send('SELECT', *params)
+        type, data, untagged = select.result()
+        if type != 'OK':
+            return None
+        codes = {}
+        for info in untagged:
+            match = ResponseCode.match(info)
+            if match:
+                codes[match.group('name')] = int(match.group('value'))
+        uidvalidity = codes.get('UIDVALIDITY')
+        uidnext = codes.get('UIDNEXT')
+        modseq = codes.get('HIGHESTMODSEQ')
+        result = SyncResult()
+        # Start from scratch if the UIDs of the last synchronization are not
+        # valid any more. [2.3.1.1, RFC 3501]
+        if known is None or uidvalidity is None or known[0] != uidvalidity:
+            if known is not None:
+                result.vanished = known[3]
+            result.full = True
+            uids = self._fetchNew(result, 1, items)
+        elif self.qresync and known[2] and len(params) > 1:
+            uids = self._qresync(result, known, untagged, items)
+        elif self.condstore and known[2] and modseq is not None:
+            uids = self._condstore(result, known, untagged, items)
+        else:
+            uids = self._diff(result, known, items)
+        if modseq is None:
+            # The server does not support CONDSTORE for this mailbox.
+            modseq = 0
+        if uidnext is None:
+            uidnext = max(uids) + 1 if uids else 1
+        self.state.put(self.account, mailbox, uidvalidity, uidnext, modseq, uids)
+        return result
+
+    def _qresync(self, result, known, untagged, items):
+        """ Collect the changes reported while selecting with QRESYNC.
+        """
+        vanished = set()
+        changed = {}
+        for info in untagged:
+            tokens = tokenize(info)
+            if tokens[:1] == ['VANISHED']:
+                vanished.update(seqset.expand(tokens[-1]))
+            elif tokens[1:2] == ['FETCH']:
+                record = parseFetch(info)
+                changed[record.uid] = record
+        uids = set(known[3]) - vanished
+        result.vanished = sorted(vanished & set(known[3]))
+        result.changed = [changed[uid] for uid in sorted(changed) if uid in uids]
+        return sorted(uids | set(self._fetchNew(result, known[1], items)))
+
+    def _condstore(self, result, known, untagged, items):
+        """ Fetch the flags changed since the last HIGHESTMODSEQ, then compare
+        the UIDs only if some emails are expunged.
+        """
+        changed = self._fetch('1:*', '(UID FLAGS)', '(CHANGEDSINCE %d)' % known[2])
+        new = self._fetchNew(result, known[1], items)
+        new_set = set(new)
+        result.changed = [record for record in changed if record.uid not in new_set]
+        exists = _exists(untagged)
+        if exists is not None and exists == len(known[3]) + len(new):
+            return known[3] + new
+        current = self._uids()
+        result.vanished = sorted(set(known[3]) - set(current))
+        return current
+
+    def _diff(self, result, known, items):
+        """ Compare the UIDs and fetch all flags, for servers without
+        CONDSTORE.
+        """
+        records = self._fetch('1:*', '(UID FLAGS)')
+        current = sorted(record.uid for record in records)
+        new = self._fetchNew(result, known[1], items)
+        new_set = set(new)
+        result.vanished = sorted(set(known[3]) - set(current))
+        result.changed = [record for record in records if record.uid not in new_set]
+        result.full = True
+        return sorted(set(current) | new_set)
+
+    def _fetchNew(self, result, uidnext, items):
+        """ Fetch the emails with UID not less than uidnext into result.new.
+
+        Returns:
+            The list of their UIDs.
+        """
+        if 'UID' not in items.upper():
+            items = '(UID ' + items.strip('()') + ')'
+        for record in self._fetch('%d:*' % uidnext, items):
+            # n:* always includes the last email, even below n. [6.4.8]
+            if record.uid >= uidnext:
+                result.new.append(record)
+        return [record.uid for record in result.new]
+
+    def _uids(self):
+        """ Return the sorted list of UIDs in the selected mailbox.
+        """
+        return sorted(record.uid for record in self._fetch('1:*', '(UID)'))
+
+    def _fetch(self, uids, *items):
+        """ Send UID FETCH and return the EmailRecords.
+
+        Some servers reject 1:* in an empty mailbox, which gives no records.
+        """
+        try:
+            untagged = self.conn.send('UID', 'FETCH', uids, *items).result()[2]
+        except server.InvalidCommandError:
+            return []
+        return [parseFetch(info) for info in untagged if info.split(' ', 2)[1:2] == ['FETCH']]
+
+def _exists(untagged):
+    """ Return the number of emails from the EXISTS response, if any.
+    """
+    for info in untagged:
+        words = info.split(' ')
+        if words[1:2] == ['EXISTS']:
+            return int(words[0])
+    return None
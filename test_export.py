@@ -0,0 +1,95 @@
+import os
+import shutil
+import tempfile
+import unittest
+import client
+import export
+import fakeserver
+import server
+
+# Run with: python -m unittest test_export
+
+class MaildirRoundTripTest(unittest.TestCase):
+    """ Export a mailbox to a Maildir and restore it on the fake server.
+    """
+
+    def setUp(self):
+        self.mailboxes = {'INBOX': fakeserver.FakeMailbox('INBOX')}
+        self.mailboxes['INBOX'].add('Subject: old\r\n\r\nbody\r\n', ['\\Seen'], '01-Jan-2001 00:00:00 +0000')
+        self.mailboxes['INBOX'].add('Subject: zone\r\n\r\nbody\r\n', [], '17-Jul-1996 02:44:25 -0700')
+        self.server = fakeserver.FakeIMAPServer(self.mailboxes)
+        server.IMAP_SSL_PORT = self.server.start()
+        self.dest = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.dest)
+
+    def test_internaldate(self):
+        imap = client.IMAPClient('localhost', 'user', 'password')
+        self.assertEqual(imap.export(['INBOX'], self.dest), {'INBOX': 2})
+        self.assertEqual(imap.restore(self.dest + '/INBOX', 'Restored'), 2)
+        # The zone is not kept, only the moment.
+        self.assertEqual([(message.date, message.flags) for message in self.mailboxes['Restored'].messages],
+                         [('01-Jan-2001 00:00:00 +0000', ['\\Seen']), ('17-Jul-1996 09:44:25 +0000', [])])
+
+class MaildirOrderTest(unittest.TestCase):
+    """ Export emails whose UIDs sort differently as strings.
+    """
+
+    def setUp(self):
+        self.mailboxes = {'INBOX': fakeserver.FakeMailbox('INBOX')}
+        for uid in (2, 10):
+            self.mailboxes['INBOX'].uidnext = uid
+            self.mailboxes['INBOX'].add('Subject: %d\r\n\r\nbody\r\n' % uid)
+        self.server = fakeserver.FakeIMAPServer(self.mailboxes)
+        server.IMAP_SSL_PORT = self.server.start()
+        self.dest = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.dest)
+
+    def test_uid_order(self):
+        imap = client.IMAPClient('localhost', 'user', 'password')
+        self.assertEqual(imap.export(['INBOX'], self.dest), {'INBOX': 2})
+        # A foreign email follows the exported ones.
+        foreign = os.path.join(self.dest, 'INBOX', 'cur', '1.foreign:2,S')
+        with open(foreign, 'wb') as f:
+            f.write('Subject: foreign\r\n\r\nbody\r\n')
+        os.utime(foreign, (0, 0))
+        subjects = []
+        for flags, date, f in export.readMaildir(os.path.join(self.dest, 'INBOX')):
+            subjects.append(f.readline().strip())
+            f.close()
+        self.assertEqual(subjects, ['Subject: 2', 'Subject: 10', 'Subject: foreign'])
+
+class DelimiterTest(unittest.TestCase):
+    """ Export the mailboxes of a server whose hierarchy delimiter is '.'.
+    """
+
+    def setUp(self):
+        self.delimiter, fakeserver.DELIMITER = fakeserver.DELIMITER, '.'
+        self.mailboxes = {}
+        for name in ('INBOX', 'Work.Projects', 'Work.a/b'):
+            self.mailboxes[name] = fakeserver.FakeMailbox(name)
+            self.mailboxes[name].add('Subject: %s\r\n\r\nbody\r\n' % name)
+        self.server = fakeserver.FakeIMAPServer(self.mailboxes)
+        server.IMAP_SSL_PORT = self.server.start()
+        self.dest = tempfile.mkdtemp()
+
+    def tearDown(self):
+        fakeserver.DELIMITER = self.delimiter
+        self.server.stop()
+        shutil.rmtree(self.dest)
+
+    def test_nested(self):
+        imap = client.IMAPClient('localhost', 'user', 'password')
+        mailboxes = ['INBOX', 'Work.Projects', '"Work.a/b"']
+        self.assertEqual(imap.export(mailboxes, self.dest, 'mbox'), dict.fromkeys(mailboxes, 1))
+        self.assertEqual(sorted(os.listdir(os.path.join(self.dest, 'Work'))),
+                         ['Projects.mbox', 'Projects.mbox.imapCMD-export',
+                          'a\\057b.mbox', 'a\\057b.mbox.imapCMD-export'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,28 @@
+import shutil
+import tempfile
+import unittest
+from index import TextIndex
+from seqset import UIDSet
+
+# Run with: python -m unittest test_index
+
+class TextIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.index = TextIndex(self.directory)
+
+    def tearDown(self):
+        self.index.db.close()
+        shutil.rmtree(self.directory)
+
+    def test_broken_charset(self):
+        # base64 is a codec but not a charset, and decodes strictly only.
+        self.index.add('user@host', 'INBOX', 1, 1, 'Subject: broken\r\n'
+                       'Content-Type: text/plain; charset=base64\r\n\r\n', 'not base64 \xe9\r\n')
+        self.index.add('user@host', 'INBOX', 1, 2, 'Subject: normal\r\n\r\n', 'needle in the body\r\n')
+        self.assertEqual(self.index.search('user@host', 'INBOX', 1, 'needle'), UIDSet([2]))
+        self.assertEqual(self.index.covered('user@host', 'INBOX', 1), UIDSet([1, 2]))
+
+if __name__ == '__main__':
+    unittest.main()
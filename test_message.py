@@ -0,0 +1,87 @@
+import unittest
+from message import LazyEmail, Part, decodeHeaders
+from response import tokenize
+
+# Run with: python -m unittest test_message
+
+def _email(structure):
+    """ Return a LazyEmail of a BODYSTRUCTURE, without a client.
+    """
+    return LazyEmail(None, 'INBOX', 1, '', tokenize(structure)[0])
+
+def _part(content, encoding='7bit', **params):
+    """ Return a Part holding its content, which is never downloaded.
+    """
+    part = Part(None, '1', 'text/plain', params, encoding, len(content))
+    part.content = content
+    return part
+
+class StructureTest(unittest.TestCase):
+    """ Parse body structures as in the examples of [7.4.2].
+    """
+
+    def test_single(self):
+        body = _email('("TEXT" "PLAIN" ("CHARSET" "US-ASCII") NIL NIL "7BIT" 3028 92)').body
+        self.assertEqual((body.section, body.type, body.params, body.encoding, body.size, body.children),
+                         ('1', 'text/plain', {'charset': 'US-ASCII'}, '7bit', 3028, []))
+
+    def test_multipart(self):
+        email = _email('(("TEXT" "PLAIN" ("CHARSET" "US-ASCII") NIL NIL "7BIT" 1152 23)'
+                       '("TEXT" "PLAIN" ("CHARSET" "US-ASCII" "NAME" "cc.diff") "<960723163407.20117h@cac.washington.edu>" '
+                       '"Compiler diff" "BASE64" 4554 73) "MIXED" ("BOUNDARY" "x"))')
+        self.assertEqual((email.body.section, email.body.type, email.body.params), ('TEXT', 'multipart/mixed', {'boundary': 'x'}))
+        self.assertEqual([(part.section, part.encoding, part.filename) for part in email.parts()],
+                         [('1', '7bit', None), ('2', 'base64', 'cc.diff')])
+
+    def test_nested(self):
+        # A message/rfc822 part holds the structure of its email, whose parts
+        # are numbered under it. [6.4.5]
+        email = _email('(("TEXT" "HTML" ("CHARSET" "UTF-8") NIL NIL "QUOTED-PRINTABLE" 200 4 NIL NIL NIL NIL)'
+                       '(("TEXT" "PLAIN" NIL NIL NIL "7BIT" 10 1)("IMAGE" "PNG" NIL NIL NIL "BASE64" 300) "ALTERNATIVE" NIL)'
+                       '("MESSAGE" "RFC822" NIL NIL NIL "7BIT" 500 ("date" "subject" NIL NIL NIL NIL NIL NIL NIL "<id>") '
+                       '("TEXT" "PLAIN" NIL NIL NIL "7BIT" 20 2) 12 NIL ("ATTACHMENT" ("FILENAME" "fwd.eml")) NIL NIL) '
+                       '"MIXED" NIL NIL NIL NIL)')
+        self.assertEqual([(part.section, part.type) for part in email.body.walk()],
+                         [('TEXT', 'multipart/mixed'), ('1', 'text/html'), ('2', 'multipart/alternative'),
+                          ('2.1', 'text/plain'), ('2.2', 'image/png'), ('3', 'message/rfc822')])
+        forwarded = email.body.children[2]
+        self.assertEqual((forwarded.size, forwarded.disposition, forwarded.filename), (500, 'attachment', 'fwd.eml'))
+
+    def test_disposition(self):
+        email = _email('(("TEXT" "PLAIN" NIL NIL NIL "7BIT" 10 1 NIL ("INLINE" NIL) NIL NIL)'
+                       '("APPLICATION" "PDF" ("NAME" "a.pdf") NIL NIL "BASE64" 4000 NIL '
+                       '("ATTACHMENT" ("FILENAME" "report.pdf")) NIL NIL) "MIXED" NIL NIL NIL NIL)')
+        self.assertEqual([(part.disposition, part.filename) for part in email.parts()],
+                         [('inline', None), ('attachment', 'report.pdf')])
+        # An attachment is never the text of the email.
+        self.assertEqual(email.find('application/pdf', 'text/plain').section, '1')
+
+class PartTest(unittest.TestCase):
+
+    def test_decode(self):
+        self.assertEqual(_part('aGVsbG8gd29ybGQ=', 'base64').decode(), 'hello world')
+        self.assertEqual(_part('caf=C3=A9 =\r\nau lait', 'quoted-printable').decode(), 'caf\xc3\xa9 au lait')
+        self.assertEqual(_part('plain =41', '8bit').decode(), 'plain =41')
+
+    def test_text(self):
+        self.assertEqual(_part('Y2Fmw6k=', 'base64', charset='UTF-8').text(), u'caf\xe9')
+        # Without a charset, the text is US-ASCII. [RFC 2045]
+        self.assertEqual(_part('caf\xe9').text(), u'caf\ufffd')
+
+    def test_text_broken_charset(self):
+        # Codecs which are not charsets, and unknown charsets, give latin-1.
+        for charset in ('base64', 'zlib', 'hex', 'x-unknown'):
+            self.assertEqual(_part('caf\xe9', charset=charset).text(), u'caf\xe9')
+
+class DecodeHeadersTest(unittest.TestCase):
+
+    def test_encoded_words(self):
+        self.assertEqual(decodeHeaders(['=?utf-8?Q?Caf=C3=A9?= =?iso-8859-1?B?Y3LobWU=?=', 'plain \xe9']),
+                         [u'Caf\xe9 cr\xe8me', u'plain \xe9'])
+
+    def test_broken_charset(self):
+        # A codec which is not a charset gives latin-1.
+        self.assertEqual(decodeHeaders(['=?base64?Q?abc?=', '=?zlib?Q?caf=E9?=']), [u'abc', u'caf\xe9'])
+
+if __name__ == '__main__':
+    unittest.main()